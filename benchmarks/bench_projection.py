@@ -0,0 +1,99 @@
+"""
+    Microbenchmark for event field projection.
+
+    Compares the per-key get_prop_value loop the alert action used to run for every
+    event with puppetenterprise_sdk.projection.FieldProjector.
+
+    Usage: python benchmarks/bench_projection.py [event_count]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+
+from puppetenterprise_sdk.projection import FieldProjector
+
+# The default EVENT_KEYS of bin/puppetenterprise_itsi.py
+EVENT_KEYS = [
+    'alert_level', 'alert_severity', 'alert_value', 'change_type', 'composite_kpi_name',
+    'description', 'drilldown_uri', 'event_description', 'event_id', 'health_score', 'host',
+    'linecount', 'orig_index', 'owner', 'scoretype', 'search_name', 'service_ids', 'severity',
+    'severity_label', 'source', 'splunk_server', 'tag', 'time', 'title',
+]
+
+DEFAULT_EVENT_COUNT = 20000
+REPEATS = 5
+
+
+def get_prop_value(key, value):
+    """
+        The previous per value coercion, kept here as the baseline
+    """
+    value_type = type(value)
+    if value_type is list:
+        return ','.join(value)
+    elif value_type is str or value_type is unicode:
+        return value
+    elif value is None:
+        return ''
+    return False
+
+
+def get_key_values_from_object(keys, source_object):
+    """
+        The previous per event projection, kept here as the baseline
+    """
+    result = {}
+    for key in keys:
+        value = get_prop_value(key, source_object.get(key))
+        if value is not False:
+            result[key] = value
+    return result
+
+
+def build_events(event_count):
+    """
+        @return: <list[dict]> synthetic child events shaped like Notable Events
+    """
+    events = []
+    for index in xrange(event_count):
+        event = dict((key, u'%s-%d' % (key, index)) for key in EVENT_KEYS)
+        event['service_ids'] = [u'service-%d' % (index % 7), u'service-%d' % (index % 11)]
+        event['tag'] = None
+        event['linecount'] = u'1'
+        event['extra_field'] = u'not projected'
+        events.append(event)
+    return events
+
+
+def run(label, project, events):
+    """
+        Times the best of REPEATS passes over events
+    """
+    best = None
+    for _ in range(REPEATS):
+        start = time.time()
+        for event in events:
+            project(event)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    per_event_us = best / len(events) * 1000000
+    print '%-12s events=%d total_ms=%.1f per_event_us=%.2f' % (label, len(events), best * 1000, per_event_us)
+    return per_event_us
+
+
+def main():
+    event_count = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_EVENT_COUNT
+    events = build_events(event_count)
+    projector = FieldProjector(EVENT_KEYS)
+
+    assert projector.project(events[0]) == get_key_values_from_object(EVENT_KEYS, events[0])
+
+    baseline = run('baseline', lambda event: get_key_values_from_object(EVENT_KEYS, event), events)
+    projected = run('projector', projector.project, events)
+    print 'speedup=%.2fx' % (baseline / projected)
+
+
+if __name__ == '__main__':
+    main()
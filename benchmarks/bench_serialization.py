@@ -0,0 +1,147 @@
+"""
+    Compares the JSON backends of common_utils.serialization on episode payloads.
+
+    The payload is built the way the alert action builds it, a PuppetEnterpriseEvent
+    holding every event of a synthetic episode, grown until it encodes to --size-kb.
+    For every backend that is installed it reports the throughput of encoding the
+    payload, decoding it, and decoding a REST handler request, where splunkd wraps
+    the payload as a json string inside the request json so it is decoded twice.
+    The standard library's iterencode, used for streamed sends, is listed as
+    json-stream.
+
+    Usage:
+        python benchmarks/bench_serialization.py
+        python benchmarks/bench_serialization.py --size-kb 4096 --repeat 20
+"""
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCHMARKS_DIR)
+sys.path[:0] = [
+    os.path.join(BENCHMARKS_DIR, 'stubs'),
+    os.path.join(ROOT_DIR, 'lib'),
+    BENCHMARKS_DIR,
+]
+
+from common_utils import serialization
+from puppetenterprise_sdk.aggregation import EpisodeAggregator
+from puppetenterprise_sdk.puppetenterprise_event import PuppetEnterpriseEvent
+from run_benchmarks import iter_events
+
+
+def build_payload(size_kb):
+    """
+        @param size_kb: <int> the approximate encoded size to reach
+        @return: <dict> an Orchestrator deploy body for an episode of that size
+    """
+    events = 1000
+    while True:
+        aggregator = EpisodeAggregator()
+        nodes = set()
+        for event in iter_events('episode-1', events):
+            aggregator.add(event['event_id'], event, 'high')
+            nodes.add(event['host'])
+        pe_event = PuppetEnterpriseEvent()
+        pe_event.set_scope('production', sorted(nodes))
+        pe_event.add_property('event_count', aggregator.event_count)
+        pe_event.add_property('events_by_id', aggregator.get_events_by_id())
+        pe_event.add_property('event_ids_by_severity', aggregator.get_event_ids_by_severity())
+        pe_event.add_recipient('ops')
+        pe_event.set_priority('medium')
+        payload = pe_event.get_payload()
+        size = len(json.dumps(payload))
+        if size >= size_kb * 1024:
+            return payload
+        events = int(events * float(size_kb * 1024) / size) + 1
+
+
+def measure(function, repeat):
+    """
+        @return: <float> the best of repeat runs, in seconds
+    """
+    best = None
+    for _ in range(repeat):
+        gc.collect()
+        start = time.time()
+        function()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bench_backend(name, payload, repeat):
+    """
+        @return: <dict> the throughput of the backend, None if it isn't installed
+    """
+    if serialization.set_backend(name) != name:
+        return None
+    dumps = serialization.dumps
+    loads = serialization.loads
+    encoded = dumps(payload)
+    assert json.loads(encoded) == json.loads(json.dumps(payload)), '%s output differs' % name
+    request = dumps({'method': 'POST', 'payload': encoded, 'session': {'authtoken': 'x'}})
+    size_mb = len(encoded) / (1024.0 * 1024.0)
+    return {
+        'backend': name,
+        'size_kb': len(encoded) / 1024,
+        'dumps_mb_s': size_mb / measure(lambda: dumps(payload), repeat),
+        'loads_mb_s': size_mb / measure(lambda: loads(encoded), repeat),
+        'handler_mb_s': size_mb / measure(lambda: loads(loads(request)['payload']), repeat),
+    }
+
+
+def bench_stream(payload, repeat):
+    encoded = json.dumps(payload)
+    size_mb = len(encoded) / (1024.0 * 1024.0)
+    encoder = json.JSONEncoder()
+    return {
+        'backend': 'json-stream',
+        'size_kb': len(encoded) / 1024,
+        'dumps_mb_s': size_mb / measure(lambda: list(encoder.iterencode(payload)), repeat),
+        'loads_mb_s': None,
+        'handler_mb_s': None,
+    }
+
+
+def format_rate(value):
+    return '%8.1f' % value if value is not None else '       -'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--size-kb', type=int, default=1024, help='encoded payload size')
+    parser.add_argument('--repeat', type=int, default=10, help='runs per measurement, the best is kept')
+    parser.add_argument('--json', dest='json_path', default=None, help='also write the results here')
+    options = parser.parse_args()
+
+    payload = build_payload(options.size_kb)
+    results = []
+    for name in serialization.BACKENDS:
+        result = bench_backend(name, payload, options.repeat)
+        if result is None:
+            print 'backend=%s not installed' % name
+            continue
+        results.append(result)
+    results.append(bench_stream(payload, options.repeat))
+
+    for result in results:
+        print 'backend=%-12s size_kb=%d dumps_mb_s=%s loads_mb_s=%s handler_mb_s=%s' % (
+            result['backend'],
+            result['size_kb'],
+            format_rate(result['dumps_mb_s']),
+            format_rate(result['loads_mb_s']),
+            format_rate(result['handler_mb_s'])
+        )
+
+    if options.json_path:
+        with open(options.json_path, 'w') as json_file:
+            json.dump(results, json_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""
+    Microbenchmark for task and plan parameter templates.
+
+    Compares parsing and compiling the template for every payload with rendering
+    the cached template from puppetenterprise_sdk.templates.get_template.
+
+    Usage: python benchmarks/bench_templates.py [payload_count]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+
+from puppetenterprise_sdk.templates import ParameterTemplate, get_template
+
+# Parameters for the splunk::pkgsrv example class, run through a task
+TEMPLATE = '''{
+    "pkgname": "{pkgname}",
+    "pkgver": "{pkgver}",
+    "srvname": "{srvname}",
+    "description": "Remediating {title} on {host} for episode {event_id}",
+    "targets": "{nodes}",
+    "options": {"noop": false, "retries": 3, "environment": "{environment}"}
+}'''
+
+DEFAULT_PAYLOAD_COUNT = 20000
+REPEATS = 5
+
+
+def build_fields(payload_count):
+    """
+        @return: <list[dict]> synthetic correlation event fields
+    """
+    fields = []
+    for index in xrange(payload_count):
+        fields.append({
+            'pkgname': u'httpd',
+            'pkgver': u'2.4.%d' % (index % 50),
+            'srvname': u'httpd',
+            'title': u'Episode %d' % index,
+            'host': u'node-%d.example.com' % index,
+            'event_id': u'episode-%d' % index,
+            'nodes': [u'node-%d.example.com' % index, u'node-%d.example.com' % (index + 1)],
+            'environment': u'production',
+        })
+    return fields
+
+
+def run(label, render, fields):
+    """
+        Times the best of REPEATS passes over fields
+    """
+    best = None
+    for _ in range(REPEATS):
+        start = time.time()
+        for item in fields:
+            render(item)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    per_payload_us = best / len(fields) * 1000000
+    print '%-12s payloads=%d total_ms=%.1f per_payload_us=%.2f' % (label, len(fields), best * 1000, per_payload_us)
+    return per_payload_us
+
+
+def main():
+    payload_count = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_PAYLOAD_COUNT
+    fields = build_fields(payload_count)
+
+    assert ParameterTemplate(TEMPLATE).render(fields[0]) == get_template(TEMPLATE, version='1').render(fields[0])
+
+    uncached = run('uncached', lambda item: ParameterTemplate(TEMPLATE).render(item), fields)
+    cached = run('cached', lambda item: get_template(TEMPLATE, version='1').render(item), fields)
+    print 'speedup=%.2fx' % (uncached / cached)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,336 @@
+"""
+    A local HTTPS stand-in for the Puppet Enterprise Orchestrator and splunkd REST
+    endpoints used by the app, with configurable latency and error injection.
+
+    One server answers both APIs so a single port can be used for endpoint_url and
+    the splunkd server uri. Every request is counted per route so the benchmarks
+    can report how many calls a run made.
+"""
+import BaseHTTPServer
+import SocketServer
+import json
+import os
+import random
+import re
+import shutil
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+import urlparse
+
+ROUTES = [
+    ('orchestrator_command', 'POST', re.compile(r'^/orchestrator/v1/command/[a-z_]+$')),
+    ('orchestrator_job_nodes', 'GET', re.compile(r'^/orchestrator/v1/jobs/[^/]+/nodes$')),
+    ('orchestrator_job', 'GET', re.compile(r'^/orchestrator/v1/jobs/[^/]+$')),
+    ('puppetdb_nodes', 'GET', re.compile(r'^/pdb/query/v4/nodes$')),
+    ('puppetdb_facts', 'GET', re.compile(r'^/pdb/query/v4/facts$')),
+    ('puppetdb_fact_contents', 'GET', re.compile(r'^/pdb/query/v4/fact-contents$')),
+    ('splunkd_password', 'GET', re.compile(r'^/servicesNS/nobody/[^/]+/storage/passwords/')),
+    ('splunkd_user', 'GET', re.compile(r'^/services/authentication/users/[^/]+$')),
+    ('splunkd_app', 'GET', re.compile(r'^/services/apps/local/[^/]+$')),
+    ('splunkd_event_comment', 'POST', re.compile(r'^/servicesNS/nobody/SA-ITOA/event_management_interface/notable_event_comment$')),
+    ('splunkd_event_update', 'POST', re.compile(r'^/servicesNS/nobody/SA-ITOA/event_management_interface/notable_event$')),
+]
+
+MOCK_PASSWORD = 'mock-pe-token'
+MOCK_ITSI_VERSION = '4.4.0'
+
+
+def create_certificate(cert_dir):
+    """
+        Creates a self-signed certificate for 127.0.0.1 with openssl
+        @param cert_dir: <str> the directory to write cert.pem and key.pem to
+        @return: <tuple(str, str)> the certificate and key paths
+    """
+    cert_path = os.path.join(cert_dir, 'cert.pem')
+    key_path = os.path.join(cert_dir, 'key.pem')
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call([
+            'openssl', 'req', '-x509', '-nodes', '-newkey', 'rsa:2048', '-days', '1',
+            '-subj', '/CN=127.0.0.1', '-keyout', key_path, '-out', cert_path
+        ], stdout=devnull, stderr=devnull)
+    return cert_path, key_path
+
+
+def read_chunked_body(rfile):
+    """
+        @param rfile: <file> the request stream, positioned at the first chunk
+        @return: <str> the decoded body of a chunked request
+    """
+    chunks = []
+    while True:
+        size = int(rfile.readline().split(';')[0].strip(), 16)
+        if size == 0:
+            # skip any trailers up to the blank line
+            while rfile.readline().strip():
+                pass
+            return ''.join(chunks)
+        chunks.append(rfile.read(size))
+        rfile.readline()
+
+
+class MockRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+        Routes requests to canned responses after the configured latency
+    """
+    protocol_version = 'HTTP/1.1'
+    # buffer the status line and headers so a response is one write, unbuffered
+    # writes stall keep-alive clients on Nagle and delayed acks
+    wbufsize = -1
+
+    def log_message(self, log_format, *args):
+        pass
+
+    def read_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            return read_chunked_body(self.rfile)
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else ''
+
+    def send_json(self, status, payload, headers=None):
+        body = json.dumps(payload)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.wfile.flush()
+
+    def handle_request(self, method):
+        path = self.path.split('?', 1)[0]
+        body = self.read_body()
+        route = None
+        for name, route_method, pattern in ROUTES:
+            if route_method == method and pattern.match(path):
+                route = name
+                break
+
+        services = self.server.services
+        is_error = services.record(route or 'unknown', len(body))
+        services.wait()
+
+        if route is None:
+            self.send_json(404, {'message': 'not found: %s %s' % (method, path)})
+        elif is_error:
+            headers = {}
+            if services.retry_after is not None:
+                headers['Retry-After'] = str(services.retry_after)
+            self.send_json(services.error_status, {'message': 'injected error'}, headers)
+        else:
+            self.send_json(*services.respond(route, self.path, body))
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+
+class ThreadingHTTPSServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def handle_error(self, request, client_address):
+        # clients closing pooled keep-alive connections are expected
+        pass
+
+
+class MockServices(object):
+    """
+        Runs the mock server on a background thread
+    """
+
+    def __init__(self, **kwargs):
+        """
+            @param latency_ms: <float>, An optional delay added to every response
+            @param jitter_ms: <float>, An optional uniform random delay added on top
+            @param error_rate: <float>, An optional fraction of requests answered with an error
+            @param error_status: <int>, An optional status for injected errors, defaults to 503
+            @param retry_after: <int>, An optional Retry-After sent with injected errors
+            @param error_routes: <list[str]>, An optional list of route names errors are
+                injected into, defaults to every route
+            @param job_nodes: <int>, The number of nodes reported for every job
+            @param puppetdb_nodes: <int>, The number of nodes in PuppetDB, named like the
+                hosts of the benchmark events
+            @param seed: <int>, An optional seed for the error and jitter draws
+        """
+        self.latency_ms = kwargs.get('latency_ms', 0)
+        self.jitter_ms = kwargs.get('jitter_ms', 0)
+        self.error_rate = kwargs.get('error_rate', 0)
+        self.error_routes = kwargs.get('error_routes')
+        self.error_status = kwargs.get('error_status', 503)
+        self.retry_after = kwargs.get('retry_after')
+        self.job_nodes = kwargs.get('job_nodes', 10)
+        self.puppetdb_nodes = kwargs.get('puppetdb_nodes', 500)
+        self.random = random.Random(kwargs.get('seed', 0))
+        self.lock = threading.Lock()
+        self.job_counter = 0
+        self.cert_dir = None
+        self.server = None
+        self.thread = None
+        self.reset()
+
+    def reset(self):
+        """
+            Clears the request counters
+        """
+        with self.lock:
+            self.counts = {}
+            self.bytes_received = 0
+            self.errors = 0
+
+    def get_counts(self):
+        """
+            @return: <dict> the requests per route, plus totals
+        """
+        with self.lock:
+            counts = dict(self.counts)
+            counts['total'] = sum(self.counts.values())
+            counts['errors'] = self.errors
+            counts['bytes_received'] = self.bytes_received
+            return counts
+
+    def record(self, route, body_size):
+        """
+            Counts a request and decides whether it fails
+            @return: <bool> True if an error should be injected
+        """
+        with self.lock:
+            self.counts[route] = self.counts.get(route, 0) + 1
+            self.bytes_received += body_size
+            is_error = (
+                self.error_rate > 0 and
+                (self.error_routes is None or route in self.error_routes) and
+                self.random.random() < self.error_rate
+            )
+            if is_error:
+                self.errors += 1
+            return is_error
+
+    def wait(self):
+        delay = self.latency_ms
+        if self.jitter_ms:
+            with self.lock:
+                delay += self.random.uniform(0, self.jitter_ms)
+        if delay:
+            time.sleep(delay / 1000.0)
+
+    def get_puppetdb_page(self, query, make_item, **kwargs):
+        """
+            @param total: <int> An optional number of results, defaults to one per node
+            @return: <list[dict]> the page of PuppetDB results asked for by limit and offset
+        """
+        total = kwargs.get('total', self.puppetdb_nodes)
+        params = urlparse.parse_qs(query)
+        offset = int(params.get('offset', ['0'])[0])
+        limit = int(params.get('limit', [str(total)])[0])
+        return [make_item(index) for index in range(offset, min(offset + limit, total))]
+
+    def get_fact_contents_page(self, query):
+        """
+            @return: <list[dict]> a page of fact-contents results, one per node and
+                ['=', 'path', [...]] clause in the query
+        """
+        paths = []
+
+        def find_paths(clause):
+            if isinstance(clause, list) and clause[:2] == ['=', 'path']:
+                paths.append(clause[2])
+            elif isinstance(clause, list):
+                for item in clause:
+                    find_paths(item)
+        query_param = urlparse.parse_qs(query).get('query')
+        if query_param:
+            find_paths(json.loads(query_param[0]))
+        if not paths:
+            return []
+        return self.get_puppetdb_page(query, lambda index: {
+            'certname': 'node-%d.example.com' % (index // len(paths)),
+            'environment': 'production',
+            'name': paths[index % len(paths)][0],
+            'path': paths[index % len(paths)],
+            'value': '%s-%d' % (paths[index % len(paths)][-1], (index // len(paths)) % 4),
+        }, total=self.puppetdb_nodes * len(paths))
+
+    def respond(self, route, path, body):
+        """
+            @return: <tuple(int, dict|list)> the status and payload for a routed request
+        """
+        path, _, query = path.partition('?')
+        if route == 'orchestrator_command':
+            json.loads(body)
+            with self.lock:
+                self.job_counter += 1
+                job_name = str(self.job_counter)
+            if path.endswith('/plan_run'):
+                return 202, {'name': job_name}
+            return 202, {'job': {'id': 'https://%s/orchestrator/v1/jobs/%s' % (self.get_host(), job_name),
+                                 'name': job_name}}
+        if route == 'orchestrator_job':
+            return 200, {'state': 'finished', 'name': path.rsplit('/', 1)[-1]}
+        if route == 'orchestrator_job_nodes':
+            items = [{'name': 'node-%d' % index, 'state': 'finished'} for index in range(self.job_nodes)]
+            return 200, {'items': items, 'pagination': {'total': len(items)}}
+        if route == 'puppetdb_nodes':
+            return 200, self.get_puppetdb_page(query, lambda index: {
+                'certname': 'node-%d.example.com' % index,
+                'catalog_environment': 'production',
+                'facts_timestamp': '2020-01-01T00:00:00.000Z',
+            })
+        if route == 'puppetdb_facts':
+            return 200, self.get_puppetdb_page(query, lambda index: {
+                'certname': 'node-%d.example.com' % index,
+                'name': 'itsi_services',
+                'value': ['service-%d' % (index % 7)],
+            })
+        if route == 'puppetdb_fact_contents':
+            return 200, self.get_fact_contents_page(query)
+        if route == 'splunkd_password':
+            return 200, {'entry': [{'content': {'clear_password': MOCK_PASSWORD}}]}
+        if route == 'splunkd_user':
+            return 200, {'entry': [{'content': {'roles': ['itoa_analyst']}}]}
+        if route == 'splunkd_app':
+            return 200, {'entry': [{'content': {'version': MOCK_ITSI_VERSION}}]}
+        return 200, {'success': True}
+
+    def get_host(self):
+        return '127.0.0.1:%d' % self.server.server_address[1]
+
+    def get_uri(self):
+        """
+            @return: <str> the https base uri of the running server
+        """
+        return 'https://%s' % self.get_host()
+
+    def start(self):
+        """
+            Starts serving on a free port with a fresh self-signed certificate
+            @return: <str> the https base uri
+        """
+        self.cert_dir = tempfile.mkdtemp(prefix='pe_bench_cert_')
+        cert_path, key_path = create_certificate(self.cert_dir)
+        self.server = ThreadingHTTPSServer(('127.0.0.1', 0), MockRequestHandler)
+        self.server.services = self
+        self.server.socket = ssl.wrap_socket(
+            self.server.socket,
+            certfile=cert_path,
+            keyfile=key_path,
+            server_side=True
+        )
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self.get_uri()
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+        if self.cert_dir is not None:
+            shutil.rmtree(self.cert_dir, ignore_errors=True)
+            self.cert_dir = None
@@ -0,0 +1,157 @@
+"""
+    Reports the cold start import cost of the bin/ entry points, per module.
+
+    Each entry point is imported in a fresh interpreter with an __import__ hook that
+    times every module the first time it is loaded. Python 2 has no -X importtime,
+    so the hook stands in for it. self_ms excludes the time spent importing the
+    module's own imports, cumulative_ms includes it.
+
+    Usage:
+        python benchmarks/profile_startup.py                  all entry points, offline stubs
+        python benchmarks/profile_startup.py puppetenterprise_itsi --top 10
+        splunk cmd python benchmarks/profile_startup.py --no-stubs
+"""
+import __builtin__
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCHMARKS_DIR)
+
+ENTRY_POINTS = [
+    'puppetenterprise_itsi',
+    'puppetenterprise_comment_handler',
+    'puppetenterprise_response_handler',
+    'puppetenterprise_bulk_handler',
+    'puppetenterprise_spool_sender',
+    'puppetenterprise_job_poller',
+    'puppetenterprise_node_indexer',
+    'puppetenterprise_action_worker',
+]
+
+
+class ImportProfiler(object):
+    """
+        Wraps __import__ and records the first import of every module
+    """
+
+    def __init__(self):
+        self.original_import = __builtin__.__import__
+        self.timings = {}
+        self.stack = []
+
+    def profiled_import(self, name, globals_=None, locals_=None, fromlist=None, level=-1):
+        if name in sys.modules or name in self.timings:
+            return self.original_import(name, globals_, locals_, fromlist, level)
+        # time spent in nested first imports is subtracted from this module's self time
+        self.stack.append(0.0)
+        start = time.time()
+        try:
+            return self.original_import(name, globals_, locals_, fromlist, level)
+        finally:
+            elapsed = time.time() - start
+            children = self.stack.pop()
+            if self.stack:
+                self.stack[-1] += elapsed
+            self.timings[name] = {
+                'cumulative_ms': elapsed * 1000,
+                'self_ms': (elapsed - children) * 1000,
+                'depth': len(self.stack),
+            }
+
+    def install(self):
+        __builtin__.__import__ = self.profiled_import
+
+    def uninstall(self):
+        __builtin__.__import__ = self.original_import
+
+
+def profile_child(entry_point):
+    """
+        Runs in the fresh interpreter, imports the entry point and prints the timings
+    """
+    profiler = ImportProfiler()
+    start = time.time()
+    profiler.install()
+    try:
+        __import__(entry_point)
+    finally:
+        profiler.uninstall()
+    print json.dumps({
+        'entry_point': entry_point,
+        'total_ms': (time.time() - start) * 1000,
+        'modules': profiler.timings,
+        'loggers': len(__import__('logging').Logger.manager.loggerDict),
+    })
+
+
+def run_child(entry_point, use_stubs):
+    """
+        @return: <dict> the timings reported by a fresh interpreter
+    """
+    paths = [os.path.join(ROOT_DIR, 'lib'), os.path.join(ROOT_DIR, 'bin')]
+    env = dict(os.environ)
+    if use_stubs:
+        paths.insert(0, os.path.join(BENCHMARKS_DIR, 'stubs'))
+        env.setdefault('SPLUNK_HOME', tempfile.gettempdir())
+    env['PYTHONPATH'] = os.pathsep.join(paths + [env.get('PYTHONPATH', '')])
+    output = subprocess.check_output(
+        [sys.executable, '-B', os.path.abspath(__file__), '--child', entry_point],
+        env=env
+    )
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def format_profile(profile, top):
+    lines = [
+        'entry_point=%s total_ms=%.2f modules=%d loggers=%d' % (
+            profile['entry_point'],
+            profile['total_ms'],
+            len(profile['modules']),
+            profile['loggers']
+        )
+    ]
+    modules = sorted(profile['modules'].items(), key=lambda item: -item[1]['self_ms'])
+    for name, timing in modules[:top]:
+        lines.append('    self_ms=%8.2f cumulative_ms=%8.2f depth=%d module=%s' % (
+            timing['self_ms'],
+            timing['cumulative_ms'],
+            timing['depth'],
+            name
+        ))
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('entry_points', nargs='*', default=ENTRY_POINTS,
+                        help='bin/ modules to profile, defaults to all of them')
+    parser.add_argument('--top', type=int, default=15, help='modules listed per entry point')
+    parser.add_argument('--no-stubs', dest='use_stubs', action='store_false',
+                        help='use the real splunk and ITSI modules, eg. under splunk cmd python')
+    parser.add_argument('--json', dest='json_path', default=None, help='also write the results here')
+    parser.add_argument('--child', default=None, help=argparse.SUPPRESS)
+    options = parser.parse_args()
+
+    if options.child:
+        profile_child(options.child)
+        return
+
+    profiles = []
+    for entry_point in options.entry_points:
+        profile = run_child(entry_point, options.use_stubs)
+        profiles.append(profile)
+        print format_profile(profile, options.top)
+
+    if options.json_path:
+        with open(options.json_path, 'w') as json_file:
+            json.dump(profiles, json_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
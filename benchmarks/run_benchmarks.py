@@ -0,0 +1,404 @@
+"""
+    End to end benchmarks for the alert action and the REST handlers, run offline.
+
+    The ITSI and splunk SDK modules are replaced by the stubs in benchmarks/stubs and
+    both Puppet Enterprise and splunkd are served by benchmarks/mock_services.py, so
+    only python 2.7 and openssl are needed. Each scenario drives synthetic episodes
+    through the real code and reports, per episode size:
+
+        p50_ms / p99_ms     the latency of one execute() or handle() call
+        events_per_s        episode events processed per second
+        maxrss_kb           the growth of the peak resident set size
+        retained_objects    gc tracked objects left alive after the runs, python 2
+                            has no tracemalloc so this and maxrss stand in for
+                            allocation tracking
+        requests_per_run    the requests the mock services received per run, with a
+                            per route breakdown
+
+    Usage:
+        python benchmarks/run_benchmarks.py --sizes 10,1000,100000 --runs 5
+        python benchmarks/run_benchmarks.py --scenarios execute --latency-ms 20 --error-rate 0.1
+"""
+import argparse
+import gc
+import json
+import os
+import resource
+import shutil
+import ssl
+import sys
+import tempfile
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCHMARKS_DIR)
+sys.path[:0] = [
+    os.path.join(BENCHMARKS_DIR, 'stubs'),
+    os.path.join(ROOT_DIR, 'lib'),
+    os.path.join(ROOT_DIR, 'bin'),
+    BENCHMARKS_DIR,
+]
+
+from mock_services import MockServices
+
+SCENARIOS = ['execute', 'comment', 'response', 'response_async', 'response_burst', 'bulk']
+DEFAULT_SIZES = '10,1000,10000,100000'
+SEVERITIES = ['1', '2', '3', '4', '5', '6']
+SESSION_KEY = 'bench-session-key'
+# The task and plan parameters of --command task and plan_run
+PARAMETERS = '{"action": "install", "name": "{title}", "targets": "{nodes}"}'
+
+
+def create_splunk_home():
+    """
+        Creates a throwaway SPLUNK_HOME so the local state works as it does on an instance
+        @return: <str> the directory
+    """
+    return tempfile.mkdtemp(prefix='pe_bench_home_')
+
+
+def iter_events(episode_id, size):
+    """
+        Yields child events shaped like the Notable Events SDK returns them, lazily
+            like the SDK so the episode is never fully held in memory
+    """
+    for index in xrange(size):
+        yield {
+            'event_id': u'%s-%d' % (episode_id, index),
+            'host': u'node-%d.example.com' % (index % 500),
+            'severity': SEVERITIES[index % len(SEVERITIES)],
+            'title': u'KPI breach %d' % index,
+            'description': u'Synthetic event %d of %s' % (index, episode_id),
+            'service_ids': [u'service-%d' % (index % 7)],
+            'owner': u'unassigned',
+            'time': u'%d' % (1500000000 + index),
+            'tag': None,
+            'source': u'bench',
+        }
+
+
+def get_percentile(values, percentile):
+    """
+        @return: <float> the nearest-rank percentile of values
+    """
+    ordered = sorted(values)
+    index = int(round(percentile / 100.0 * len(ordered) + 0.5)) - 1
+    return ordered[max(0, min(len(ordered) - 1, index))]
+
+
+def get_maxrss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class Benchmarks(object):
+    """
+        Runs the scenarios against the mock services
+    """
+
+    def __init__(self, services, options):
+        self.services = services
+        self.options = options
+        self.uri = services.get_uri()
+        self.episode_counter = 0
+
+    def get_episode_id(self):
+        self.episode_counter += 1
+        return 'episode-%d' % self.episode_counter
+
+    def get_alert_settings(self, episode_id):
+        return {
+            'server_uri': self.uri,
+            # splunkd issues every alert action run its own session key
+            'session_key': '%s-%s' % (SESSION_KEY, episode_id),
+            'owner': 'admin',
+            'result': {
+                'event_id': episode_id,
+                'host': 'node-0.example.com',
+                'severity': '5',
+                'title': 'Episode %s' % episode_id,
+            },
+            'configuration': {
+                'endpoint_url': self.uri + '/orchestrator/v1/command/' + self.options.command,
+                'puppetdb_url': self.uri + '/pdb/query/v4',
+                'service_fact': 'itsi_services',
+                'inventory_facts': self.options.inventory_facts,
+                'scope_facts': self.options.scope_facts,
+                'task': 'package',
+                'plan': 'remediate',
+                'parameters': PARAMETERS,
+                'shard_size': str(self.options.shard_size),
+                'shard_by': self.options.shard_by,
+                'username': 'bench',
+                'recipients': 'ops;oncall',
+                'priority': 'medium',
+                'module': self.options.environment,
+                'batch_window': '0',
+                'max_event_sample': str(self.options.max_event_sample),
+                'use_spool': '1' if self.options.spool else '0',
+                'track_jobs': '0',
+                'suppression_ttl': str(self.options.suppression_ttl),
+            }
+        }
+
+    def run_execute(self, size):
+        """
+            One alert action invocation for an episode of size events
+            @return: <bool> True if execute completed without exiting
+        """
+        from itsi.event_management.sdk import custom_event_action_base
+        from puppetenterprise_itsi import puppetenterpriseITSI
+
+        episode_id = self.get_episode_id()
+        custom_event_action_base.EVENT_SOURCE = lambda: iter_events(episode_id, size)
+        try:
+            puppetenterpriseITSI(json.dumps(self.get_alert_settings(episode_id))).execute()
+        except SystemExit:
+            return False
+        return True
+
+    def settle_execute(self):
+        """
+            Runs the node indexer scripted input, so the next run resolves against a
+                fresh index the way it would on an instance
+        """
+        from puppetenterprise_node_indexer import refresh_node_index
+
+        refresh_node_index(self.uri, SESSION_KEY)
+
+    def get_handler_request(self, payload, **kwargs):
+        return json.dumps({
+            'method': 'POST',
+            'rest_path': '/puppetenterprise/itsi_response',
+            'query': kwargs.get('query', []),
+            'payload': json.dumps(payload),
+            'session': {'authtoken': SESSION_KEY},
+            'server': {'rest_uri': self.uri},
+        })
+
+    def run_comment(self, size):
+        """
+            One comment handler request for an episode of size events
+        """
+        from puppetenterprise_comment_handler import CommentHandler
+
+        episode_id = self.get_episode_id()
+        request = self.get_handler_request({
+            'event_id': episode_id,
+            'children': ['%s-%d' % (episode_id, index) for index in xrange(size)],
+            'message': 'Puppet run finished',
+        })
+        return CommentHandler(None, None).handle(request)['status'] == 200
+
+    def run_response(self, size):
+        """
+            One response handler request for an episode of size events
+        """
+        from puppetenterprise_response_handler import ResponseHandler
+
+        episode_id = self.get_episode_id()
+        request = self.get_handler_request({
+            'event_id': episode_id,
+            'children': ['%s-%d' % (episode_id, index) for index in xrange(size)],
+            'owner': 'bench',
+            'response': 'acknowledge',
+            'message': 'Puppet is handling this',
+        })
+        return ResponseHandler(None, None).handle(request)['status'] == 200
+
+    def run_response_async(self, size):
+        """
+            One response handler request with async=1, only the time until it is
+                accepted is measured
+        """
+        from puppetenterprise_response_handler import ResponseHandler
+
+        episode_id = self.get_episode_id()
+        request = self.get_handler_request({
+            'event_id': episode_id,
+            'children': ['%s-%d' % (episode_id, index) for index in xrange(size)],
+            'owner': 'bench',
+            'response': 'acknowledge',
+            'message': 'Puppet is handling this',
+        }, query=[['async', '1']])
+        return ResponseHandler(None, None).handle(request)['status'] == 202
+
+    def run_response_burst(self, size):
+        """
+            size single event response requests queued at once, measured until the
+                last one has been processed
+        """
+        from puppetenterprise_response_handler import ResponseHandler, WORK_QUEUE
+
+        accepted = True
+        for _ in xrange(size):
+            request = self.get_handler_request({
+                'event_id': self.get_episode_id(),
+                'children': [],
+                'owner': 'bench',
+                'response': 'acknowledge',
+                'message': 'Puppet is handling this',
+            }, query=[['async', '1']])
+            accepted = ResponseHandler(None, None).handle(request)['status'] == 202 and accepted
+        WORK_QUEUE.queue.join()
+        return accepted
+
+    def run_bulk(self, size):
+        """
+            The response_burst episodes acknowledged in one bulk handler request, which
+                sends one update per status and owner
+        """
+        from puppetenterprise_bulk_handler import BulkHandler
+
+        request = json.loads(self.get_handler_request({
+            'items': [{
+                'event_id': self.get_episode_id(),
+                'owner': 'bench',
+                'response': 'acknowledge',
+                'message': 'Puppet is handling this',
+            } for _ in xrange(size)]
+        }))
+        request['rest_path'] = '/puppetenterprise/itsi_bulk'
+        return BulkHandler(None, None).handle(json.dumps(request))['status'] == 200
+
+    def settle_response_async(self):
+        """
+            Waits, outside the measured time, for the queued request to be processed
+        """
+        from puppetenterprise_response_handler import WORK_QUEUE
+        WORK_QUEUE.queue.join()
+
+    def measure(self, scenario, size):
+        """
+            Runs a scenario for one episode size
+            @return: <dict> the results
+        """
+        run = getattr(self, 'run_%s' % scenario)
+        # waits for background work between runs, outside the measured time
+        settle = getattr(self, 'settle_%s' % scenario, lambda: None)
+        for _ in range(self.options.warmup):
+            run(size)
+            settle()
+
+        gc.collect()
+        objects_before = len(gc.get_objects())
+        maxrss_before = get_maxrss_kb()
+        self.services.reset()
+
+        durations = []
+        failed = 0
+        for _ in range(self.options.runs):
+            start = time.time()
+            if not run(size):
+                failed += 1
+            durations.append(time.time() - start)
+            settle()
+
+        counts = self.services.get_counts()
+        gc.collect()
+        total = sum(durations)
+        runs = len(durations)
+        return {
+            'scenario': scenario,
+            'events': size,
+            'runs': runs,
+            'failed': failed,
+            'p50_ms': get_percentile(durations, 50) * 1000,
+            'p99_ms': get_percentile(durations, 99) * 1000,
+            'events_per_s': size * runs / total if total else 0,
+            'runs_per_s': runs / total if total else 0,
+            'maxrss_kb': get_maxrss_kb() - maxrss_before,
+            'retained_objects': len(gc.get_objects()) - objects_before,
+            'requests_per_run': float(counts['total']) / runs,
+            'requests': counts,
+        }
+
+
+def format_result(result):
+    line = (
+        'scenario=%(scenario)s events=%(events)d runs=%(runs)d failed=%(failed)d '
+        'p50_ms=%(p50_ms).2f p99_ms=%(p99_ms).2f events_per_s=%(events_per_s).0f '
+        'runs_per_s=%(runs_per_s).2f maxrss_kb=%(maxrss_kb)d retained_objects=%(retained_objects)d '
+        'requests_per_run=%(requests_per_run).1f' % result
+    )
+    routes = ' '.join(
+        '%s=%s' % (route, count) for route, count in sorted(result['requests'].items())
+        if route != 'total'
+    )
+    return line + '\n    ' + routes
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help='comma separated scenarios from %s' % ','.join(SCENARIOS))
+    parser.add_argument('--sizes', default=DEFAULT_SIZES, help='comma separated episode sizes')
+    parser.add_argument('--runs', type=int, default=5, help='measured runs per size')
+    parser.add_argument('--warmup', type=int, default=1, help='unmeasured runs per size')
+    parser.add_argument('--latency-ms', type=float, default=0, help='mock response latency')
+    parser.add_argument('--jitter-ms', type=float, default=0, help='mock random extra latency')
+    parser.add_argument('--error-rate', type=float, default=0, help='fraction of mock 503 responses')
+    parser.add_argument('--error-routes', default=None,
+                        help='comma separated mock routes to inject errors into, defaults to all')
+    parser.add_argument('--error-status', type=int, default=503, help='status of injected errors')
+    parser.add_argument('--retry-after', type=int, default=None,
+                        help='Retry-After seconds sent with injected errors')
+    parser.add_argument('--max-event-sample', type=int, default=0, help='the max_event_sample param')
+    parser.add_argument('--suppression-ttl', type=int, default=0,
+                        help='the suppression_ttl param, 0 sends every repeated episode')
+    parser.add_argument('--inventory-facts', default='',
+                        help='the inventory_facts param, eg. os.family,role')
+    parser.add_argument('--scope-facts', default='', help='the scope_facts param, eg. role=role-0')
+    parser.add_argument('--shard-size', type=int, default=0, help='the shard_size param')
+    parser.add_argument('--shard-by', default='', help='the shard_by param, eg. environment or role')
+    parser.add_argument('--command', default='deploy', choices=['deploy', 'task', 'plan_run'],
+                        help='the Orchestrator command of the endpoint_url')
+    parser.add_argument('--environment', default='production',
+                        help='the module param, empty picks it from the inventory')
+    parser.add_argument('--spool', action='store_true', help='spool failed alert action requests')
+    parser.add_argument('--json', dest='json_path', default=None, help='also write the results here')
+    parser.add_argument('--keep-home', action='store_true', help='keep the temporary SPLUNK_HOME')
+    return parser.parse_args()
+
+
+def main():
+    options = parse_args()
+    splunk_home = create_splunk_home()
+    os.environ['SPLUNK_HOME'] = splunk_home
+    # the mock services use a self-signed certificate
+    ssl._create_default_https_context = ssl._create_unverified_context
+
+    services = MockServices(
+        latency_ms=options.latency_ms,
+        jitter_ms=options.jitter_ms,
+        error_rate=options.error_rate,
+        error_routes=options.error_routes.split(',') if options.error_routes else None,
+        error_status=options.error_status,
+        retry_after=options.retry_after
+    )
+    os.environ['BENCH_SPLUNKD_URI'] = services.start()
+    print 'mock_services=%s splunk_home=%s' % (services.get_uri(), splunk_home)
+
+    results = []
+    try:
+        benchmarks = Benchmarks(services, options)
+        for scenario in options.scenarios.split(','):
+            for size in [int(size) for size in options.sizes.split(',')]:
+                result = benchmarks.measure(scenario, size)
+                results.append(result)
+                print format_result(result)
+                sys.stdout.flush()
+    finally:
+        # close the pooled client connections so the server threads finish
+        from common_utils.rest import CONNECTION_POOL
+        CONNECTION_POOL.clear()
+        services.stop()
+        if not options.keep_home:
+            shutil.rmtree(splunk_home, ignore_errors=True)
+
+    if options.json_path:
+        with open(options.json_path, 'w') as json_file:
+            json.dump(results, json_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
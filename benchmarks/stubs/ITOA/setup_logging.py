@@ -0,0 +1,30 @@
+"""
+    Offline stand-in for ITOA.setup_logging, writes to $SPLUNK_HOME/var/log/splunk
+    like the real one so logging cost is part of the measurements
+"""
+import logging
+import os
+
+LOGGERS = {}
+
+
+def setup_logging(log_name, logger_name, **kwargs):
+    """
+        @param log_name: <str> the log file name
+        @param logger_name: <str> the logger name
+        @return: <Logger>
+    """
+    key = (log_name, logger_name)
+    if key in LOGGERS:
+        return LOGGERS[key]
+    log_dir = os.path.join(os.environ['SPLUNK_HOME'], 'var', 'log', 'splunk')
+    if not os.path.isdir(log_dir):
+        os.makedirs(log_dir)
+    logger = logging.getLogger('%s.%s' % (log_name, logger_name))
+    logger.propagate = False
+    logger.setLevel(kwargs.get('level', logging.INFO))
+    handler = logging.FileHandler(os.path.join(log_dir, log_name))
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(name)s] %(message)s'))
+    logger.addHandler(handler)
+    LOGGERS[key] = logger
+    return logger
@@ -0,0 +1,30 @@
+"""
+    Offline stand-in for the ITSI CustomEventActionBase. The runner sets
+    EVENT_SOURCE to a callable returning the synthetic events of an episode
+"""
+import json
+
+EVENT_SOURCE = None
+
+
+class CustomEventActionBase(object):
+    """
+        Implements the subset of the SDK used by the alert action
+    """
+
+    def __init__(self, settings, logger):
+        if isinstance(settings, basestring):
+            settings = json.loads(settings)
+        self.settings = settings
+        self.logger = logger
+
+    def get_config(self):
+        return self.settings.get('configuration', {})
+
+    def get_session_key(self):
+        return self.settings.get('session_key')
+
+    def get_event(self):
+        if EVENT_SOURCE is None:
+            return iter([])
+        return EVENT_SOURCE()
@@ -0,0 +1,39 @@
+"""
+    Offline stand-in for the ITSI Notable Events SDK Event class. Comments and
+    updates are posted to the mock splunkd so they show up in request counts
+"""
+import json
+import os
+
+from common_utils.rest import RESTClient
+
+COMMENT_PATH = '/servicesNS/nobody/SA-ITOA/event_management_interface/notable_event_comment'
+UPDATE_PATH = '/servicesNS/nobody/SA-ITOA/event_management_interface/notable_event'
+
+
+class Event(object):
+    """
+        Implements the subset of the SDK used by the app
+    """
+
+    def __init__(self, session_key, logger=None, **kwargs):
+        self.session_key = session_key
+        self.logger = logger
+        self.server_uri = os.environ.get('BENCH_SPLUNKD_URI')
+        self.rest = RESTClient(logger=logger) if logger is not None else RESTClient()
+
+    def post(self, path, payload):
+        headers = {
+            'Authorization': 'Splunk %s' % self.session_key,
+            'Content-Type': 'application/json'
+        }
+        response = self.rest.post(self.server_uri + path, headers=headers, body=json.dumps(payload))
+        if response is False:
+            raise Exception('Notable event request failed: %s' % path)
+        return response
+
+    def create_comment(self, event_id, comment, **kwargs):
+        return self.post(COMMENT_PATH, {'event_id': event_id, 'comment': comment})
+
+    def update(self, update_blob, **kwargs):
+        return self.post(UPDATE_PATH, update_blob)
@@ -0,0 +1,11 @@
+"""
+    Offline stand-in for the splunk python package, used by the benchmarks only
+"""
+import os
+
+
+def getLocalServerInfo():
+    """
+        @return: <str> the mock splunkd uri started by the benchmark runner
+    """
+    return os.environ.get('BENCH_SPLUNKD_URI', 'https://127.0.0.1:8089')
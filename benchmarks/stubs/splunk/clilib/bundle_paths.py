@@ -0,0 +1,13 @@
+"""
+    Offline stand-in for splunk.clilib.bundle_paths, paths resolve under the
+    temporary SPLUNK_HOME created by the benchmark runner
+"""
+import os
+
+
+def make_splunkhome_path(parts):
+    """
+        @param parts: <list[str]> path segments below SPLUNK_HOME
+        @return: <str> the absolute path
+    """
+    return os.path.join(os.environ['SPLUNK_HOME'], *parts)
@@ -0,0 +1,12 @@
+"""
+    Offline stand-in for splunk.persistconn.application
+"""
+
+
+class PersistentServerConnectionApplication(object):
+    """
+        The persistent handlers only call the constructor
+    """
+
+    def __init__(self):
+        pass
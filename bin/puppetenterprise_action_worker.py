@@ -0,0 +1,35 @@
+"""
+    Scripted input that keeps a warm worker running alert actions handed over by
+    the puppetenterprise_itsi.py --execute stub, see puppetenterprise_sdk.action_worker
+"""
+import sys
+
+from splunk.clilib.bundle_paths import make_splunkhome_path
+
+sys.path.append(make_splunkhome_path(['etc', 'apps', 'puppetenterprise_itsi', 'lib']))
+sys.path.append(make_splunkhome_path(['etc', 'apps', 'SA-ITOA', 'lib']))
+
+from puppetenterprise_sdk.action_worker import ActionWorker
+from puppetenterprise_itsi import run_action, PE_ITSI_LOG
+
+from common_utils.lazy import LazyLogger
+
+DEFAULT_LOGGER = LazyLogger(PE_ITSI_LOG, 'puppetenterprise.itsi.action.worker')
+
+# The worker exits after this many seconds so splunkd restarts it with fresh code and
+# memory, the input interval brings it back
+WORKER_MAX_RUNTIME = 3600
+
+
+if __name__ == '__main__':
+    try:
+        ActionWorker(
+            lambda payload: run_action(payload, DEFAULT_LOGGER),
+            DEFAULT_LOGGER
+        ).run(WORKER_MAX_RUNTIME)
+# pylint: disable = broad-except
+    except Exception, exception:
+        DEFAULT_LOGGER.error('The action worker failed.')
+        DEFAULT_LOGGER.exception(exception)
+        sys.exit(1)
+# pylint: enable = broad-except
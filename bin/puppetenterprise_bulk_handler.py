@@ -0,0 +1,168 @@
+import sys
+
+from splunk.clilib.bundle_paths import make_splunkhome_path
+from splunk.persistconn.application import PersistentServerConnectionApplication
+sys.path.append(make_splunkhome_path(['etc', 'apps', 'puppetenterprise_itsi', 'lib']))
+sys.path.append(make_splunkhome_path(['etc', 'apps', 'SA-ITOA', 'lib']))
+from handler_utils.puppetenterprise_handler import PuppetEnterpriseHandler
+from itsi_utils.roles import is_itsi_user
+from itsi_utils.app import get_itsi_version
+from itsi_utils.responses import get_status, update_event, UPDATE_UNSUPPORTED_VERSIONS
+from itsi_utils.comments import add_comments
+from common_utils.lazy import LazyLogger, LazyImport
+
+# The name of the log file to write to
+REST_HANDLER_LOG = 'puppetenterprise_itsi_rest.log'
+# import ITSI libraries on first use
+Event = LazyImport('itsi.event_management.sdk.eventing', 'Event')
+
+DEFAULT_LOGGER = LazyLogger(REST_HANDLER_LOG, 'puppetenterprise.handlers.bulk')
+
+REQUIRED_FIELDS = [
+    'items',
+]
+
+REQUIRED_ITEM_FIELDS = [
+    'event_id',
+    'message',
+]
+
+class BulkHandler(PuppetEnterpriseHandler, PersistentServerConnectionApplication):
+    """
+        This class extends the PersistentServerConnectionApplication and is used to
+        comment on many notable events, and update their Status/Owner, in one request
+    """
+    def __init__(self, command_line, command_arg):
+        """
+            initialize the object. parameters are unused
+        """
+        super(BulkHandler, self).__init__(command_line, command_arg, logger=DEFAULT_LOGGER)
+        PersistentServerConnectionApplication.__init__(self)
+        self.required_fields = REQUIRED_FIELDS
+
+    def validate_request(self, input_payload, **kwargs):
+        """
+            Overrides PuppetEnterpriseHandler, every item needs an event_id and a message
+            @param input_payload: <object> The request payload in object form
+
+            @returns: <object|None> If a validation error exists, return an
+                error object, otherwise return a Falsey value
+        """
+        items = input_payload.get('items')
+        if not isinstance(items, list) or not items:
+            return {
+                'error_code': 'INVALID_REQUEST',
+                'error_message': 'items must be a non empty list'
+            }
+        invalid_items = []
+        for index, item in enumerate(items):
+            if not isinstance(item, dict):
+                invalid_items.append({'index': index, 'missing_fields': REQUIRED_ITEM_FIELDS})
+                continue
+            missing_fields = self.check_required_fields(item, required_fields=REQUIRED_ITEM_FIELDS)
+            if missing_fields:
+                invalid_items.append({'index': index, 'missing_fields': missing_fields})
+        if invalid_items:
+            return {
+                'error_code': 'INVALID_REQUEST',
+                'error_message': 'Missing Required Fields',
+                'invalid_items': invalid_items
+            }
+        return None
+
+    def group_updates(self, items, server_rest_uri, session_key):
+        """
+            Resolves each item's status and owner and groups the event ids by them
+            @param items: <list[object]> the validated request items
+            @param server_rest_uri: <str> The Splunk Server base url
+            @param session_key: <str> The Splunk session key
+
+            @returns: <tuple(list, dict)> the per item results, and a map of
+                (status, owner) to the indexes of the items to update with them
+        """
+        results = []
+        groups = {}
+        for index, item in enumerate(items):
+            response = item.get('response')
+            owner = item.get('owner')
+            status = get_status(response, logger=self.logger) if response else None
+            if owner is not None:
+                if is_itsi_user(server_rest_uri, session_key, owner, logger=self.logger) is False:
+                    owner = None
+            results.append({
+                'event_id': item.get('event_id'),
+                'owner': owner,
+                'status': status,
+                'is_comment_successful': True,
+                'is_update_successful': False
+            })
+            groups.setdefault((status, owner), []).append(index)
+        return results, groups
+
+    def process_request(self, input_payload, **kwargs):
+        """
+            Overrides PuppetEnterpriseHandler
+            @param input_payload: <object> The request payload in object form
+            @param method: <str> The HTTP Method (should be all caps) <kwargs>
+            @param session_key: <str> The Splunk session key <kwargs>
+            @param server_rest_uri: <str> The Splunk Server base url <kwargs>
+
+            @returns: <object> A response object, likely made by self.build_response
+        """
+        items = input_payload.get('items')
+        session_key = kwargs.get('session_key')
+        server_rest_uri = kwargs.get('server_rest_uri')
+
+        self.logger.info('action=PROCESS_BULK item_count=%d', len(items))
+
+        event = Event(session_key, logger=self.logger)
+        results, groups = self.group_updates(items, server_rest_uri, session_key)
+
+        # items with the same message are commented on together, a failed comment
+        # is recorded against its item rather than failing the request
+        comments = {}
+        for index, item in enumerate(items):
+            comments.setdefault(item.get('message'), []).append(index)
+        for message, indexes in comments.items():
+            event_ids = [items[index].get('event_id') for index in indexes]
+            failed_ids = set(add_comments(event, event_ids, message, logger=self.logger))
+            for index in indexes:
+                if items[index].get('event_id') in failed_ids:
+                    results[index]['is_comment_successful'] = False
+
+        itsi_version = get_itsi_version(server_rest_uri, session_key, logger=self.logger)
+        if itsi_version in UPDATE_UNSUPPORTED_VERSIONS:
+            self.logger.warn(
+                'warning=%s message="%s" version=%s',
+                'LIMITED_FUNCTIONALITY',
+                'unable to update owner and status due to version',
+                itsi_version
+            )
+            for result in results:
+                result['is_update_successful'] = True
+        else:
+            for (status, owner), indexes in groups.items():
+                event_ids = [items[index].get('event_id') for index in indexes]
+                is_update_successful = update_event(event, event_ids, status, owner, logger=self.logger)
+                self.logger.info(
+                    'action=BULK_UPDATE status=%s owner=%s event_count=%d is_update_successful=%s',
+                    status,
+                    owner,
+                    len(event_ids),
+                    is_update_successful
+                )
+                for index in indexes:
+                    results[index]['is_update_successful'] = is_update_successful
+
+        failed_count = len([
+            result for result in results
+            if not (result['is_comment_successful'] and result['is_update_successful'])
+        ])
+        return self.build_response(
+            200,  # HTTP status code
+            {    # Payload of the request.
+                'message': 'Handled %d event responses, %d failed' % (len(results), failed_count),
+                'is_update_successful': failed_count == 0,
+                'results': results
+            }
+        )
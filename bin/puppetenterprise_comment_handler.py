@@ -3,12 +3,18 @@ from splunk.clilib.bundle_paths import make_splunkhome_path
 from splunk.persistconn.application import PersistentServerConnectionApplication
 sys.path.append(make_splunkhome_path(['etc', 'apps', 'puppetenterprise_itsi', 'lib']))
 sys.path.append(make_splunkhome_path(['etc', 'apps', 'SA-ITOA', 'lib']))
-from handler_utils.pe_handler import PuppetEnterpriseHandler
-from ITOA.setup_logging import setup_logging
-from itsi.event_management.sdk.eventing import Event
+from handler_utils.puppetenterprise_handler import PuppetEnterpriseHandler
+from handler_utils.work_queue import WorkQueue
+from common_utils.lazy import LazyLogger, LazyImport
 
 REST_HANDLER_LOG = 'puppetenterprise_itsi_rest.log'
-DEFAULT_LOGGER = setup_logging(REST_HANDLER_LOG, 'puppetenterprise.handlers.comment')
+# import ITSI libraries on first use
+Event = LazyImport('itsi.event_management.sdk.eventing', 'Event')
+
+DEFAULT_LOGGER = LazyLogger(REST_HANDLER_LOG, 'puppetenterprise.handlers.comment')
+
+# Processes async requests, it lives as long as the persistent handler process
+WORK_QUEUE = WorkQueue(name='comment_handler', logger=DEFAULT_LOGGER)
 
 REQUIRED_FIELDS = [
     'event_id',
@@ -21,7 +27,12 @@ class CommentHandler(PuppetEnterpriseHandler, PersistentServerConnectionApplicat
         """
             initialize the object. parameters are unused
         """
-        super(CommentHandler, self).__init__(command_line, command_arg, logger=DEFAULT_LOGGER)
+        super(CommentHandler, self).__init__(
+            command_line,
+            command_arg,
+            logger=DEFAULT_LOGGER,
+            work_queue=WORK_QUEUE
+        )
         PersistentServerConnectionApplication.__init__(self)
         self.required_fields = REQUIRED_FIELDS
 
@@ -1,19 +1,61 @@
+import json
 import sys
+import time
 
 from splunk.clilib.bundle_paths import make_splunkhome_path
 
 sys.path.append(make_splunkhome_path(['etc', 'apps', 'puppetenterprise_itsi', 'lib']))
 sys.path.append(make_splunkhome_path(['etc', 'apps', 'SA-ITOA', 'lib']))
 
-from common_utils.password import get_password
-from puppetenterprise_sdk.pe_event import puppetenterpriseEvent
-from puppetenterprise_sdk.pe_client import puppetenterpriseClient
+if __name__ == '__main__' and len(sys.argv) > 1 and sys.argv[1] == '--execute':
+    # hand the action to the warm worker, when it is running, before the imports below
+    from puppetenterprise_sdk.action_worker import forward_action
+    INPUT_PARAMS = sys.stdin.read()
+    WORKER_EXIT_CODE = forward_action(INPUT_PARAMS)
+    if WORKER_EXIT_CODE is not None:
+        sys.exit(WORKER_EXIT_CODE)
+
+from common_utils.password import get_password, invalidate_password
+from common_utils.local_state import is_locking_supported
+from common_utils.fanout import DEFAULT_CONCURRENCY, run_concurrently
+from common_utils.lazy import LazyLogger, LazyImport
+from common_utils.metrics import Timer, set_sample_rate
+from itsi_utils.comments import add_comments
+from puppetenterprise_sdk.aggregation import EpisodeAggregator
+from puppetenterprise_sdk.batch import EpisodeBatcher, group_by_environment, BATCH_FAILED, BATCH_QUEUED, BATCH_SENT
+from puppetenterprise_sdk.job_tracker import JobTracker, get_orchestrator_url, is_trackable_command
+from puppetenterprise_sdk.node_resolver import (
+    NodeResolver,
+    get_service_ids,
+    parse_fact_filters,
+    parse_fact_names,
+    DEFAULT_REFRESH_INTERVAL
+)
+from puppetenterprise_sdk.puppetdb import get_puppetdb_url
+from puppetenterprise_sdk.projection import get_projector, parse_keys
+from puppetenterprise_sdk.suppression import SuppressionWindow, get_target_key, DEFAULT_SUPPRESSION_TTL
+from puppetenterprise_sdk.spool import OutboundSpool, REQUEST_QUEUED
+from puppetenterprise_sdk.puppetenterprise_event import PuppetEnterpriseEvent, DEPLOY, PLAN_RUN
+from puppetenterprise_sdk.templates import get_template, TemplateException
+from puppetenterprise_sdk.sharding import (
+    split_scope,
+    format_summary,
+    DEFAULT_SHARD_CONCURRENCY,
+    SHARD_BY_ENVIRONMENT
+)
+from puppetenterprise_sdk.puppetenterprise_client import (
+    PuppetEnterpriseClient,
+    get_deploy_payload,
+    new_idempotency_key
+)
 
 # import ITSI libraries
 from ITOA.setup_logging import setup_logging
-from itsi.event_management.sdk.eventing import Event
 from itsi.event_management.sdk.custom_event_action_base import CustomEventActionBase
 
+# The Notable Events SDK is only imported once a comment is made
+Event = LazyImport('itsi.event_management.sdk.eventing', 'Event')
+
 # The name of the log file to write to
 PE_ITSI_LOG = 'puppetenterprise_itsi.log'
 
@@ -94,28 +136,90 @@ SEVERITY_TO_LABEL = {
     '6': 'critical'
 }
 
+# Config values that turn an optional feature off
+DISABLED_VALUES = ['0', 'false', 'no', 'off']
+
+# The RequestGovernor settings and the alert action parameters that set them
+GOVERNOR_PARAMS = [
+    ('rate', 'rate_limit'),
+    ('burst', 'rate_burst'),
+    ('max_in_flight', 'max_in_flight'),
+    ('max_wait', 'max_queue_wait'),
+]
+
+# The CircuitBreaker settings and the alert action parameters that set them
+CIRCUIT_PARAMS = [
+    ('failure_rate', 'circuit_failure_rate'),
+    ('min_requests', 'circuit_min_requests'),
+    ('open_seconds', 'circuit_open_seconds'),
+]
+
+# The RESTClient settings and the alert action parameters that set them
+REQUEST_PARAMS = [
+    ('connect_timeout', 'connect_timeout'),
+    ('read_timeout', 'read_timeout'),
+    ('max_retries', 'max_retries'),
+    ('deadline', 'request_deadline'),
+]
+
 # Defines which events to update
 SHOULD_UPDATE_CORRELATION = True
 SHOULD_UPDATE_CHILDREN = False
 
-def build_pe_client(username, server_uri, session_key, logger):
+def is_enabled(value):
+    """
+        Reads a boolean alert action parameter
+        @param value: <str|None> the parameter value
+        @return: <bool> False if the value is one of DISABLED_VALUES, True otherwise
+    """
+    return str(value).strip().lower() not in DISABLED_VALUES
+
+def get_client_settings(config, params):
+    """
+        Reads numeric alert action parameters into client settings
+        @param config: <dict> the alert action configuration
+        @param params: <list[tuple(str, str)]> pairs of setting and parameter names
+        @return: <dict> the settings whose parameters are set
+    """
+    settings = {}
+    for key, param in params:
+        if config.get(param) not in (None, ''):
+            settings[key] = float(config.get(param))
+    return settings
+
+def build_pe_client(username, server_uri, session_key, logger, **kwargs):
     """
-        Builds a new puppetenterpriseclient object
+        Builds a new PuppetEnterpriseClient object
         @param username: <str> an optional puppetenterprise Username
         @param server_uri: <str> the domain of the splunk server
         @param session_key: <str> a valid session key for the splunk server
-        @return: <puppetenterpriseClient> an puppetenterprise Client that can be used to make requests to pe API
+        @param governor_settings: <dict> optional RequestGovernor settings
+        @param request_settings: <dict> optional RESTClient timeout and retry settings
+        @param circuit_settings: <dict> optional CircuitBreaker settings
+        @param owner: <str> optional Splunk user of the session key, passwords are
+            cached for the user rather than the session key when it is given
+        @return: <PuppetEnterpriseClient> an puppetenterprise Client that can be used to make requests to pe API
     """
-    pe_client = puppetenterpriseclient(logger=logger)
+    pe_client = PuppetEnterpriseClient(
+        logger=logger,
+        governor_settings=kwargs.get('governor_settings', {}),
+        request_settings=kwargs.get('request_settings', {}),
+        circuit_settings=kwargs.get('circuit_settings', {})
+    )
     if username:
         password = get_password(
             server_uri,
             session_key,
-            puppetenterprise_PASSWORD_NAME
+            puppetenterprise_PASSWORD_NAME,
+            owner=kwargs.get('owner')
         )
         if password is False:
             raise Exception('Error getting password: %s', puppetenterprise_PASSWORD_NAME)
-        pe_client.add_credentials(username, password)
+        pe_client.add_credentials(
+            username,
+            password,
+            on_rejected=lambda: invalidate_password(server_uri, puppetenterprise_PASSWORD_NAME, logger=logger)
+        )
     return pe_client
 
 class puppetenterpriseITSI(CustomEventActionBase):
@@ -133,57 +237,92 @@ class puppetenterpriseITSI(CustomEventActionBase):
 
         @returns Nothing
         """
-        self.logger = setup_logging(pe_ITSI_LOG, 'puppetenterprise.itsi.event.action')
+        self.logger = setup_logging(PE_ITSI_LOG, 'puppetenterprise.itsi.event.action')
 
         super(puppetenterpriseITSI, self).__init__(settings, self.logger)
 
         config = self.get_config()
+        if config.get('metrics_sample_rate') not in (None, ''):
+            set_sample_rate(config.get('metrics_sample_rate'))
         username = config['username']
-        token = config['token']
 
         self.pe_client = build_pe_client(
             username,
             self.settings.get('server_uri'),
             self.get_session_key(),
-            self.logger
+            self.logger,
+            governor_settings=get_client_settings(config, GOVERNOR_PARAMS),
+            request_settings=get_client_settings(config, REQUEST_PARAMS),
+            circuit_settings=get_client_settings(config, CIRCUIT_PARAMS),
+            # splunkd names the user the alert ran as along with its session key
+            owner=self.settings.get('owner')
         )
 
+        self.username = username
         self.result = self.settings.get('result')
         self.endpoint_url = config['endpoint_url']
         self.recipients = config['recipients']
         self.priority = config['priority']
+        self.environment = config.get('module')
+        self.batch_window = float(config.get('batch_window') or 0)
+        # 0 keeps every event, anything else caps the number of events sent in detail
+        self.max_event_sample = int(config.get('max_event_sample') or 0)
+        self.use_spool = is_enabled(config.get('use_spool', '1')) and is_locking_supported()
+        self.comment_concurrency = int(config.get('comment_concurrency') or DEFAULT_CONCURRENCY)
+        self.track_jobs = is_enabled(config.get('track_jobs', '1')) and is_locking_supported()
+        self.event_client = None
+        # hosts and services are resolved to certnames through the PuppetDB node index
+        self.resolve_nodes = is_enabled(config.get('resolve_nodes', '1')) and is_locking_supported()
+        # hosts that don't resolve are sent as they are, unless strict_nodes is set
+        self.strict_nodes = is_enabled(config.get('strict_nodes') or '0')
+        self.puppetdb_url = config.get('puppetdb_url') or get_puppetdb_url(self.endpoint_url)
+        self.service_fact = config.get('service_fact') or None
+        self.node_refresh_interval = float(config.get('node_refresh_interval') or DEFAULT_REFRESH_INTERVAL)
+        # only nodes with these fact values are deployed to, the facts are kept in the
+        # inventory along with inventory_facts
+        self.scope_facts = parse_fact_filters(config.get('scope_facts'))
+        # large scopes are split into jobs of at most shard_size nodes, and into a job
+        # per environment or per value of an inventory fact when shard_by is set
+        self.shard_size = int(config.get('shard_size') or 0)
+        self.shard_by = (config.get('shard_by') or '').strip() or None
+        self.shard_concurrency = int(config.get('shard_concurrency') or DEFAULT_SHARD_CONCURRENCY)
+        self.inventory_facts = parse_fact_names(
+            parse_fact_names(config.get('inventory_facts')) +
+            [name for name, _ in self.scope_facts] +
+            ([self.shard_by] if self.shard_by not in (None, SHARD_BY_ENVIRONMENT) else [])
+        )
+        self.node_resolver = None
+        # repeated deploys of the same nodes are skipped for suppression_ttl seconds
+        self.suppression_ttl = float(config.get('suppression_ttl') or DEFAULT_SUPPRESSION_TTL)
+        self.command = self.endpoint_url.rstrip('/').rsplit('/', 1)[-1]
+        # task and plan_run commands take parameters rendered from the episode's fields
+        self.command_name = config.get('plan' if self.command == PLAN_RUN else 'task') or None
+        self.parameters = config.get('parameters') or None
+        self.template_version = config.get('template_version') or None
+        # the key lists can be overridden with comma separated alert action parameters
+        self.event_projector = get_projector(
+            parse_keys(config.get('event_keys'), EVENT_KEYS),
+            logger=self.logger
+        )
+        self.correlation_projector = get_projector(
+            parse_keys(config.get('correlation_keys'), CORRELATION_KEYS),
+            logger=self.logger
+        )
 
         self.logger.info(
-            'action=%s token=%s endpoint_url=%s recipients=%s priority=%s',
+            'action=%s token=%s endpoint_url=%s recipients=%s priority=%s batch_window=%s '
+            'max_event_sample=%s',
             'PE_ITSI_INIT',
             username,
             self.endpoint_url,
             self.recipients,
-            self.priority
+            self.priority,
+            self.batch_window,
+            self.max_event_sample
         )
 
 
 
-    def get_prop_value(self, key, value):
-        """
-            Safely gets the value of a property for use in an Puppet Enterprise Event.
-            Currently supports list, str, unicode, None types
-
-            @param key: <str> the name of the property
-            @param value: <any> the value of the property
-            @return: string
-        """
-        value_type = type(value)
-        if value_type is list:
-            return ','.join(value)
-        elif value_type is str or value_type is unicode:
-            return value
-        elif value is None:
-            return ''
-        self.logger.warn('warning=INVALID_PROP_TYPE key=%s value_type=%s', key, value_type)
-        return False
-
-
     def get_key_values_from_object(self, keys, source_object):
         """
             Helper method for getting a list of values from an object
@@ -191,12 +330,7 @@ class puppetenterpriseITSI(CustomEventActionBase):
             @param source_object: <dict>, a standard python map object
             @return: <dict> with only the selected keys
         """
-        result = {}
-        for key in keys:
-            value = self.get_prop_value(key, source_object.get(key))
-            if value is not False:
-                result[key] = value
-        return result
+        return get_projector(keys, logger=self.logger).project(source_object)
 
 
     def get_notable_event_pe_properties(self):
@@ -204,7 +338,7 @@ class puppetenterpriseITSI(CustomEventActionBase):
             Helper method for getting the correlation event's properties
             @return: <dict> an object with only the keys we wish to send to puppetenterprise
         """
-        return self.get_key_values_from_object(CORRELATION_KEYS, self.result)
+        return self.correlation_projector.project(self.result)
 
 
     def get_event_details(self, event):
@@ -213,7 +347,7 @@ class puppetenterpriseITSI(CustomEventActionBase):
             @param event: <dict>, an event's details from the Notable Event SDK
             @return: <dict> an object with only the keys we wish to send to puppetenterprise for the event
         """
-        return self.get_key_values_from_object(EVENT_KEYS, event)
+        return self.event_projector.project(event)
 
 
     def get_severity_label(self, event_details):
@@ -230,6 +364,30 @@ class puppetenterpriseITSI(CustomEventActionBase):
         return event_severity
 
 
+    def get_event_client(self):
+        """
+            Gets the Notable Events SDK client, one is created per action and reused
+            @return: <Event>
+        """
+        if self.event_client is None:
+            self.event_client = Event(self.get_session_key(), logger=self.logger)
+        return self.event_client
+
+    def add_comment_to_events(self, event_ids, comment):
+        """
+            Adds a comment to every event, concurrently when there are several
+            @param event_ids: <list[str]> the event ids
+            @param comment: <str> the comment
+            @return: <list[str]> the ids of the events that could not be commented on
+        """
+        return add_comments(
+            self.get_event_client(),
+            event_ids,
+            comment,
+            concurrency=self.comment_concurrency,
+            logger=self.logger
+        )
+
     def add_success_comment_to_event(self, event_id, request_id):
         """
             Adds a success comment to an event
@@ -238,37 +396,488 @@ class puppetenterpriseITSI(CustomEventActionBase):
             @return: None
         """
         comment = 'Successfully sent request to Puppet Enterprise: [%s]' % (request_id)
-        event = Event(self.get_session_key(), self.logger)
-        event.create_comment(event_id, comment)
+        self.get_event_client().create_comment(event_id, comment)
 
-    def send_pe_event(self, events_by_id, event_ids_by_severity):
+    def add_success_comment_to_events(self, event_ids, request_id):
+        """
+            Adds a success comment to many events
+            @param event_ids: <list[str]> the event ids
+            @param request_id: <str> the request id received from puppetenterprise
+            @return: <list[str]> the ids of the events that could not be commented on
         """
-            Preps and sends an event to Puppet Enterprise
-            @param events_by_id: <dict> a dict of event ids to their event
-            @param event_ids_by_severity: <dit> a dict of severities to a
-                list of events with that severity
+        comment = 'Successfully sent request to Puppet Enterprise: [%s]' % (request_id)
+        return self.add_comment_to_events(event_ids, comment)
 
-            @returns: <str|bool> If the request was successful, it will return
-                the requestId from Puppet Enterprise. Otherwise, False.
+    def add_failure_comment_to_events(self, event_ids):
         """
-        pe_event = puppetenterpriseEvent()
-        properties = self.get_notable_event_pe_properties()
-        for key in properties:
-            pe_event.add_property(key, properties[key])
+            Adds a comment to events saying the request to puppetenterprise failed
+            @param event_ids: <list[str]> the event ids
+            @return: <list[str]> the ids of the events that could not be commented on
+        """
+        msg = 'An error occurred while sending request to puppetenterprise.'
+        msg += ' See %s for details.' % PE_ITSI_LOG
+        return self.add_comment_to_events(event_ids, msg)
 
-        pe_event.add_property('event_count', len(events_by_id))
-        pe_event.add_property('events_by_id', events_by_id)
-        pe_event.add_property('event_ids_by_severity', event_ids_by_severity)
-        pe_event.add_property('pe_should_update_correlation', SHOULD_UPDATE_CORRELATION)
-        pe_event.add_property('pe_should_update_children', SHOULD_UPDATE_CHILDREN)
+    def add_queued_comment_to_events(self, event_ids):
+        """
+            Adds a comment to events saying the request will be retried
+            @param event_ids: <list[str]> the event ids
+            @return: <list[str]> the ids of the events that could not be commented on
+        """
+        msg = 'Puppet Enterprise is unavailable, the request has been queued for retry.'
+        msg += ' The job id will be added once it has been delivered.'
+        return self.add_comment_to_events(event_ids, msg)
 
-        for recipient in self.recipients.split(';'):
-            target_name = recipient.strip()
-            pe_event.add_recipient(target_name)
+    def track_job(self, job_id, url, event_ids):
+        """
+            Registers a job with the job poller so its outcome is commented on the
+                events once it finishes
+            @param job_id: <str> the Orchestrator job id
+            @param url: <str> the Orchestrator command url the job was started with
+            @param event_ids: <list[str]> the events to report the outcome to
+            @return: None
+        """
+        if not self.track_jobs or not is_trackable_command(url):
+            return
+        JobTracker(logger=self.logger).track(
+            job_id,
+            get_orchestrator_url(url),
+            self.username,
+            event_ids
+        )
 
-        pe_event.set_priority(self.priority)
+    def spool_request(self, url, body, event_ids, idempotency_key, **kwargs):
+        """
+            Writes a request that could not be delivered to the outbound spool, the
+                spool sender delivers it and comments on the events later
+            @param url: <str> the Orchestrator command url
+            @param body: <str> the json payload
+            @param event_ids: <list[str]> the events to comment on once delivered
+            @param idempotency_key: <str> the key the request was first sent with
+            @param is_commented: <bool> An optional value, False skips the queued comment
+            @return: None
+        """
+        spool = OutboundSpool(logger=self.logger)
+        spool.append({
+            'url': url,
+            'body': body,
+            'idempotency_key': idempotency_key,
+            'username': self.username,
+            'event_ids': event_ids,
+            'created': time.time()
+        })
+        spool.flush()
+        if kwargs.get('is_commented', True):
+            self.add_queued_comment_to_events(event_ids)
+
+    def get_hosts(self, source_object):
+        """
+            Gets the hosts of an event
+            @param source_object: <dict>, an event or the correlation event
+            @return: <list> the host names, empty if there are none
+        """
+        hosts = source_object.get('host')
+        if not hosts:
+            return []
+        if type(hosts) is list:
+            return hosts
+        return [hosts]
+
+    def get_certnames(self, nodes, service_ids):
+        """
+            Resolves the hosts and services gathered from the episode to certnames
+            @param nodes: <set> the hosts gathered from the episode
+            @param service_ids: <set> the services gathered from the episode
+            @return: <list[str]> the sorted certnames to deploy to
+        """
+        if not self.resolve_nodes:
+            return sorted(nodes)
+        with Timer('resolve_nodes', host_count=len(nodes), service_count=len(service_ids)) as timer:
+            certnames = self.get_node_resolver().resolve(nodes, service_ids)
+            timer.add(certname_count=len(certnames))
+        return certnames
 
-        return self.pe_client.send_event(self.endpoint_url, pe_event)
+    def get_node_resolver(self):
+        """
+            @return: <NodeResolver> the resolver for this action's PuppetDB
+        """
+        if self.node_resolver is None:
+            self.node_resolver = NodeResolver(
+                self.pe_client,
+                self.puppetdb_url,
+                logger=self.logger,
+                refresh_interval=self.node_refresh_interval,
+                service_fact=self.service_fact,
+                inventory_facts=self.inventory_facts,
+                strict=self.strict_nodes
+            )
+            # the node indexer scripted input refreshes the index from what is registered
+            self.node_resolver.register(self.username)
+        return self.node_resolver
+
+    def set_scope(self, certnames):
+        """
+            Picks the environment and the nodes to deploy from the inventory, when the
+                action has no environment the one most of the nodes are in is used,
+                unless the nodes are sharded by environment
+            @param certnames: <list[str]> the certnames resolved from the episode
+            @return: <list[str]> the sorted certnames to deploy to
+        """
+        if not self.resolve_nodes:
+            return certnames
+        with Timer('scope_nodes', certname_count=len(certnames)) as timer:
+            self.environment, certnames = self.get_node_resolver().get_scope(
+                certnames,
+                environment=self.environment,
+                fact_filters=self.scope_facts,
+                pick_environment=self.shard_by != SHARD_BY_ENVIRONMENT
+            )
+            timer.add(environment=self.environment, scope_count=len(certnames))
+        return certnames
+
+    def get_shards(self, certnames):
+        """
+            Splits the nodes by shard_by and shard_size
+            @param certnames: <list[str]> the certnames to deploy to
+            @return: <list[dict]> the shards, with the group value, the nodes and the
+                environment to deploy them with. A single shard when sharding is off
+        """
+        groups = {None: certnames}
+        if self.shard_by and self.resolve_nodes:
+            index = self.get_node_resolver().index
+            if self.shard_by == SHARD_BY_ENVIRONMENT:
+                groups = index.get_environments(certnames)
+                if not self.environment and None in groups:
+                    # hosts passed through unresolved have no environment to deploy with
+                    self.logger.warn('warning=NODES_WITHOUT_ENVIRONMENT count=%d nodes="%s"',
+                                     len(groups[None]), ','.join(groups[None][:20]))
+                    del groups[None]
+            else:
+                facts = index.get_facts(certnames)
+                groups = {}
+                for certname in certnames:
+                    groups.setdefault(facts.get(certname, {}).get(self.shard_by), []).append(certname)
+        shards = split_scope(groups, self.shard_size)
+        for shard in shards:
+            if self.shard_by == SHARD_BY_ENVIRONMENT and not self.environment:
+                shard['environment'] = shard['group']
+            else:
+                shard['environment'] = self.environment
+        return shards
+
+    def get_command_params(self, nodes, **kwargs):
+        """
+            Renders the parameters of a task or plan command from the correlation
+                event's fields, the certnames and the environment
+            @param nodes: <list[str]> the certnames to deploy to
+            @param environment: <str> An optional environment, defaults to the action's
+            @return: <dict|None> the parameters, None for a deploy
+            @raise: TemplateException, if the template is invalid or a field is missing
+        """
+        if self.command == DEPLOY:
+            return None
+        if not self.command_name:
+            raise Exception('The %s command needs a %s name.' % (
+                self.command,
+                'plan' if self.command == PLAN_RUN else 'task'
+            ))
+        if not self.parameters:
+            return {}
+        fields = dict(self.result)
+        fields['nodes'] = nodes
+        fields['environment'] = kwargs.get('environment', self.environment)
+        with Timer('render_params', command=self.command):
+            template = get_template(self.parameters, version=self.template_version)
+            return template.render(fields)
+
+    def get_command_key(self, params):
+        """
+            @param params: <dict|None> the rendered command parameters
+            @return: <str> what the command does, for the suppression target, eg.
+                deploy or task/package/{...}
+        """
+        if params is None:
+            return self.command
+        return '%s/%s/%s' % (self.command, self.command_name, json.dumps(params, sort_keys=True))
+
+    def get_suppression_window(self):
+        """
+            @return: <SuppressionWindow|None> the shared claims, None if suppression is off
+        """
+        if self.suppression_ttl <= 0 or not is_locking_supported():
+            return None
+        return SuppressionWindow(self.suppression_ttl, logger=self.logger)
+
+    def is_suppressed(self, window, target, correlation_event_id, nodes):
+        """
+            Claims the episode's target, or comments on the correlation event when a
+                deploy of the same nodes was already sent inside the suppression window
+            @param window: <SuppressionWindow> the shared claims
+            @param target: <str> the key of the episode's target
+            @param correlation_event_id: <str> the correlation event id
+            @param nodes: <list[str]> the certnames of the episode
+            @return: <bool> True if the send should be skipped
+        """
+        with Timer('suppression', node_count=len(nodes)) as timer:
+            claim = window.claim(
+                target,
+                environment=self.environment,
+                command=self.command,
+                node_count=len(nodes)
+            )
+            timer.add(suppressed=claim is not None)
+            if claim is None:
+                return False
+            timer.add(suppressed_count=claim['suppressed_count'])
+
+        self.logger.info(
+            'action=SUPPRESSED event_id=%s environment=%s command=%s node_count=%d job_id=%s '
+            'suppressed_count=%d expires=%d',
+            correlation_event_id,
+            self.environment,
+            self.command,
+            len(nodes),
+            claim['job_id'],
+            claim['suppressed_count'],
+            claim['expires']
+        )
+        msg = 'Puppet Enterprise request suppressed, the same nodes were sent a %s' % self.command
+        if claim['job_id']:
+            msg += ' in job [%s]' % claim['job_id']
+        msg += ' %d seconds ago.' % max(0, time.time() - claim['created'])
+        self.add_comment_to_events([correlation_event_id], msg)
+        return True
+
+    def send_batched_episode(self, correlation_event_id, nodes):
+        """
+            Adds this episode to the current batch. If this process leads the batch it
+                sends one deploy per environment for every episode in the batch, comments
+                the resulting job id on each contributing correlation event and reports
+                every episode's outcome. Otherwise it waits for the leader's outcome
+            @param correlation_event_id: <str> the correlation event id
+            @param nodes: <list[str]> the certnames of the episode
+            @return: <dict> the status and job_id of this episode
+            @raise: Exception, if this episode's deploy failed or its outcome never came
+        """
+        batcher = EpisodeBatcher(self.batch_window, logger=self.logger)
+        outcome = batcher.send({
+            'event_id': correlation_event_id,
+            'endpoint_url': self.endpoint_url,
+            'environment': self.environment,
+            'nodes': nodes
+        }, self.send_batches)
+        if outcome is None:
+            raise Exception('Timed out waiting for the batched deploy of the episode.')
+        if outcome['status'] == BATCH_FAILED:
+            raise Exception('Failed to execute one or more batched deploy actions.')
+        return outcome
+
+    def send_batches(self, episodes, outcomes):
+        """
+            Sends one deploy per environment for the episodes of a batch
+            @param episodes: <list[dict]> the episodes collected by the batch leader
+            @param outcomes: <dict> a map of each episode's event id to its status and
+                job_id, updated as each deploy is sent
+            @return: None
+        """
+        batches = group_by_environment(episodes)
+        for (endpoint_url, environment), batch in batches.items():
+            if not batch['nodes']:
+                self.logger.warning('action=BATCH_SKIPPED environment=%s episode_count=%d message="no nodes"',
+                                    environment, len(batch['event_ids']))
+                self.add_failure_comment_to_events(batch['event_ids'])
+                continue
+            idempotency_key = new_idempotency_key()
+            job_id = self.pe_client.deploy(
+                endpoint_url,
+                environment,
+                batch['nodes'],
+                idempotency_key=idempotency_key
+            )
+            self.logger.info(
+                'action=BATCH_DEPLOY environment=%s node_count=%d episode_count=%d job_id=%s',
+                environment,
+                len(batch['nodes']),
+                len(batch['event_ids']),
+                job_id
+            )
+            if job_id is False and self.use_spool and self.pe_client.is_last_failure_retryable():
+                self.spool_request(
+                    endpoint_url,
+                    get_deploy_payload(environment, batch['nodes']),
+                    batch['event_ids'],
+                    idempotency_key
+                )
+                status = BATCH_QUEUED
+            elif job_id is False:
+                self.add_failure_comment_to_events(batch['event_ids'])
+                status = BATCH_FAILED
+            else:
+                self.add_success_comment_to_events(batch['event_ids'], job_id)
+                self.track_job(job_id, endpoint_url, batch['event_ids'])
+                status = BATCH_SENT
+            for event_id in batch['event_ids']:
+                outcomes[event_id] = {'status': status, 'job_id': job_id or None}
+
+    def send_pe_event(self, aggregator, nodes, **kwargs):
+        """
+            Preps and sends an event to Puppet Enterprise as a deploy of the episode's
+                nodes, or as the task or plan_run command of the endpoint url
+            @param aggregator: <EpisodeAggregator> the aggregated events of the episode
+            @param nodes: <list[str]> the certnames to deploy to
+            @param params: <dict> An optional task or plan parameters, see get_command_params
+            @param environment: <str> An optional environment, defaults to the action's
+            @param shard: <tuple(int, int)> An optional shard number and shard count,
+                added to the event properties. Only the first shard carries the
+                events in detail, the others point at it
+            @param is_queued_commented: <bool> An optional value, False leaves the queued
+                comment of a spooled request out, defaults to True
+
+            @returns: <str|bool|REQUEST_QUEUED> If the request was successful, it will return
+                the requestId from Puppet Enterprise. REQUEST_QUEUED if it got no response,
+                a 5xx or a 429 and was spooled for retry. Otherwise, False.
+        """
+        with Timer(
+            'send_pe_event',
+            event_count=aggregator.event_count,
+            streamed=aggregator.is_bounded()
+        ) as timer:
+            pe_event = PuppetEnterpriseEvent()
+            pe_event.set_scope(kwargs.get('environment', self.environment), nodes)
+            params = kwargs.get('params')
+            if params is not None:
+                pe_event.set_command(self.command, self.command_name, params)
+            properties = self.get_notable_event_pe_properties()
+            for key in properties:
+                pe_event.add_property(key, properties[key])
+
+            shard = kwargs.get('shard')
+            pe_event.add_property('event_count', aggregator.event_count)
+            if shard and shard[0] > 1:
+                pe_event.add_property('events_shard_index', 1)
+            else:
+                pe_event.add_property('events_by_id', aggregator.get_events_by_id())
+            pe_event.add_property('event_ids_by_severity', aggregator.get_event_ids_by_severity())
+            if aggregator.is_bounded():
+                pe_event.add_property('event_counts_by_severity', aggregator.counts_by_severity)
+                pe_event.add_property('is_sampled', aggregator.is_sampled())
+            pe_event.add_property('pe_should_update_correlation', SHOULD_UPDATE_CORRELATION)
+            pe_event.add_property('pe_should_update_children', SHOULD_UPDATE_CHILDREN)
+            if shard:
+                pe_event.add_property('shard_index', shard[0])
+                pe_event.add_property('shard_count', shard[1])
+
+            for recipient in self.recipients.split(';'):
+                target_name = recipient.strip()
+                pe_event.add_recipient(target_name)
+
+            pe_event.set_priority(self.priority)
+
+            idempotency_key = new_idempotency_key()
+            request_id = self.pe_client.send_event(
+                self.endpoint_url,
+                pe_event,
+                stream=aggregator.is_bounded(),
+                idempotency_key=idempotency_key
+            )
+            timer.add(is_successful=request_id is not False)
+
+        if request_id is False and self.use_spool and self.pe_client.is_last_failure_retryable():
+            self.spool_request(
+                self.endpoint_url,
+                pe_event.get_json_payload(),
+                [self.get_correlation_event_id()],
+                idempotency_key,
+                is_commented=kwargs.get('is_queued_commented', True)
+            )
+            return REQUEST_QUEUED
+        return request_id
+
+    def send_sharded_episode(self, aggregator, shards, correlation_event_id, **kwargs):
+        """
+            Sends every shard as its own job, at most shard_concurrency at a time, then
+                comments a summary with the job of every shard on the correlation
+                event and tracks each job
+            @param aggregator: <EpisodeAggregator> the aggregated events of the episode
+            @param shards: <list[dict]> the shards from get_shards
+            @param correlation_event_id: <str> the correlation event id
+            @param params: <dict> An optional task or plan parameters, they are rendered
+                again for the nodes and environment of every shard
+            @param window: <SuppressionWindow> An optional suppression window
+            @param target: <str> The suppression target claimed for the episode
+            @return: <list[str]> the ids of the jobs started
+            @raise: Exception, if a shard could not be sent nor queued
+        """
+        params = kwargs.get('params')
+        window = kwargs.get('window')
+        target = kwargs.get('target')
+        node_count = sum(len(shard['nodes']) for shard in shards)
+
+        def send_shard(index):
+            shard = shards[index]
+            shard['job_id'] = None
+            shard['result'] = 'failed'
+            if not shard['environment']:
+                shard['result'] = 'not sent, the nodes have no environment'
+                return
+            shard_params = params
+            if params is not None:
+                shard_params = self.get_command_params(shard['nodes'], environment=shard['environment'])
+            request_id = self.send_pe_event(
+                aggregator,
+                shard['nodes'],
+                params=shard_params,
+                environment=shard['environment'],
+                shard=(index + 1, len(shards)),
+                is_queued_commented=False
+            )
+            if request_id is REQUEST_QUEUED:
+                shard['result'] = 'queued for retry'
+            elif request_id is not False:
+                shard['job_id'] = request_id
+                shard['result'] = 'job %s' % request_id
+
+        with Timer('send_shards', shard_count=len(shards), node_count=node_count) as timer:
+            failures = run_concurrently(
+                send_shard,
+                range(len(shards)),
+                concurrency=self.shard_concurrency
+            )
+            job_ids = [shard['job_id'] for shard in shards if shard['job_id']]
+            timer.add(job_count=len(job_ids))
+        for index, error in failures:
+            self.logger.error('error=SHARD_SEND_FAILED shard=%d message="%s"', index + 1, error)
+
+        queued_count = len([shard for shard in shards if shard['result'] == 'queued for retry'])
+        failed_count = len(shards) - len(job_ids) - queued_count
+        self.logger.info(
+            'action=SHARDED_SEND event_id=%s node_count=%d shard_count=%d job_count=%d '
+            'queued_count=%d failed_count=%d job_ids=%s',
+            correlation_event_id,
+            node_count,
+            len(shards),
+            len(job_ids),
+            queued_count,
+            failed_count,
+            ','.join(job_ids)
+        )
+        self.add_comment_to_events([correlation_event_id], format_summary(shards, node_count))
+
+        if window is not None:
+            if job_ids:
+                window.set_job_id(target, ','.join(job_ids))
+            elif not queued_count:
+                window.release(target)
+        for job_id in job_ids:
+            self.track_job(job_id, self.endpoint_url, [correlation_event_id])
+        if SHOULD_UPDATE_CHILDREN and job_ids:
+            child_event_ids = [
+                event_id for event_id in aggregator.get_event_ids() if event_id != correlation_event_id
+            ]
+            self.add_success_comment_to_events(child_event_ids, ','.join(job_ids))
+        if failed_count:
+            raise Exception('Failed to send %d of %d shards.' % (failed_count, len(shards)))
+        return job_ids
 
     def get_correlation_event_id(self):
         """
@@ -286,59 +895,105 @@ class puppetenterpriseITSI(CustomEventActionBase):
         if correlation_event_id is None:
             raise Exception('Missing correlation event_id')
 
-        event_count = 0
         try:
-            events_by_id = {}
-            event_ids_by_severity = {
-                'critical': [],
-                'high': [],
-                'medium': [],
-                'low': [],
-                'normal': [],
-                'info': [],
-                'other': []
-            }
-
-            for data in self.get_event():
-                if isinstance(data, Exception):
-                    # Generator can yield an Exception
-                    # We cannot print the call stack here reliably, because
-                    # of how this code handles it, we may have generated an exception elsewhere
-                    # Better to present this as an error
-                    self.logger.error(data)
-                    raise data
-
-                event_id = data.get('event_id')
-                if not event_id:
-                    self.logger.warning('Event does not have an `event_id`. No-op.')
-                    continue
-
-                event_details = self.get_event_details(data)
-                events_by_id[event_id] = event_details
-                event_count += 1
-
-                event_ids_by_severity.get(self.get_severity_label(event_details)).append(event_id)
-
-            request_id = self.send_pe_event(events_by_id, event_ids_by_severity)
-            if request_id is False:
-                event = Event(self.get_session_key(), logger=self.logger)
-                msg = 'An error occurred while sending request to puppetenterprise.'
-                msg += ' See %s for details.' % PE_ITSI_LOG
-                event.create_comment(
+            nodes = set(self.get_hosts(self.result))
+            service_ids = set(get_service_ids(self.result.get('service_ids')))
+            aggregator = EpisodeAggregator(
+                max_sample=self.max_event_sample or None,
+                keep_event_ids=SHOULD_UPDATE_CHILDREN
+            )
+
+            with Timer('event_iteration') as timer:
+                for data in self.get_event():
+                    if isinstance(data, Exception):
+                        # Generator can yield an Exception
+                        # We cannot print the call stack here reliably, because
+                        # of how this code handles it, we may have generated an exception elsewhere
+                        # Better to present this as an error
+                        self.logger.error(data)
+                        raise data
+
+                    event_id = data.get('event_id')
+                    if not event_id:
+                        self.logger.warning('Event does not have an `event_id`. No-op.')
+                        continue
+
+                    event_details = self.get_event_details(data)
+                    aggregator.add(event_id, event_details, self.get_severity_label(event_details))
+                    nodes.update(self.get_hosts(data))
+                    service_ids.update(get_service_ids(data.get('service_ids')))
+                timer.add(event_count=aggregator.event_count, node_count=len(nodes))
+
+            certnames = self.set_scope(self.get_certnames(nodes, service_ids))
+            if not certnames:
+                self.add_failure_comment_to_events([correlation_event_id])
+                raise Exception('No Puppet nodes found for the episode.')
+            shards = self.get_shards(certnames)
+            if len(shards) == 1 and not self.environment:
+                self.environment = shards[0]['environment']
+            if len(shards) == 1 and not self.environment:
+                self.add_failure_comment_to_events([correlation_event_id])
+                raise Exception('No Puppet environment found for the episode.')
+
+            window = self.get_suppression_window()
+            try:
+                params = self.get_command_params(certnames)
+            except TemplateException:
+                self.add_failure_comment_to_events([correlation_event_id])
+                raise
+            target = get_target_key(self.environment, certnames, self.get_command_key(params))
+            if window is not None and self.is_suppressed(window, target, correlation_event_id, certnames):
+                return
+
+            if len(shards) > 1:
+                self.send_sharded_episode(
+                    aggregator,
+                    shards,
                     correlation_event_id,
-                    msg
+                    params=params,
+                    window=window,
+                    target=target
                 )
+                return
+
+            # only deploys are batched, task and plan parameters are per episode
+            if self.batch_window > 0 and is_locking_supported() and self.command == DEPLOY:
+                try:
+                    outcome = self.send_batched_episode(correlation_event_id, certnames)
+                except Exception:
+                    if window is not None:
+                        window.release(target)
+                    raise
+                if window is not None and outcome['status'] == BATCH_SENT:
+                    window.set_job_id(target, outcome['job_id'])
+                return
+
+            try:
+                request_id = self.send_pe_event(aggregator, certnames, params=params)
+            except Exception:
+                if window is not None:
+                    window.release(target)
+                raise
+            if request_id is REQUEST_QUEUED:
+                return
+            if request_id is False:
+                if window is not None:
+                    window.release(target)
+                self.add_failure_comment_to_events([correlation_event_id])
                 raise Exception('Failed to execute one or more send event actions.')
+            if window is not None:
+                window.set_job_id(target, request_id)
 
             if SHOULD_UPDATE_CORRELATION:
                 self.add_success_comment_to_event(correlation_event_id, request_id)
+            self.track_job(request_id, self.endpoint_url, [correlation_event_id])
 
             if SHOULD_UPDATE_CHILDREN:
-                for event_data in events_by_id.values():
-                    event_id = event_data.get('event_id')
-                    is_correlation_event = event_id != correlation_event_id
-                    if is_correlation_event or self.should_update_correlation is not True:
-                        self.add_success_comment_to_event(event_id, request_id)
+                child_event_ids = [
+                    event_id for event_id in aggregator.get_event_ids()
+                    if event_id != correlation_event_id or SHOULD_UPDATE_CORRELATION is not True
+                ]
+                self.add_success_comment_to_events(child_event_ids, request_id)
 
         except ValueError:
             pass
@@ -348,10 +1003,29 @@ class puppetenterpriseITSI(CustomEventActionBase):
             sys.exit(1)
         return
 
+def run_action(payload, logger):
+    """
+        Runs one alert action the way an --execute process would
+        @param payload: <str> the payload splunkd passes on stdin
+        @param logger: <Logger> the logger object
+        @return: <int> the exit code of the action
+    """
+    try:
+        puppetenterpriseITSI(payload).execute()
+    except SystemExit, exit_error:
+        return exit_error.code or 0
+# pylint: disable = broad-except
+    except Exception, exception:
+        logger.error('Failed to execute PE.')
+        logger.exception(exception)
+        return 1
+# pylint: enable = broad-except
+    return 0
+
 if __name__ == '__main__':
-    LOGGER = setup_logging(pe_ITSI_LOG, 'puppetenterprise.itsi')
+    LOGGER = LazyLogger(PE_ITSI_LOG, 'puppetenterprise.itsi')
     if len(sys.argv) > 1 and sys.argv[1] == '--execute':
-        INPUT_PARAMS = sys.stdin.read()
+        LOGGER.info('action=RUN_IN_PROCESS message="the action worker is not running"')
         try:
             pe_ITSI = puppetenterpriseITSI(INPUT_PARAMS)
             pe_ITSI.execute()
@@ -0,0 +1,81 @@
+"""
+    Scripted input that polls the Orchestrator jobs started by the alert action and
+    comments their per-node outcomes on the Notable Events when they finish
+"""
+import sys
+
+from splunk.clilib.bundle_paths import make_splunkhome_path
+
+sys.path.append(make_splunkhome_path(['etc', 'apps', 'puppetenterprise_itsi', 'lib']))
+sys.path.append(make_splunkhome_path(['etc', 'apps', 'SA-ITOA', 'lib']))
+
+import splunk
+from itsi_utils.comments import add_comments
+from puppetenterprise_sdk.job_tracker import JobPoller
+from puppetenterprise_itsi import build_pe_client, PE_ITSI_LOG
+
+from common_utils.lazy import LazyLogger, LazyImport
+
+# import ITSI libraries on first use
+Event = LazyImport('itsi.event_management.sdk.eventing', 'Event')
+
+DEFAULT_LOGGER = LazyLogger(PE_ITSI_LOG, 'puppetenterprise.itsi.job.poller')
+
+# Stop before the next run of the scripted input is due
+MAX_RUNTIME = 55
+
+
+class JobOutcomeReporter(object):
+    """
+        Builds the clients the poller needs and posts job outcomes through the
+        Notable Events SDK
+    """
+
+    def __init__(self, server_uri, session_key, **kwargs):
+        """
+            @param server_uri: <str> the domain of the splunk server
+            @param session_key: <str> a valid session key for the splunk server
+            @param logger: <Logger> An optional logger object
+        """
+        self.logger = kwargs.get('logger', DEFAULT_LOGGER)
+        self.server_uri = server_uri
+        self.session_key = session_key
+        self.pe_clients = {}
+        self.event = Event(session_key, logger=self.logger)
+
+    def get_pe_client(self, username):
+        """
+            Gets a client for the username, building it once per run
+            @param username: <str> the puppetenterprise username the job was started with
+            @return: <PuppetEnterpriseClient>
+        """
+        if username not in self.pe_clients:
+            self.pe_clients[username] = build_pe_client(
+                username,
+                self.server_uri,
+                self.session_key,
+                self.logger
+            )
+        return self.pe_clients[username]
+
+    def report_outcome(self, event_ids, comment):
+        """
+            @param event_ids: <list[str]> the events the job was started for
+            @param comment: <str> the outcome of the job
+        """
+        add_comments(self.event, event_ids, comment, logger=self.logger)
+
+
+if __name__ == '__main__':
+    # passAuth in inputs.conf hands us a session key on stdin
+    SESSION_KEY = sys.stdin.readline().strip()
+    try:
+        REPORTER = JobOutcomeReporter(splunk.getLocalServerInfo(), SESSION_KEY)
+        POLLER = JobPoller(REPORTER.get_pe_client, REPORTER.report_outcome, logger=DEFAULT_LOGGER)
+        POLLER.run(MAX_RUNTIME)
+# pylint: disable = broad-except
+    except Exception, exception:
+        DEFAULT_LOGGER.error('Failed to poll Puppet Enterprise jobs.')
+        DEFAULT_LOGGER.exception(exception)
+        sys.exit(1)
+# pylint: enable = broad-except
@@ -0,0 +1,65 @@
+"""
+    Scripted input that refreshes the PuppetDB node index the alert action resolves
+    episodes against, so an alert never waits on PuppetDB
+"""
+import sys
+import time
+
+from splunk.clilib.bundle_paths import make_splunkhome_path
+
+sys.path.append(make_splunkhome_path(['etc', 'apps', 'puppetenterprise_itsi', 'lib']))
+sys.path.append(make_splunkhome_path(['etc', 'apps', 'SA-ITOA', 'lib']))
+
+import splunk
+from puppetenterprise_sdk.node_resolver import NodeIndex, NodeResolver
+from puppetenterprise_sdk.puppetdb import PuppetDBException
+from puppetenterprise_itsi import build_pe_client, PE_ITSI_LOG
+
+from common_utils.lazy import LazyLogger
+
+DEFAULT_LOGGER = LazyLogger(PE_ITSI_LOG, 'puppetenterprise.itsi.node.indexer')
+
+
+def refresh_node_index(server_uri, session_key, **kwargs):
+    """
+        Refreshes the index from the PuppetDB the alert action registered, if it is due
+        @param server_uri: <str> the domain of the splunk server
+        @param session_key: <str> a valid session key for the splunk server
+        @param logger: <Logger> An optional logger object
+        @return: <bool> True if the index was refreshed
+    """
+    logger = kwargs.get('logger', DEFAULT_LOGGER)
+    index = NodeIndex()
+    source = index.get_source()
+    if source is None:
+        logger.info('action=REFRESH_NODE_INDEX message="no alert action has registered a PuppetDB yet"')
+        return False
+    resolver = NodeResolver(
+        build_pe_client(source['username'], server_uri, session_key, logger),
+        source['puppetdb_url'],
+        logger=logger,
+        index=index,
+        refresh_interval=source['refresh_interval'],
+        service_fact=source['service_fact'],
+        inventory_facts=source['inventory_facts']
+    )
+    if not resolver.is_stale(time.time()):
+        return False
+    try:
+        return resolver.refresh()
+    except PuppetDBException, exception:
+        logger.warn('warning=NODE_INDEX_REFRESH_FAILED message="%s"', exception)
+        return False
+
+
+if __name__ == '__main__':
+    # passAuth in inputs.conf hands us a session key on stdin
+    SESSION_KEY = sys.stdin.readline().strip()
+    try:
+        refresh_node_index(splunk.getLocalServerInfo(), SESSION_KEY)
+# pylint: disable = broad-except
+    except Exception, exception:
+        DEFAULT_LOGGER.error('Failed to refresh the node index.')
+        DEFAULT_LOGGER.exception(exception)
+        sys.exit(1)
+# pylint: enable = broad-except
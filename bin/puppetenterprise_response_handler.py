@@ -4,15 +4,22 @@ from splunk.clilib.bundle_paths import make_splunkhome_path
 from splunk.persistconn.application import PersistentServerConnectionApplication
 sys.path.append(make_splunkhome_path(['etc', 'apps', 'puppetenterprise_itsi', 'lib']))
 sys.path.append(make_splunkhome_path(['etc', 'apps', 'SA-ITOA', 'lib']))
-from handler_utils.pe_handler import PuppetEnterpriseHandler
+from handler_utils.puppetenterprise_handler import PuppetEnterpriseHandler
+from handler_utils.work_queue import WorkQueue
 from itsi_utils.roles import is_itsi_user
 from itsi_utils.app import get_itsi_version
-from ITOA.setup_logging import setup_logging
-from itsi.event_management.sdk.eventing import Event
+from itsi_utils.responses import get_status, update_event, UPDATE_UNSUPPORTED_VERSIONS
+from common_utils.lazy import LazyLogger, LazyImport
 
 # The name of the log file to write to
 REST_HANDLER_LOG = 'puppetenterprise_itsi_rest.log'
-DEFAULT_LOGGER = setup_logging(REST_HANDLER_LOG, 'puppetenterprise.handlers.response')
+# import ITSI libraries on first use
+Event = LazyImport('itsi.event_management.sdk.eventing', 'Event')
+
+DEFAULT_LOGGER = LazyLogger(REST_HANDLER_LOG, 'puppetenterprise.handlers.response')
+
+# Processes async requests, it lives as long as the persistent handler process
+WORK_QUEUE = WorkQueue(name='response_handler', logger=DEFAULT_LOGGER)
 
 REQUIRED_FIELDS = [
     'event_id',
@@ -21,29 +28,22 @@ REQUIRED_FIELDS = [
     'message',
 ]
 
-STATUS_NO_CHANGE = 'NO_CHANGE'
-
-RESPONSE_TO_STATUS = {
-    'acknowledge': '2',
-    'resolve': '4',
-    'close': '5',
-    'escalate': STATUS_NO_CHANGE
-}
-
-UPDATE_UNSUPPORTED_VERSIONS = [
-    '2.6.0'
-]
-
 class ResponseHandler(PuppetEnterpriseHandler, PersistentServerConnectionApplication):
     """
         This class extends the PersistentServerConnectionApplication and is used to
-        update notable events Status/Owner and add a commennt
+        update notable events Status/Owner and add a commennt. Responses to many
+        episodes at once go to the bulk handler, which sends one update per Status/Owner
     """
     def __init__(self, command_line, command_arg):
         """
             initialize the object. parameters are unused
         """
-        super(ResponseHandler, self).__init__(command_line, command_arg, logger=DEFAULT_LOGGER)
+        super(ResponseHandler, self).__init__(
+            command_line,
+            command_arg,
+            logger=DEFAULT_LOGGER,
+            work_queue=WORK_QUEUE
+        )
         PersistentServerConnectionApplication.__init__(self)
         self.required_fields = REQUIRED_FIELDS
 
@@ -56,44 +56,7 @@ class ResponseHandler(PuppetEnterpriseHandler, PersistentServerConnectionApplica
             @param owner: <str>|<None> the owner to assign the event(s) to
             @return: <bool> True, if the update was successful
         """
-        is_update_successful = False
-        try:
-            update_blob = {
-                'event_ids': event_id
-            }
-            should_send = False
-            if status is not None:
-                update_blob['status'] = status
-                should_send = True
-            if owner is not None:
-                update_blob['owner'] = owner
-                should_send = True
-
-            if should_send:
-                event.update(update_blob)
-                is_update_successful = True
-            else:
-                code = 'NO_EVENT_UPDATE'
-                message = 'no change to status and owner'
-                self.logger.warn(
-                    'warning=%s message="%s"',
-                    code,
-                    message
-                )
-                is_update_successful = True
-# pylint: disable = broad-except
-        except Exception, exception:
-            code = 'UPDATE_EVENT_ERROR'
-            message = 'Unable to update event due to sdk error'
-            self.logger.error(
-                'error=%s message="%s"',
-                code,
-                message
-            )
-            self.logger.exception(exception)
-# pylint: enable = broad-except
-
-        return is_update_successful
+        return update_event(event, event_id, status, owner, logger=self.logger)
 
     def get_status(self, response):
         """
@@ -101,17 +64,7 @@ class ResponseHandler(PuppetEnterpriseHandler, PersistentServerConnectionApplica
             @param response: <str> the response from PuppetEnterprise
             @return: <str>|<None> if the response is valid it will return a status, otherwise None
         """
-        response_lower = response.lower()
-        status = RESPONSE_TO_STATUS.get(response_lower)
-        if not status:
-            self.logger.error(
-                'error=INVALID_RESPONSE response=%s valid_responses=%s',
-                response_lower,
-                ",".join(RESPONSE_TO_STATUS.keys())
-            )
-        elif status == STATUS_NO_CHANGE:
-            status = None
-        return status
+        return get_status(response, logger=self.logger)
 
     def build_success_response(self, owner, status):
         """
@@ -167,7 +120,7 @@ class ResponseHandler(PuppetEnterpriseHandler, PersistentServerConnectionApplica
             if is_itsi_user(server_rest_uri, session_key, owner, logger=self.logger) is False:
                 owner = None
 
-        itsi_version = get_itsi_version(server_rest_uri, session_key)
+        itsi_version = get_itsi_version(server_rest_uri, session_key, logger=self.logger)
         if itsi_version in UPDATE_UNSUPPORTED_VERSIONS:
             event.create_comment(event_id, message)
             warning_message = 'unable to update owner and status due to version'
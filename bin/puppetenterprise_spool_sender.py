@@ -0,0 +1,112 @@
+"""
+    Scripted input that delivers Orchestrator requests spooled by the alert action
+    while Puppet Enterprise was unavailable
+"""
+import sys
+
+from splunk.clilib.bundle_paths import make_splunkhome_path
+
+sys.path.append(make_splunkhome_path(['etc', 'apps', 'puppetenterprise_itsi', 'lib']))
+sys.path.append(make_splunkhome_path(['etc', 'apps', 'SA-ITOA', 'lib']))
+
+import splunk
+from itsi_utils.comments import add_comments
+from puppetenterprise_sdk.job_tracker import JobTracker, get_orchestrator_url, is_trackable_command
+from puppetenterprise_sdk.spool import OutboundSpool, SEND_DELIVERED, SEND_FAILED, SEND_REJECTED
+from puppetenterprise_itsi import build_pe_client, PE_ITSI_LOG
+
+from common_utils.lazy import LazyLogger, LazyImport
+
+# import ITSI libraries on first use
+Event = LazyImport('itsi.event_management.sdk.eventing', 'Event')
+
+DEFAULT_LOGGER = LazyLogger(PE_ITSI_LOG, 'puppetenterprise.itsi.spool.sender')
+
+
+class SpoolSender(object):
+    """
+        Delivers spooled records and comments the resulting job id on their events
+    """
+
+    def __init__(self, server_uri, session_key, **kwargs):
+        """
+            @param server_uri: <str> the domain of the splunk server
+            @param session_key: <str> a valid session key for the splunk server
+            @param logger: <Logger> An optional logger object
+        """
+        self.logger = kwargs.get('logger', DEFAULT_LOGGER)
+        self.server_uri = server_uri
+        self.session_key = session_key
+        self.pe_clients = {}
+        self.event = Event(session_key, logger=self.logger)
+
+    def get_pe_client(self, username):
+        """
+            Gets a client for the username, building it once per run
+            @param username: <str> the puppetenterprise username from the record
+            @return: <PuppetEnterpriseClient>
+        """
+        if username not in self.pe_clients:
+            self.pe_clients[username] = build_pe_client(
+                username,
+                self.server_uri,
+                self.session_key,
+                self.logger
+            )
+        return self.pe_clients[username]
+
+    def send_record(self, record):
+        """
+            @param record: <dict> a spooled request record
+            @return: <str> SEND_DELIVERED, SEND_FAILED if it may succeed later, or
+                SEND_REJECTED if Puppet Enterprise refused it
+        """
+        pe_client = self.get_pe_client(record.get('username'))
+        # records spooled before idempotency keys were added get a new key
+        job_id = pe_client.post_command(
+            record['url'],
+            record['body'],
+            idempotency_key=record.get('idempotency_key')
+        )
+        if job_id is False:
+            return SEND_FAILED if pe_client.is_last_failure_retryable() else SEND_REJECTED
+
+        self.logger.info(
+            'action=SPOOL_DELIVERED job_id=%s event_ids=%s',
+            job_id,
+            ','.join(record.get('event_ids', []))
+        )
+        comment = 'Successfully sent request to Puppet Enterprise: [%s]' % (job_id)
+        add_comments(self.event, record.get('event_ids', []), comment, logger=self.logger)
+        if is_trackable_command(record['url']):
+            JobTracker(logger=self.logger).track(
+                job_id,
+                get_orchestrator_url(record['url']),
+                record.get('username'),
+                record.get('event_ids', [])
+            )
+        return SEND_DELIVERED
+
+    def comment_dead_letter(self, record, reason):
+        """
+            Tells the record's events that the request was given up on
+            @param record: <dict> a spooled request record
+            @param reason: <str> why it was dead-lettered
+        """
+        comment = 'The queued request to Puppet Enterprise could not be delivered (%s).' % reason
+        comment += ' See %s for details.' % PE_ITSI_LOG
+        add_comments(self.event, record.get('event_ids', []), comment, logger=self.logger)
+
+
+if __name__ == '__main__':
+    # passAuth in inputs.conf hands us a session key on stdin
+    SESSION_KEY = sys.stdin.readline().strip()
+    try:
+        SENDER = SpoolSender(splunk.getLocalServerInfo(), SESSION_KEY)
+        OutboundSpool(logger=DEFAULT_LOGGER).drain(SENDER.send_record, on_dead_letter=SENDER.comment_dead_letter)
+# pylint: disable = broad-except
+    except Exception, exception:
+        DEFAULT_LOGGER.error('Failed to drain the outbound spool.')
+        DEFAULT_LOGGER.exception(exception)
+        sys.exit(1)
+# pylint: enable = broad-except
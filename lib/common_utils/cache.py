@@ -0,0 +1,82 @@
+"""
+    A small thread safe LRU cache whose entries expire after a time to live
+"""
+import threading
+import time
+
+from collections import OrderedDict
+
+DEFAULT_MAX_SIZE = 128
+DEFAULT_TTL = 300
+
+
+class TTLCache(object):
+    """
+        Least recently used entries are dropped once max_size is reached, and entries
+            older than ttl seconds are treated as missing
+    """
+
+    def __init__(self, **kwargs):
+        """
+            @param max_size: <int>, An optional maximum number of entries
+            @param ttl: <float>, An optional number of seconds an entry stays valid
+        """
+        self.max_size = kwargs.get('max_size', DEFAULT_MAX_SIZE)
+        self.ttl = kwargs.get('ttl', DEFAULT_TTL)
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        """
+            @param key: <hashable>, The cache key
+            @param default: <any>, An optional value to return on a miss
+
+            @return: <any> the cached value, or default if it is missing or expired
+        """
+        now = time.time()
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or now - entry[1] > self.ttl:
+                self.misses += 1
+                return default
+            # re-insert to mark it as most recently used
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        """
+            @param key: <hashable>, The cache key
+            @param value: <any>, The value to cache
+        """
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (value, time.time())
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, key=None):
+        """
+            @param key: <hashable>, An optional key to remove, every entry is
+                removed if it is not given
+        """
+        with self.lock:
+            if key is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(key, None)
+
+    def get_stats(self):
+        """
+            @return: <dict> the hit and miss counters, hit rate and size of the cache
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+                'size': len(self.entries)
+            }
@@ -0,0 +1,278 @@
+"""
+    A circuit breaker per endpoint, shared by every process through a small state
+    file under local/circuit. While the endpoint keeps failing the circuit opens and
+    requests are refused straight away instead of each one waiting out its timeouts.
+    After open_seconds a single probe request is let through (half-open), its outcome
+    closes the circuit again or re-opens it.
+
+    Successes of a closed circuit are counted in process memory and only merged into
+    the state file once a bucket's worth of seconds, with the next failure, or when
+    the process exits, so a healthy endpoint costs no locking or writes per request.
+"""
+import atexit
+import errno
+import hashlib
+import json
+import os
+import threading
+import time
+
+from .local_state import FileLock, get_local_path
+from .lazy import LazyLogger
+
+DEFAULT_LOGGER = LazyLogger('puppetenterprise.log', 'circuit_breaker')
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# The fraction of failed requests in the window that opens the circuit
+DEFAULT_FAILURE_RATE = 0.5
+# The number of requests in the window before the failure rate is considered
+DEFAULT_MIN_REQUESTS = 5
+# Seconds of outcomes the failure rate is computed over
+DEFAULT_WINDOW = 60
+# Seconds the circuit stays open before a probe is let through
+DEFAULT_OPEN_SECONDS = 30
+# The number of buckets the window is counted in
+WINDOW_BUCKETS = 10
+# Seconds after which the probe of a process that never reported back is replaced
+PROBE_LEASE = 120
+
+# Successes not yet merged into the state files, by state path, to the breaker,
+# the successes per bucket and when they were last merged
+PENDING_SUCCESSES = {}
+PENDING_LOCK = threading.Lock()
+
+
+def flush_pending_successes():
+    """
+        Merges the successes every breaker in this process has counted, registered to
+            run when the process exits
+    """
+    with PENDING_LOCK:
+        breakers = [pending['breaker'] for pending in PENDING_SUCCESSES.values() if pending['buckets']]
+    for breaker in breakers:
+        breaker.flush()
+
+atexit.register(flush_pending_successes)
+
+
+class CircuitBreaker(object):
+    """
+        Tracks the outcomes of requests to one endpoint
+
+            admitted_as = breaker.allow_request()
+            if admitted_as is not None:
+                ... send the request ...
+                breaker.record(admitted_as, is_success)
+            or, if the request was never sent
+                breaker.release(admitted_as)
+    """
+
+    def __init__(self, endpoint, **kwargs):
+        """
+            @param endpoint: <str> the endpoint key, eg. from governor.get_endpoint_key
+            @param failure_rate: <float> An optional failure rate that opens the circuit
+            @param min_requests: <int> An optional number of requests needed in the window
+            @param window: <float> An optional number of seconds outcomes are kept for
+            @param open_seconds: <float> An optional number of seconds the circuit stays open
+            @param logger: <Logger> An optional logger object
+            @param state_dir: <str> An optional directory for the state files,
+                defaults to local/circuit in the app
+        """
+        self.endpoint = endpoint
+        self.failure_rate = float(kwargs.get('failure_rate', DEFAULT_FAILURE_RATE))
+        self.min_requests = int(kwargs.get('min_requests', DEFAULT_MIN_REQUESTS))
+        self.window = float(kwargs.get('window', DEFAULT_WINDOW))
+        self.open_seconds = float(kwargs.get('open_seconds', DEFAULT_OPEN_SECONDS))
+        self.logger = kwargs.get('logger', DEFAULT_LOGGER)
+        name = hashlib.sha1(endpoint).hexdigest()[:16] + '.json'
+        state_dir = kwargs.get('state_dir')
+        if state_dir:
+            self.state_path = os.path.join(state_dir, name)
+        else:
+            self.state_path = get_local_path('circuit', name)
+        self.lock_path = self.state_path + '.lock'
+        self.bucket_seconds = self.window / WINDOW_BUCKETS
+
+    def read_state(self):
+        """
+            @return: <dict> state, opened_at, probe_until and the window buckets
+        """
+        try:
+            with open(self.state_path) as state_file:
+                return json.load(state_file)
+        except IOError, error:
+            if error.errno != errno.ENOENT:
+                raise
+        except ValueError:
+            self.logger.warning('action=READ_CIRCUIT_STATE message="corrupt state reset" path=%s',
+                                self.state_path)
+        return {'state': CLOSED, 'opened_at': 0, 'probe_until': 0, 'buckets': {}}
+
+    def write_state(self, state):
+        """
+            Replaces the state, the lock must be held. The rename means readers that
+                don't take the lock always see a whole file
+        """
+        temp_path = self.state_path + '.tmp'
+        with open(temp_path, 'w') as state_file:
+            json.dump(state, state_file)
+        os.rename(temp_path, self.state_path)
+
+    def transition(self, state, new_state, now):
+        """
+            Moves the circuit to new_state, the lock must be held
+        """
+        if state['state'] != new_state:
+            self.logger.warning('action=CIRCUIT_%s endpoint=%s previous=%s',
+                                new_state.upper(), self.endpoint, state['state'])
+        state['state'] = new_state
+        if new_state == OPEN:
+            state['opened_at'] = now
+        if new_state != HALF_OPEN:
+            state['probe_until'] = 0
+        if new_state == CLOSED:
+            state['buckets'] = {}
+
+    def allow_request(self, **kwargs):
+        """
+            @param now: <float> An optional current time
+            @return: <str|None> CLOSED if the request may be sent, HALF_OPEN if it may be
+                sent as the probe, None if the circuit is open or another process is
+                already probing the endpoint
+        """
+        now = kwargs.get('now') or time.time()
+        # a closed circuit, the common case, is read without taking the lock
+        state = self.read_state()
+        if state['state'] == CLOSED:
+            return CLOSED
+        if state['state'] == OPEN and now - state['opened_at'] < self.open_seconds:
+            return None
+
+        with FileLock(self.lock_path):
+            state = self.read_state()
+            if state['state'] == CLOSED:
+                return CLOSED
+            if state['state'] == OPEN and now - state['opened_at'] < self.open_seconds:
+                return None
+            if state['state'] == HALF_OPEN and state['probe_until'] > now:
+                return None
+            self.transition(state, HALF_OPEN, now)
+            state['probe_until'] = now + PROBE_LEASE
+            self.write_state(state)
+        return HALF_OPEN
+
+    def release(self, admitted_as):
+        """
+            Gives back an admission whose request was never sent, without recording an
+                outcome. A released probe lets the next request probe the endpoint
+            @param admitted_as: <str> the value allow_request returned for the request
+        """
+        if admitted_as != HALF_OPEN:
+            return
+        with FileLock(self.lock_path):
+            state = self.read_state()
+            if state['state'] == HALF_OPEN:
+                state['probe_until'] = 0
+                self.write_state(state)
+
+    def count_success(self, now):
+        """
+            Counts a success of a closed circuit in memory
+            @param now: <float> the current time
+            @return: <bool> True if the counted successes are due to be merged
+        """
+        bucket = str(int(now // self.bucket_seconds))
+        with PENDING_LOCK:
+            pending = PENDING_SUCCESSES.setdefault(self.state_path, {
+                'breaker': self,
+                'buckets': {},
+                'merged': now
+            })
+            pending['breaker'] = self
+            pending['buckets'][bucket] = pending['buckets'].get(bucket, 0) + 1
+            return now - pending['merged'] >= self.bucket_seconds
+
+    def take_successes(self, now):
+        """
+            @param now: <float> the current time
+            @return: <dict> the successes per bucket counted since they were last merged
+        """
+        with PENDING_LOCK:
+            pending = PENDING_SUCCESSES.get(self.state_path)
+            if pending is None:
+                return {}
+            successes = pending['buckets']
+            pending['buckets'] = {}
+            pending['merged'] = now
+            return successes
+
+    def flush(self, **kwargs):
+        """
+            Merges the successes counted in memory into the state file
+            @param now: <float> An optional current time
+        """
+        now = kwargs.get('now') or time.time()
+        with FileLock(self.lock_path):
+            state = self.read_state()
+            self.merge_successes(state, now)
+            if state['state'] == CLOSED:
+                self.write_state(state)
+
+    def merge_successes(self, state, now):
+        """
+            Adds the successes counted in memory to the window and drops expired buckets,
+                the lock must be held. Successes are dropped if the circuit isn't closed
+            @return: <dict> the buckets of the window
+        """
+        successes = self.take_successes(now)
+        if state['state'] != CLOSED:
+            return state['buckets']
+        oldest = int(now // self.bucket_seconds) - WINDOW_BUCKETS
+        buckets = dict(
+            (key, counts) for key, counts in state['buckets'].items() if int(key) > oldest
+        )
+        for bucket, count in successes.items():
+            if int(bucket) > oldest:
+                buckets.setdefault(bucket, [0, 0])[0] += count
+        state['buckets'] = buckets
+        return buckets
+
+    def record(self, admitted_as, is_success, **kwargs):
+        """
+            Records the outcome of a request allowed by allow_request
+            @param admitted_as: <str> the value allow_request returned for the request
+            @param is_success: <bool> False if the endpoint failed or could not be reached
+            @param now: <float> An optional current time
+        """
+        now = kwargs.get('now') or time.time()
+        if admitted_as == CLOSED and is_success:
+            # successes can't trip the circuit, they are merged in batches
+            if self.count_success(now):
+                self.flush(now=now)
+            return
+
+        with FileLock(self.lock_path):
+            state = self.read_state()
+            if admitted_as == HALF_OPEN:
+                # successes counted before the circuit opened are out of date
+                self.take_successes(now)
+                if state['state'] == HALF_OPEN:
+                    self.transition(state, CLOSED if is_success else OPEN, now)
+                    self.write_state(state)
+                return
+            buckets = self.merge_successes(state, now)
+            if state['state'] != CLOSED:
+                return
+
+            buckets.setdefault(str(int(now // self.bucket_seconds)), [0, 0])[1] += 1
+
+            total = sum(successes + failures for successes, failures in buckets.values())
+            failures = sum(failures for _, failures in buckets.values())
+            if total >= self.min_requests and failures >= self.failure_rate * total:
+                self.transition(state, OPEN, now)
+                self.logger.warning('action=CIRCUIT_TRIPPED endpoint=%s requests=%d failures=%d',
+                                    self.endpoint, total, failures)
+            self.write_state(state)
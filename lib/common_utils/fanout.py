@@ -0,0 +1,47 @@
+"""
+    Runs a function over many items with a bounded number of threads
+"""
+import sys
+import threading
+
+from Queue import Queue, Empty
+
+DEFAULT_CONCURRENCY = 8
+
+
+def run_concurrently(function, items, **kwargs):
+    """
+        Calls function once per item using at most concurrency threads
+        @param function: <function>, Called with a single item
+        @param items: <list>, The items to process
+        @param concurrency: <int>, An optional maximum number of threads
+
+        @return: <list[tuple(any, Exception)]> the items that raised, with their exception
+    """
+    concurrency = max(1, kwargs.get('concurrency', DEFAULT_CONCURRENCY))
+    work = Queue()
+    for item in items:
+        work.put(item)
+    failures = []
+    failures_lock = threading.Lock()
+
+    def worker():
+        while True:
+            try:
+                item = work.get_nowait()
+            except Empty:
+                return
+            try:
+                function(item)
+# pylint: disable = broad-except
+            except Exception:
+                with failures_lock:
+                    failures.append((item, sys.exc_info()[1]))
+# pylint: enable = broad-except
+
+    threads = [threading.Thread(target=worker) for _ in range(min(concurrency, len(items)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return failures
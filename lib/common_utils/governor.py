@@ -0,0 +1,225 @@
+"""
+    Rate limiting and a cap on in-flight requests per endpoint, shared by every
+    process through a small state file under local/governor. Each endpoint has a
+    token bucket refilled at rate requests per second up to burst, a set of leased
+    in-flight slots, and a time before which no request is sent after the server
+    answered with Retry-After. Callers that can't be admitted wait, up to max_wait
+    seconds, rather than failing straight away.
+"""
+import binascii
+import errno
+import hashlib
+import json
+import os
+import time
+
+from .local_state import FileLock, get_local_path
+from .lazy import LazyLogger
+
+DEFAULT_LOGGER = LazyLogger('puppetenterprise.log', 'governor')
+
+# Requests per second admitted per endpoint, 0 turns rate limiting off
+DEFAULT_RATE = 10.0
+# The number of requests that can be admitted at once after an idle period
+DEFAULT_BURST = 20
+# The number of requests sent to an endpoint at the same time, 0 is unlimited
+DEFAULT_MAX_IN_FLIGHT = 8
+# Seconds a caller waits to be admitted before giving up
+DEFAULT_MAX_WAIT = 30.0
+# Seconds after which the slot of a process that never released it is reclaimed
+SLOT_LEASE = 300.0
+# The longest Retry-After that is honored, in seconds
+MAX_RETRY_AFTER = 300.0
+# The longest sleep between admission attempts, so released slots are noticed
+MAX_POLL_INTERVAL = 0.25
+# Statuses that mean the endpoint is shedding load
+THROTTLED_STATUSES = (429, 503)
+
+
+class GovernorTimeoutException(Exception):
+    """
+        Exception Class used when a request could not be admitted within max_wait
+    """
+    pass
+
+
+def get_endpoint_key(url):
+    """
+        @param url: <str> a request url
+        @return: <str> the scheme, host and port the url is governed under
+    """
+    scheme, _, rest = url.partition('://')
+    return '%s://%s' % (scheme.lower(), rest.split('/', 1)[0].lower())
+
+
+def parse_retry_after(value, **kwargs):
+    """
+        @param value: <str|None> a Retry-After header, in seconds or an HTTP date
+        @param now: <float> An optional current time
+        @return: <float|None> the seconds to wait, capped at MAX_RETRY_AFTER, None if
+            the header is missing or invalid
+    """
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        seconds = float(value)
+    except ValueError:
+        from email.utils import parsedate_tz, mktime_tz
+        parsed = parsedate_tz(value)
+        if parsed is None:
+            return None
+        seconds = mktime_tz(parsed) - kwargs.get('now', time.time())
+    return min(MAX_RETRY_AFTER, max(0.0, seconds))
+
+
+class RequestGovernor(object):
+    """
+        Admits requests to one endpoint
+
+            slot = governor.acquire()
+            try:
+                ... send the request ...
+            finally:
+                governor.release(slot, status=res.status, retry_after=seconds)
+    """
+
+    def __init__(self, endpoint, **kwargs):
+        """
+            @param endpoint: <str> the endpoint key, see get_endpoint_key
+            @param rate: <float> An optional number of requests per second
+            @param burst: <int> An optional bucket size
+            @param max_in_flight: <int> An optional number of concurrent requests
+            @param max_wait: <float> An optional number of seconds acquire waits
+            @param logger: <Logger> An optional logger object
+            @param state_dir: <str> An optional directory for the state files,
+                defaults to local/governor in the app
+        """
+        self.endpoint = endpoint
+        self.rate = float(kwargs.get('rate', DEFAULT_RATE))
+        self.burst = max(1.0, float(kwargs.get('burst', DEFAULT_BURST)))
+        self.max_in_flight = int(kwargs.get('max_in_flight', DEFAULT_MAX_IN_FLIGHT))
+        self.max_wait = float(kwargs.get('max_wait', DEFAULT_MAX_WAIT))
+        self.logger = kwargs.get('logger', DEFAULT_LOGGER)
+        name = hashlib.sha1(endpoint).hexdigest()[:16] + '.json'
+        state_dir = kwargs.get('state_dir')
+        if state_dir:
+            self.state_path = os.path.join(state_dir, name)
+        else:
+            self.state_path = get_local_path('governor', name)
+        self.lock_path = self.state_path + '.lock'
+
+    def read_state(self, now):
+        """
+            Reads the endpoint state, the lock must be held
+            @return: <dict> tokens, updated, blocked_until and the in_flight slot leases
+        """
+        try:
+            with open(self.state_path) as state_file:
+                state = json.load(state_file)
+        except IOError, error:
+            if error.errno != errno.ENOENT:
+                raise
+            state = None
+        except ValueError:
+            self.logger.warning('action=READ_GOVERNOR_STATE message="corrupt state reset" path=%s',
+                                self.state_path)
+            state = None
+        if state is None:
+            state = {'tokens': self.burst, 'updated': now, 'blocked_until': 0, 'in_flight': {}}
+        return state
+
+    def write_state(self, state):
+        """
+            Replaces the endpoint state, the lock must be held
+        """
+        temp_path = self.state_path + '.tmp'
+        with open(temp_path, 'w') as state_file:
+            json.dump(state, state_file)
+        os.rename(temp_path, self.state_path)
+
+    def try_acquire(self, now):
+        """
+            Takes a token and a slot if both are available
+            @return: <tuple(str|None, float)> the slot id, or None and the seconds until
+                it is worth trying again
+        """
+        with FileLock(self.lock_path):
+            state = self.read_state(now)
+            if self.rate > 0:
+                elapsed = max(0.0, now - state['updated'])
+                state['tokens'] = min(self.burst, state['tokens'] + elapsed * self.rate)
+            state['updated'] = now
+            state['in_flight'] = dict(
+                (slot, lease) for slot, lease in state['in_flight'].items() if lease > now
+            )
+
+            wait = 0.0
+            if state['blocked_until'] > now:
+                wait = state['blocked_until'] - now
+            elif self.rate > 0 and state['tokens'] < 1:
+                wait = (1 - state['tokens']) / self.rate
+            elif self.max_in_flight > 0 and len(state['in_flight']) >= self.max_in_flight:
+                wait = MAX_POLL_INTERVAL
+
+            slot = None
+            if not wait:
+                slot = '%d-%s' % (os.getpid(), binascii.hexlify(os.urandom(6)))
+                if self.rate > 0:
+                    state['tokens'] -= 1
+                state['in_flight'][slot] = now + SLOT_LEASE
+            self.write_state(state)
+        return slot, wait
+
+    def acquire(self, **kwargs):
+        """
+            Waits until a request can be sent to the endpoint
+            @param max_wait: <float> An optional override of the governor's max_wait
+            @return: <str> the slot id, to be passed to release
+            @raise: GovernorTimeoutException, if the request was not admitted in time
+        """
+        max_wait = kwargs.get('max_wait', self.max_wait)
+        start = time.time()
+        deadline = start + max_wait
+        while True:
+            now = time.time()
+            slot, wait = self.try_acquire(now)
+            if slot is not None:
+                waited = now - start
+                if waited > 0.001:
+                    self.logger.info('action=GOVERNOR_ADMIT endpoint=%s waited_ms=%.2f',
+                                     self.endpoint, waited * 1000)
+                return slot
+            if now + wait > deadline:
+                self.logger.warning(
+                    'action=GOVERNOR_TIMEOUT endpoint=%s waited_ms=%.2f retry_in_ms=%.2f',
+                    self.endpoint,
+                    (now - start) * 1000,
+                    wait * 1000
+                )
+                raise GovernorTimeoutException(
+                    'Request to %s was not admitted within %.1f seconds' % (self.endpoint, max_wait)
+                )
+            time.sleep(min(wait, MAX_POLL_INTERVAL))
+
+    def release(self, slot, **kwargs):
+        """
+            Frees a slot once its response has been read
+            @param slot: <str> the slot id from acquire
+            @param status: <int> An optional response status
+            @param retry_after: <float> An optional number of seconds the endpoint asked
+                callers to wait, honored when status is a throttling status
+        """
+        status = kwargs.get('status')
+        retry_after = kwargs.get('retry_after')
+        now = time.time()
+        with FileLock(self.lock_path):
+            state = self.read_state(now)
+            state['in_flight'].pop(slot, None)
+            if status in THROTTLED_STATUSES:
+                # without a Retry-After back off for one token's worth of time
+                delay = retry_after if retry_after is not None else (1.0 / self.rate if self.rate > 0 else 1.0)
+                state['blocked_until'] = max(state['blocked_until'], now + delay)
+                self.logger.warning('action=GOVERNOR_THROTTLED endpoint=%s status=%s retry_after=%.2f',
+                                     self.endpoint, status, delay)
+            self.write_state(state)
@@ -0,0 +1,70 @@
+"""
+    Deferred logger setup and imports, so entry points only pay for the ITSI SDK
+    and log handlers once something actually uses them
+"""
+import importlib
+import threading
+
+
+class LazyLogger(object):
+    """
+        Stands in for the Logger returned by ITOA's setup_logging, which is only
+            called the first time the logger is used
+    """
+
+    def __init__(self, log_name, logger_name):
+        """
+            @param log_name: <str> the log file name
+            @param logger_name: <str> the logger name
+        """
+        self.log_name = log_name
+        self.logger_name = logger_name
+        self.logger = None
+        self.lock = threading.Lock()
+
+    def get_logger(self):
+        """
+            @return: <Logger> the real logger, set up on the first call
+        """
+        if self.logger is None:
+            with self.lock:
+                if self.logger is None:
+                    from ITOA.setup_logging import setup_logging
+                    self.logger = setup_logging(self.log_name, self.logger_name)
+        return self.logger
+
+    def __getattr__(self, name):
+        return getattr(self.get_logger(), name)
+
+
+class LazyImport(object):
+    """
+        Stands in for a module attribute, usually a class, which is imported the first
+            time it is called or one of its attributes is used
+
+            Event = LazyImport('itsi.event_management.sdk.eventing', 'Event')
+            event = Event(session_key, logger=logger)
+    """
+
+    def __init__(self, module_name, attribute):
+        """
+            @param module_name: <str> the module to import
+            @param attribute: <str> the name of the attribute in the module
+        """
+        self.module_name = module_name
+        self.attribute = attribute
+        self.value = None
+
+    def resolve(self):
+        """
+            @return: <object> the imported attribute
+        """
+        if self.value is None:
+            self.value = getattr(importlib.import_module(self.module_name), self.attribute)
+        return self.value
+
+    def __call__(self, *args, **kwargs):
+        return self.resolve()(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.resolve(), name)
@@ -0,0 +1,105 @@
+"""
+    Helpers for keeping state on disk under the app's local directory so that
+    short lived alert action processes can share it
+"""
+import errno
+import os
+
+from splunk.clilib.bundle_paths import make_splunkhome_path
+
+try:
+    import fcntl
+except ImportError:
+    # file locking is only supported on posix platforms
+    fcntl = None
+
+APP_NAME = 'puppetenterprise_itsi'
+
+
+class LocalStateException(Exception):
+    """
+        Exception Class used when local state can not be used on this platform
+    """
+    pass
+
+
+def is_locking_supported():
+    """
+        @return: <boolean>, True if FileLock can be used on this platform
+    """
+    return fcntl is not None
+
+
+def get_local_path(*parts):
+    """
+        Gets a path under the app's local directory, creating any missing parent
+            directories
+        @param parts: <str>, The path segments below local/
+
+        @return: <str>, The absolute path
+    """
+    path = make_splunkhome_path(['etc', 'apps', APP_NAME, 'local'] + list(parts))
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError, error:
+            # another process may have created it first
+            if error.errno != errno.EEXIST:
+                raise
+    return path
+
+
+class FileLock(object):
+    """
+        An exclusive advisory lock on a file, shared across processes. Can be used
+            as a context manager, in which case it always blocks
+    """
+
+    def __init__(self, path, **kwargs):
+        """
+            @param path: <str>, The lock file path, it is created if it does not exist
+            @param blocking: <boolean>, An optional value which controls whether
+                acquire waits for the lock, defaults to True
+        """
+        if fcntl is None:
+            raise LocalStateException('File locking is not supported on this platform')
+        self.path = path
+        self.blocking = kwargs.get('blocking', True)
+        self.handle = None
+
+    def acquire(self):
+        """
+            @return: <boolean>, True if the lock was acquired, False if it is held
+                elsewhere and the lock is non blocking
+        """
+        self.handle = open(self.path, 'a')
+        flags = fcntl.LOCK_EX
+        if not self.blocking:
+            flags |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(self.handle.fileno(), flags)
+        except IOError, error:
+            self.handle.close()
+            self.handle = None
+            if error.errno in (errno.EAGAIN, errno.EACCES):
+                return False
+            raise
+        return True
+
+    def release(self):
+        """
+            Releases the lock, does nothing if it is not held
+        """
+        if self.handle is not None:
+            fcntl.flock(self.handle.fileno(), fcntl.LOCK_UN)
+            self.handle.close()
+            self.handle = None
+
+    def __enter__(self):
+        self.blocking = True
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
@@ -0,0 +1,124 @@
+"""
+    Lightweight timing of the hot paths. Each timed operation writes one key=value
+    line to a dedicated metrics log so Splunk can index and chart it, eg.
+
+        metric=rest_request duration_ms=12.41 method=POST host=pe status=202 bytes_sent=1834
+
+    Operations are sampled, only SAMPLE_RATE of them are timed and logged, and an
+    unsampled Timer does no work beyond a single random draw.
+"""
+import os
+import random
+import time
+
+from .lazy import LazyLogger
+
+METRICS_LOG = 'puppetenterprise_metrics.log'
+METRICS_LOGGER = LazyLogger(METRICS_LOG, 'puppetenterprise.metrics')
+
+# The fraction of operations that are timed, 0 turns metrics off. Can be set for
+# every process with PUPPETENTERPRISE_METRICS_SAMPLE_RATE or per process with
+# set_sample_rate
+DEFAULT_SAMPLE_RATE = 1.0
+SAMPLE_RATE = DEFAULT_SAMPLE_RATE
+
+
+def parse_sample_rate(value):
+    """
+        @param value: <str|float|None> a sample rate
+        @return: <float> the rate clamped to [0, 1], DEFAULT_SAMPLE_RATE if it isn't a number
+    """
+    try:
+        return min(1.0, max(0.0, float(value)))
+    except (TypeError, ValueError):
+        return DEFAULT_SAMPLE_RATE
+
+
+def set_sample_rate(value):
+    """
+        @param value: <str|float|None> the fraction of operations to time
+    """
+    global SAMPLE_RATE
+    SAMPLE_RATE = parse_sample_rate(value)
+
+
+def get_sample_rate():
+    return SAMPLE_RATE
+
+
+def format_value(value):
+    """
+        @return: <str> the value as it appears in a key=value pair, quoted if needed
+    """
+    if isinstance(value, float):
+        return '%.2f' % value
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    value = str(value)
+    if not value or ' ' in value or '=' in value or '"' in value:
+        return '"%s"' % value.replace('"', '\\"')
+    return value
+
+
+def emit(name, duration_ms, fields, **kwargs):
+    """
+        Writes one metric line
+        @param name: <str> the metric name
+        @param duration_ms: <float> the duration of the operation
+        @param fields: <dict> extra key=value pairs
+        @param logger: <Logger>, An optional logger, defaults to the metrics log
+    """
+    logger = kwargs.get('logger', METRICS_LOGGER)
+    pairs = ['metric=%s' % name, 'duration_ms=%.2f' % duration_ms]
+    for key in sorted(fields):
+        pairs.append('%s=%s' % (key, format_value(fields[key])))
+    logger.info(' '.join(pairs))
+
+
+class Timer(object):
+    """
+        Times a block and emits it as a metric when it is sampled
+
+            with Timer('send_pe_event', event_count=10) as timer:
+                ...
+                timer.add(bytes=len(body))
+    """
+
+    def __init__(self, name, **fields):
+        """
+            @param name: <str> the metric name
+            @param fields: the initial key=value pairs of the metric
+        """
+        self.name = name
+        self.fields = fields
+        self.is_sampled = SAMPLE_RATE >= 1.0 or (SAMPLE_RATE > 0 and random.random() < SAMPLE_RATE)
+        self.start = None
+
+    def add(self, **fields):
+        """
+            Adds or replaces key=value pairs of the metric
+        """
+        if self.is_sampled:
+            self.fields.update(fields)
+
+    def increment(self, key, amount=1):
+        """
+            Adds amount to a counter field, eg. retries
+        """
+        if self.is_sampled:
+            self.fields[key] = self.fields.get(key, 0) + amount
+
+    def __enter__(self):
+        if self.is_sampled:
+            self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.is_sampled:
+            if exc_type is not None:
+                self.fields['error'] = exc_type.__name__
+            emit(self.name, (time.time() - self.start) * 1000, self.fields)
+        return False
+
+
+set_sample_rate(os.environ.get('PUPPETENTERPRISE_METRICS_SAMPLE_RATE', DEFAULT_SAMPLE_RATE))
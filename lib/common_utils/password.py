@@ -1,37 +1,179 @@
+import hashlib
+import threading
+import time
+
 from .rest import RESTClient
+from .cache import TTLCache
+from .metrics import Timer
 
-# import ITSI libraries
-from ITOA.setup_logging import setup_logging
+from .lazy import LazyLogger
 
 
-DEFAULT_LOGGER = setup_logging('puppetenterprise.log', 'util')
+DEFAULT_LOGGER = LazyLogger('puppetenterprise.log', 'util')
 APP_NAME = 'puppetenterprise_itsi'
 
+# Seconds a cached password is used without checking splunkd
+PASSWORD_CACHE_TTL = 300
+# Seconds past the ttl a cached password is still returned while it is refreshed,
+# Puppet Enterprise rejecting it invalidates it straight away
+PASSWORD_STALE_TTL = 3600
+
+# Passwords are only cached in process memory, they are never written to disk. The
+# warm action worker keeps them across alert action runs
+PASSWORD_CACHE = TTLCache(max_size=32, ttl=PASSWORD_CACHE_TTL + PASSWORD_STALE_TTL)
+# Guards the callers and refresh state of the cached entries
+PASSWORD_LOCK = threading.Lock()
+
+
+def get_cache_key(server_uri, password_name):
+    """
+        @return: <str> the key a password is cached under
+    """
+    return '%s|%s' % (server_uri, password_name)
+
+
+def get_session_digest(session_key):
+    """
+        @return: <str> a digest of the session key, kept rather than the session key itself
+    """
+    return hashlib.sha256(session_key or '').hexdigest()
+
+
+def get_caller(session_key, owner):
+    """
+        A cached password is only returned to callers splunkd has let read it. Every
+            alert action run has its own session key, so callers are the user the
+            alert ran as, which splunkd passes with the session key
+        @param session_key: <str>, The session key of the caller
+        @param owner: <str|None>, The Splunk user of the session, if it is known
+        @return: <str> the identity the caller's access is cached under
+    """
+    if owner:
+        return 'user:%s' % owner
+    return 'session:%s' % get_session_digest(session_key)
+
+
+def fetch_password(server_uri, session_key, password_name, logger):
+    """
+        Gets a password from the splunkd storage/passwords endpoint, skipping any cache
+        @return: <boolean|str>, The password string in clear text or false if we were unable to
+            find it
+    """
+    rest = RESTClient(return_json=True, logger=logger)
+    url_template = '%s/servicesNS/nobody/%s/storage/passwords/%%3A%s%%3A'
+    url_template += '?output_mode=json'
+    url = url_template % (server_uri, APP_NAME, password_name)
+    headers = {'Authorization': 'Splunk %s' % session_key}
+
+    response_body = rest.get(url, headers=headers)
+    if response_body:
+        return response_body['entry'][0]['content']['clear_password']
+    # else:
+    return False
+
+
+def refresh_password(server_uri, session_key, password_name, caller, logger):
+    """
+        Fetches a password with the caller's session and caches it, the caller is
+            recorded as allowed to read it
+        @return: <boolean|str>, The password or false if we were unable to find it
+    """
+    cache_key = get_cache_key(server_uri, password_name)
+    password = False
+    try:
+        password = fetch_password(server_uri, session_key, password_name, logger)
+    finally:
+        now = time.time()
+        with PASSWORD_LOCK:
+            entry = PASSWORD_CACHE.get(cache_key)
+            if password is False:
+                if entry is not None:
+                    # splunkd refused this caller, or the password is gone
+                    entry['callers'].pop(caller, None)
+                    entry['is_refreshing'] = False
+            else:
+                callers = entry['callers'] if entry is not None else {}
+                callers[caller] = now
+                PASSWORD_CACHE.set(cache_key, {
+                    'password': password,
+                    'fetched': now,
+                    'callers': callers,
+                    'is_refreshing': False
+                })
+    return password
+
+
+def invalidate_password(server_uri, password_name, **kwargs):
+    """
+        Removes a password from the cache, eg. after Puppet Enterprise rejects it
+        @param server_uri: <str>, The server domain of the Splunk Enterprise API
+        @param password_name: <str>, The name of the password
+        @param logger: <Logger>, An optional logger object
+    """
+    logger = kwargs.get('logger', DEFAULT_LOGGER)
+    logger.info('action=INVALIDATE_PASSWORD server_uri=%s password_name=%s', server_uri, password_name)
+    PASSWORD_CACHE.invalidate(get_cache_key(server_uri, password_name))
+
+
 def get_password(server_uri, session_key, password_name, **kwargs):
     """
-        Gets a password via the Splunk Enterprise API
+        Gets a password via the Splunk Enterprise API. Passwords are cached by server
+            and name for PASSWORD_CACHE_TTL seconds for every caller splunkd has
+            returned them to, and past that are returned while being refreshed
         @param server_uri: <str>, The server domain of the Splunk Enterprise API
         @param session_key: <str>, An active session key that can be used to
             access the Splunk Enterprise API
         @param password_name: <str>, The name of the password we are looking up
             the value of
+        @param owner: <str>, An optional Splunk user the session key belongs to,
+            cached access is checked per session key without it
         @param logger: <Logger>, An optional logger object that can be used to
             log information about requests
+        @param use_cache: <boolean>, An optional value which controls whether cached
+            passwords can be returned, defaults to True
 
         @returns: <boolean|str>, The password string in clear text or false if we were unable to
             find it
     """
     logger = kwargs.get('logger', DEFAULT_LOGGER)
+    use_cache = kwargs.get('use_cache', True)
     logger.info('action=GET_PASSWORD server_uri=%s password_name=%s', server_uri, password_name)
 
-    rest = RESTClient(return_json=True, logger=logger)
-    url_template = '%s/servicesNS/nobody/%s/storage/passwords/%%3A%s%%3A'
-    url_template += '?output_mode=json'
-    url = url_template % (server_uri, APP_NAME, password_name)
-    headers = {'Authorization': 'Splunk %s' % session_key}
+    if not use_cache:
+        return fetch_password(server_uri, session_key, password_name, logger)
 
-    response_body = rest.get(url, headers=headers)
-    if response_body:
-        return response_body['entry'][0]['content']['clear_password']
-    # else:
-    return False
+    caller = get_caller(session_key, kwargs.get('owner'))
+    cache_key = get_cache_key(server_uri, password_name)
+    password = None
+    is_refresh_started = False
+    with Timer('password_cache', password_name=password_name) as timer:
+        with PASSWORD_LOCK:
+            entry = PASSWORD_CACHE.get(cache_key)
+            if entry is not None and caller in entry['callers']:
+                # as old as the older of the password and the caller's access to it
+                cache_age = time.time() - min(entry['fetched'], entry['callers'][caller])
+                password = entry['password']
+                if cache_age > PASSWORD_CACHE_TTL:
+                    # only the first stale lookup starts a refresh
+                    is_refresh_started = not entry['is_refreshing']
+                    entry['is_refreshing'] = True
+        if password is None:
+            timer.add(result='miss')
+        else:
+            result = 'stale' if cache_age > PASSWORD_CACHE_TTL else 'hit'
+            timer.add(result=result, cache_age=cache_age)
+
+    if password is None:
+        logger.info('action=PASSWORD_CACHE result=miss password_name=%s', password_name)
+        return refresh_password(server_uri, session_key, password_name, caller, logger)
+
+    logger.info('action=PASSWORD_CACHE result=%s password_name=%s cache_age=%.1f',
+                result, password_name, cache_age)
+    if is_refresh_started:
+        # the thread is not a daemon so a refresh finishes before a short lived
+        # process exits
+        threading.Thread(
+            target=refresh_password,
+            args=(server_uri, session_key, password_name, caller, logger)
+        ).start()
+    return password
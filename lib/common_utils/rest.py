@@ -1,10 +1,40 @@
-import json
-import urllib2
+import httplib
+import random
+import select
+import socket
+import threading
+import time
 
 from urlparse import urlparse
-from ITOA.setup_logging import setup_logging
+from .lazy import LazyLogger
 
-DEFAULT_LOGGER = setup_logging('puppetenterprise.log', 'rest')
+from . import serialization
+from .metrics import Timer
+from .governor import GovernorTimeoutException, THROTTLED_STATUSES, parse_retry_after
+
+DEFAULT_LOGGER = LazyLogger('puppetenterprise.log', 'rest')
+
+# The maximum number of idle connections kept per host
+DEFAULT_POOL_SIZE = 4
+# The number of seconds an idle connection may sit in the pool before it is evicted
+DEFAULT_IDLE_TIMEOUT = 60
+# The number of bytes buffered before a chunk of a streamed body is written
+STREAM_CHUNK_SIZE = 16384
+# Seconds to wait for a connection to open, and for each read once it is open
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT = 60
+# The number of times a failed idempotent or keyed request is retried, keyed requests
+# are only retried when they were provably not processed
+DEFAULT_MAX_RETRIES = 3
+# Backoff between retries, in seconds
+DEFAULT_RETRY_BACKOFF = 0.5
+MAX_RETRY_BACKOFF = 8
+# Methods that can be retried without an idempotency key
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+# Statuses a request is retried on
+RETRYABLE_STATUSES = (429, 502, 503, 504)
+# A POST carrying this header can be retried when it was provably not processed
+IDEMPOTENCY_KEY_HEADER = 'Idempotency-Key'
 
 class RESTClientValidationException(Exception):
     """
@@ -18,6 +48,13 @@ class RESTClientResponseException(Exception):
     """
     pass
 
+class RequestNotSentException(Exception):
+    """
+        Exception Class used when a connection can't be opened, so no part of the
+            request reached the server
+    """
+    pass
+
 def validate_url(url, **kwargs):
     """
         URLs should all be validated, for now it only checks to make sure it uses
@@ -58,6 +95,236 @@ def convert_to_https(url, **kwargs):
     return url.replace("http://", "https://")
 
 
+def get_retry_delay(attempt, **kwargs):
+    """
+        Exponential backoff with full jitter
+        @param attempt: <int>, The number of attempts that have failed so far
+        @param base: <float>, An optional base delay in seconds
+        @return: <float>, The number of seconds to wait before the next attempt
+    """
+    base = kwargs.get('base', DEFAULT_RETRY_BACKOFF)
+    return random.uniform(0, min(MAX_RETRY_BACKOFF, base * (2 ** attempt)))
+
+
+def is_safe_to_resend(method, res, is_sent):
+    """
+        A request that is not idempotent may only be sent again if the server
+            can't have processed it: the connection was never opened, or the
+            server refused it with 429 or 503 and a Retry-After
+        @param method: <str>, The HTTP method
+        @param res: <httplib.HTTPResponse|None>, The response, None if there was none
+        @param is_sent: <boolean>, False if no part of the request was sent
+
+        @return: <boolean>, True if sending the request again can't run it twice
+    """
+    if method in IDEMPOTENT_METHODS:
+        return True
+    if res is None:
+        return not is_sent
+    return res.status in THROTTLED_STATUSES and res.getheader('retry-after') is not None
+
+
+def is_connection_alive(connection):
+    """
+        Health check for an idle pooled connection. A keep-alive socket should
+            have nothing to read while idle, if it is readable the server has
+            closed it (or sent something unexpected) and it can't be reused
+        @param connection: <httplib.HTTPConnection>, A previously used connection
+
+        @return: <boolean>, True if the connection can be reused
+    """
+    if connection.sock is None:
+        return False
+    try:
+        readable, _, _ = select.select([connection.sock], [], [], 0)
+    except (select.error, socket.error, ValueError):
+        return False
+    return not readable
+
+
+class SendCounter:
+    """
+        Counts the bytes handed to the socket by a connection, so a failed request
+            can tell whether any part of it was sent
+    """
+    bytes_sent = 0
+
+    def send(self, data):
+        """
+            @param data: <str|file>, The data to send, see httplib.HTTPConnection.send.
+                A file counts as one byte, only whether anything was sent matters
+        """
+        httplib.HTTPConnection.send(self, data)
+        self.bytes_sent += len(data) if isinstance(data, basestring) else 1
+
+
+class CountingHTTPConnection(SendCounter, httplib.HTTPConnection):
+    """
+        An HTTPConnection that counts the bytes it sends
+    """
+    pass
+
+
+class CountingHTTPSConnection(SendCounter, httplib.HTTPSConnection):
+    """
+        An HTTPSConnection that counts the bytes it sends
+    """
+    pass
+
+
+class ConnectionPool(object):
+    """
+        A thread safe, per-host pool of keep-alive HTTP(S) connections. A single
+            instance (CONNECTION_POOL) is shared by every RESTClient in the process
+            so that repeated calls to the same host skip the TCP and TLS handshake
+    """
+
+    def __init__(self, **kwargs):
+        """
+            @param logger: <Logger>, An optional logger object that can be used to log
+                information about the pool
+            @param max_size: <int>, An optional maximum number of idle connections
+                kept per host
+            @param idle_timeout: <int>, An optional number of seconds after which an
+                idle connection is evicted
+        """
+        self.logger = kwargs.get('logger', DEFAULT_LOGGER)
+        self.max_size = kwargs.get('max_size', DEFAULT_POOL_SIZE)
+        self.idle_timeout = kwargs.get('idle_timeout', DEFAULT_IDLE_TIMEOUT)
+        self.lock = threading.Lock()
+        self.idle_connections = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_connection(self, scheme, host, port, **kwargs):
+        """
+            Gets a healthy idle connection for the host, or opens a new one
+            @param scheme: <str>, http or https
+            @param host: <str>, The host name
+            @param port: <int>, The port number
+            @param connect_timeout: <float>, An optional timeout for opening a new connection
+
+            @return: <tuple(httplib.HTTPConnection, boolean)>, The connection and
+                whether or not it was reused from the pool
+        """
+        key = (scheme, host, port)
+        now = time.time()
+        with self.lock:
+            connections = self.idle_connections.get(key, [])
+            while connections:
+                connection, last_used = connections.pop()
+                if now - last_used > self.idle_timeout or not is_connection_alive(connection):
+                    connection.close()
+                    self.evictions += 1
+                    continue
+                self.hits += 1
+                return connection, True
+            self.misses += 1
+        return self.new_connection(scheme, host, port, **kwargs), False
+
+    def new_connection(self, scheme, host, port, **kwargs):
+        """
+            Opens a new connection that is not yet tracked by the pool
+            @param scheme: <str>, http or https
+            @param host: <str>, The host name
+            @param port: <int>, The port number
+            @param connect_timeout: <float>, An optional timeout for the TCP and TLS handshake
+
+            @return: <CountingHTTPConnection|CountingHTTPSConnection>
+            @raise: socket.error, if the connection can't be opened
+        """
+        connect_timeout = kwargs.get('connect_timeout', DEFAULT_CONNECT_TIMEOUT)
+        if scheme == 'https':
+            connection = CountingHTTPSConnection(host, port, timeout=connect_timeout)
+        else:
+            connection = CountingHTTPConnection(host, port, timeout=connect_timeout)
+        connection.connect()
+        # httplib writes a body larger than its headers' segment in a second send,
+        # without this it waits out the server's delayed ACK before sending it
+        connection.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return connection
+
+    def release(self, scheme, host, port, connection):
+        """
+            Returns a connection to the pool so it can be reused, the connection
+                is closed instead if the pool for that host is already full
+            @param scheme: <str>, http or https
+            @param host: <str>, The host name
+            @param port: <int>, The port number
+            @param connection: <httplib.HTTPConnection>, The connection to release
+        """
+        key = (scheme, host, port)
+        now = time.time()
+        with self.lock:
+            connections = self.idle_connections.setdefault(key, [])
+            # evict anything that has been idle for too long while we are here
+            fresh_connections = []
+            for idle_connection, last_used in connections:
+                if now - last_used > self.idle_timeout:
+                    idle_connection.close()
+                    self.evictions += 1
+                else:
+                    fresh_connections.append((idle_connection, last_used))
+            if len(fresh_connections) < self.max_size:
+                fresh_connections.append((connection, now))
+            else:
+                connection.close()
+            self.idle_connections[key] = fresh_connections
+
+    def get_stats(self):
+        """
+            @return: <dict>, The pool hit, miss and eviction counters
+        """
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+    def clear(self):
+        """
+            Closes every idle connection in the pool
+        """
+        with self.lock:
+            for connections in self.idle_connections.values():
+                for connection, _ in connections:
+                    connection.close()
+            self.idle_connections = {}
+
+
+CONNECTION_POOL = ConnectionPool()
+
+
+def write_chunked_body(connection, body_chunks):
+    """
+        Writes an iterable body using chunked transfer encoding, small chunks are
+            buffered so each write is at least STREAM_CHUNK_SIZE bytes
+        @param connection: <httplib.HTTPConnection>, A connection whose headers have
+            been sent
+        @param body_chunks: <iterable[str]>, The pieces of the body
+        @return: <int> the number of body bytes written
+    """
+    buffered = []
+    buffered_size = 0
+    total_size = 0
+    for chunk in body_chunks:
+        if isinstance(chunk, unicode):
+            chunk = chunk.encode('utf-8')
+        buffered.append(chunk)
+        buffered_size += len(chunk)
+        total_size += len(chunk)
+        if buffered_size >= STREAM_CHUNK_SIZE:
+            connection.send('%x\r\n%s\r\n' % (buffered_size, ''.join(buffered)))
+            buffered = []
+            buffered_size = 0
+    if buffered_size:
+        connection.send('%x\r\n%s\r\n' % (buffered_size, ''.join(buffered)))
+    connection.send('0\r\n\r\n')
+    return total_size
+
+
 class RESTClient(object):
     """
         Class used to make REST Calls in a validated fashion
@@ -69,37 +336,272 @@ class RESTClient(object):
                 information about requests
             @param return_json: <boolean>, If true, the client will parse the response
                 body as json and return the parsed value
+            @param pool: <ConnectionPool>, An optional connection pool, defaults to the
+                process wide CONNECTION_POOL
+            @param governor: <RequestGovernor>, An optional governor every request has
+                to be admitted by, throttled responses are retried while it allows
+            @param connect_timeout: <float>, An optional timeout for opening a connection
+            @param read_timeout: <float>, An optional timeout for each read of a response
+            @param max_retries: <int>, An optional number of retries of a failed request,
+                only idempotent requests and those with an idempotency key are retried,
+                and keyed requests only when is_safe_to_resend allows it
+            @param deadline: <float>, An optional number of seconds a call may take in
+                total, including retries. None lets it take as long as the retries take
         """
         self.logger = kwargs.get('logger', DEFAULT_LOGGER)
         self.return_json = kwargs.get('return_json', False)
+        self.pool = kwargs.get('pool', CONNECTION_POOL)
+        self.governor = kwargs.get('governor')
+        self.connect_timeout = kwargs.get('connect_timeout', DEFAULT_CONNECT_TIMEOUT)
+        self.read_timeout = kwargs.get('read_timeout', DEFAULT_READ_TIMEOUT)
+        self.max_retries = kwargs.get('max_retries', DEFAULT_MAX_RETRIES)
+        self.deadline = kwargs.get('deadline')
+        # the status and headers of the last response, None if there was none
+        self.status = None
+        self.response_headers = None
+        # True if the governor never admitted the last request, so it was not sent
+        self.not_admitted = False
+
+    def _write_request(self, connection, method, path, body, headers):
+        """
+            Writes the request line, headers and body to the connection
+            @param connection: <httplib.HTTPConnection>, The connection to write to
+            @param method: <str>, The HTTP method
+            @param path: <str>, The path and query string
+            @param body: <str|callable|None>, The request body, see _send_request
+            @param headers: <dict>, A map of header key, value pairs
+            @return: <int> the number of body bytes written
+        """
+        if not callable(body):
+            connection.request(method, path, body, headers)
+            return len(body) if body else 0
+        connection.putrequest(method, path)
+        for header in headers:
+            connection.putheader(header, headers.get(header))
+        connection.putheader('Transfer-Encoding', 'chunked')
+        connection.endheaders()
+        return write_chunked_body(connection, body())
+
+    def get_read_timeout(self, deadline):
+        """
+            @param deadline: <float|None>, The time the call has to finish by
+            @return: <float> the read timeout, shortened to fit the deadline
+        """
+        if deadline is None:
+            return self.read_timeout
+        return max(0.001, min(self.read_timeout, deadline - time.time()))
+
+    def _perform_request(self, method, url, body, headers, timer, deadline):
+        """
+            Sends one request over a pooled connection and reads the response
+            @param method: <str>, The HTTP method
+            @param url: <str>, The url to send the request to
+            @param body: <str|callable|None>, The request body, see _send_request
+            @param headers: <dict>, A map of header key, value pairs
+            @param timer: <Timer>, The metric of the request
+            @param deadline: <float|None>, The time the call has to finish by
+
+            @return: <tuple(httplib.HTTPResponse, str)>, The response and its body
+            @raise: RequestNotSentException, if the connection can't be opened
+        """
+        parts = urlparse(url)
+        scheme = parts.scheme.lower()
+        host = parts.hostname
+        port = parts.port or (httplib.HTTPS_PORT if scheme == 'https' else httplib.HTTP_PORT)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        try:
+            connection, is_reused = self.pool.get_connection(
+                scheme, host, port, connect_timeout=self.connect_timeout
+            )
+        except (httplib.HTTPException, socket.error), error:
+            raise RequestNotSentException(error)
+        try:
+            connection.bytes_sent = 0
+            connection.sock.settimeout(self.get_read_timeout(deadline))
+            bytes_sent = self._write_request(connection, method, path, body, headers)
+            res = connection.getresponse()
+        except (httplib.HTTPException, socket.error), error:
+            connection.close()
+            if not is_reused:
+                raise
+            # a request that was at least partly sent may have been processed
+            # before the connection dropped, so only idempotent ones are replayed
+            if method not in IDEMPOTENT_METHODS and connection.bytes_sent:
+                raise
+            # the server dropped the keep-alive connection between the health
+            # check and the request, retry once on a fresh connection
+            self.logger.info('action=SEND_REQUEST message="stale pooled connection" error="%s"', error)
+            timer.increment('retries')
+            try:
+                connection = self.pool.new_connection(scheme, host, port, connect_timeout=self.connect_timeout)
+            except (httplib.HTTPException, socket.error), error:
+                raise RequestNotSentException(error)
+            connection.sock.settimeout(self.get_read_timeout(deadline))
+            bytes_sent = self._write_request(connection, method, path, body, headers)
+            res = connection.getresponse()
+
+        response_body = res.read()
+        if res.will_close:
+            connection.close()
+        else:
+            self.pool.release(scheme, host, port, connection)
+        timer.add(
+            status=res.status,
+            reused=is_reused,
+            bytes_sent=bytes_sent,
+            bytes_received=len(response_body)
+        )
+
+        stats = self.pool.get_stats()
+        self.logger.info(
+            'action=CONNECTION_POOL host=%s reused=%s hits=%d misses=%d evictions=%d',
+            host,
+            is_reused,
+            stats['hits'],
+            stats['misses'],
+            stats['evictions']
+        )
+        return res, response_body
+
+    def _send_governed_request(self, method, url, body, headers, timer, deadline):
+        """
+            Sends a request once the governor admits it. Throttled responses are
+                retried after the endpoint's Retry-After for as long as the governor's
+                max_wait and the call's deadline allow, then the last response is returned.
+                A request that is not idempotent is only retried if is_safe_to_resend allows it
+            @return: <tuple(httplib.HTTPResponse, str)>, The response and its body
+            @raise: GovernorTimeoutException, if the request was never admitted
+        """
+        wait_deadline = time.time() + self.governor.max_wait
+        if deadline is not None:
+            wait_deadline = min(wait_deadline, deadline)
+        last_response = None
+        while True:
+            try:
+                slot = self.governor.acquire(max_wait=max(0.0, wait_deadline - time.time()))
+            except GovernorTimeoutException:
+                if last_response is None:
+                    raise
+                return last_response
+            res = None
+            try:
+                res, response_body = self._perform_request(method, url, body, headers, timer, deadline)
+            finally:
+                if res is None:
+                    self.governor.release(slot)
+                else:
+                    self.governor.release(
+                        slot,
+                        status=res.status,
+                        retry_after=parse_retry_after(res.getheader('retry-after'))
+                    )
+            last_response = (res, response_body)
+            if (
+                res.status not in THROTTLED_STATUSES or time.time() >= wait_deadline or
+                not is_safe_to_resend(method, res, True)
+            ):
+                return last_response
+            timer.increment('throttled')
+            self.logger.info('action=SEND_REQUEST message="throttled, waiting to retry" status=%s url=%s',
+                             res.status, url)
 
-    def _send_request(self, req, headers):
+    def _send_request(self, method, url, body, headers, **kwargs):
         """
-            Makes the request and optionally parses the response as json
-            @param req: <urllib2.Request>, A url request
+            Makes the request over a pooled connection, retrying it when that is safe,
+                and optionally parses the response as json
+            @param method: <str>, The HTTP method
+            @param url: <str>, The url to send the request to
+            @param body: <str|callable|None>, The request body. A callable must return
+                an iterable of strings, which is streamed with chunked transfer encoding
+            @param headers: <dict>, A map of header key, value pairs
+            @param deadline: <float>, An optional override of the client's deadline
 
             @return: <json|str|boolean>, False if the request failed,
                 JSON if specified when constructing the client, otherwise the String response
         """
-        try:
-            for header in headers:
-                req.add_header(header, headers.get(header))
-
-            res = urllib2.urlopen(req)
-            response_body = res.read()
-            if self.return_json:
-                response_body = json.loads(response_body)
-            if res.code >= 200 and res.code < 300:
-                return response_body
-            self.logger.error('action=SEND_REQUEST code=%d body=%s', res.code, response_body)
-            return False
-        except urllib2.HTTPError, error:
+        self.status = None
+        self.response_headers = None
+        self.not_admitted = False
+        timeout = kwargs.get('deadline', self.deadline)
+        deadline = time.time() + timeout if timeout else None
+        is_retryable = method in IDEMPOTENT_METHODS or IDEMPOTENCY_KEY_HEADER in headers
+        # the governor already waits out throttled responses
+        retryable_statuses = [
+            status for status in RETRYABLE_STATUSES
+            if self.governor is None or status not in THROTTLED_STATUSES
+        ]
+        parts = urlparse(url)
+        with Timer('rest_request', method=method, host=parts.hostname, path=parts.path, retries=0) as timer:
+            attempt = 0
+            while True:
+                res = None
+                error = None
+                is_sent = True
+                try:
+                    if self.governor is None:
+                        res, response_body = self._perform_request(method, url, body, headers, timer, deadline)
+                    else:
+                        res, response_body = self._send_governed_request(
+                            method, url, body, headers, timer, deadline
+                        )
+                except GovernorTimeoutException, error:
+                    self.not_admitted = True
+                    timer.add(status='not_admitted')
+                    self.logger.error('action=SEND_REQUEST error="%s"', error)
+                    return False
+                except RequestNotSentException, error:
+                    is_sent = False
+                except (httplib.HTTPException, socket.error), error:
+                    pass
+
+                if res is not None and res.status not in retryable_statuses:
+                    break
+                delay = get_retry_delay(attempt)
+                if (
+                    not is_retryable or not is_safe_to_resend(method, res, is_sent) or
+                    attempt >= self.max_retries or
+                    (deadline is not None and time.time() + delay >= deadline)
+                ):
+                    break
+                attempt += 1
+                timer.increment('retries')
+                self.logger.warning(
+                    'action=RETRY_REQUEST method=%s url=%s attempt=%d delay_ms=%.2f status=%s error="%s"',
+                    method,
+                    url,
+                    attempt,
+                    delay * 1000,
+                    res.status if res is not None else None,
+                    error
+                )
+                time.sleep(delay)
+
+            if res is None:
+                timer.add(error=type(error).__name__)
+                self.logger.error(
+                    'action=SEND_REQUEST method=%s url=%s attempts=%d error="%s"',
+                    method,
+                    url,
+                    attempt + 1,
+                    error
+                )
+                return False
+
+        self.status = res.status
+        self.response_headers = dict(res.getheaders())
+        if res.status < 200 or res.status >= 300:
             self.logger.error(
                 'action=SEND_REQUEST error_code="%s" error_body:"%s"',
-                error,
-                error.read()
+                res.status,
+                response_body
             )
             return False
+        if self.return_json:
+            response_body = serialization.loads(response_body)
+        return response_body
 
 
     def get(self, url, **kwargs):
@@ -109,6 +611,7 @@ class RESTClient(object):
             @param headers: <dict>, an optional map of header key, value pairs
             @param force_https: <boolean>, an optional value that controls whether the url
                 should automatically be converted to https
+            @param deadline: <float>, an optional number of seconds the call may take
 
             @return: <json|str|boolean>, False if the request failed,
                 JSON if specified when constructing the client, otherwise the String response
@@ -120,29 +623,36 @@ class RESTClient(object):
         if force_https:
             url = convert_to_https(url, logger=self.logger)
         self.logger.info("action=GET url=%s", url)
-        req = urllib2.Request(url)
 
-        return self._send_request(req, headers)
+        return self._send_request('GET', url, None, headers, deadline=kwargs.get('deadline', self.deadline))
 
 
     def post(self, url, **kwargs):
         """
             @param url: <str>, The url to send the request to
-            @param body: <dict>, the optional payload to send as part of the request
+            @param body: <str|callable>, the optional payload to send as part of the request,
+                a callable returning an iterable of strings streams the payload
             @param headers: <dict>, an optional map of header key, value pairs
             @param force_https: <boolean>, an optional value that controls whether the url
                 should automatically be converted to https
+            @param idempotency_key: <str>, an optional key sent as the Idempotency-Key
+                header, which lets the request be retried when it was provably not
+                processed, see is_safe_to_resend
+            @param deadline: <float>, an optional number of seconds the call may take
 
             @return: <json|str|boolean>, False if the request failed,
                 JSON if specified when constructing the client, otherwise the String response
         """
         force_https = kwargs.get('force_https', False)
-        body = kwargs.get('body', {})
+        body = kwargs.get('body', '')
         headers = kwargs.get('headers', {})
+        idempotency_key = kwargs.get('idempotency_key')
 
         if force_https:
             url = convert_to_https(url, logger=self.logger)
-        self.logger.info("action=POST url=%s", url)
-        req = urllib2.Request(url, body)
+        if idempotency_key:
+            headers = dict(headers)
+            headers[IDEMPOTENCY_KEY_HEADER] = idempotency_key
+        self.logger.info("action=POST url=%s idempotency_key=%s", url, idempotency_key)
 
-        return self._send_request(req, headers)
+        return self._send_request('POST', url, body, headers, deadline=kwargs.get('deadline', self.deadline))
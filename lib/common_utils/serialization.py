@@ -0,0 +1,74 @@
+"""
+    JSON encoding and decoding through the fastest backend that is installed:
+    ujson, then simplejson with its C speedups, then the standard library json.
+    None of the accelerated backends are required, the standard library is always
+    available as the fallback. PUPPETENTERPRISE_JSON_BACKEND can name the backend
+    to use, eg. json to rule out differences between backends.
+"""
+import json
+import os
+
+# The backends in order of preference
+BACKENDS = ['ujson', 'simplejson', 'json']
+
+
+def load_ujson():
+    import ujson
+
+    def dumps(obj):
+        # the standard library leaves forward slashes alone, keep the output the same
+        return ujson.dumps(obj, escape_forward_slashes=False)
+    return dumps, ujson.loads
+
+
+def load_simplejson():
+    import simplejson
+    from simplejson import encoder
+    # without its C extension simplejson is slower than the standard library
+    if getattr(encoder, 'c_make_encoder', None) is None:
+        raise ImportError('simplejson speedups are not available')
+    return simplejson.dumps, simplejson.loads
+
+
+def load_json():
+    return json.dumps, json.loads
+
+
+LOADERS = {
+    'ujson': load_ujson,
+    'simplejson': load_simplejson,
+    'json': load_json,
+}
+
+
+def set_backend(name=None):
+    """
+        Selects the backend used by dumps and loads
+        @param name: <str|None> ujson, simplejson or json. None picks the first of
+            BACKENDS that can be imported
+        @return: <str> the name of the backend in use
+    """
+    global BACKEND, dumps, loads
+    names = [name] if name else BACKENDS
+    for backend in names:
+        try:
+            dumps, loads = LOADERS[backend]()
+        except (ImportError, KeyError):
+            continue
+        BACKEND = backend
+        return BACKEND
+    dumps, loads = load_json()
+    BACKEND = 'json'
+    return BACKEND
+
+
+def get_backend():
+    """
+        @return: <str> the name of the backend in use
+    """
+    return BACKEND
+
+
+BACKEND = 'json'
+dumps, loads = load_json()
+set_backend(os.environ.get('PUPPETENTERPRISE_JSON_BACKEND') or None)
@@ -2,11 +2,15 @@
     This file is used as a template for creating Persistent
     Connection REST Handlers
 """
+import logging
 import os
 import sys
 import json
 
-from ITOA.setup_logging import setup_logging
+from common_utils import serialization
+from common_utils.password import get_session_digest
+from common_utils.metrics import Timer
+from common_utils.lazy import LazyLogger
 
 if sys.platform == "win32":
     import msvcrt
@@ -14,9 +18,37 @@ if sys.platform == "win32":
     msvcrt.setmode(sys.stdout.fileno(), os.O_BINARY)
     msvcrt.setmode(sys.stderr.fileno(), os.O_BINARY)
 
-DEFAULT_LOGGER = setup_logging('puppetenterprise.log', 'puppetenterprise.handler')
+DEFAULT_LOGGER = LazyLogger('puppetenterprise.log', 'puppetenterprise.handler')
 
-class puppetenterpriseHandler(object):
+# Values of the async query param or payload field that queue the request
+ASYNC_VALUES = ['1', 'true', 'yes', 'on']
+
+
+def get_query_params(input_request):
+    """
+        @param input_request: <object> the request splunkd passes a persistent handler
+        @return: <dict> the query string params, splunkd passes them as [key, value] pairs
+    """
+    params = {}
+    for pair in input_request.get('query') or []:
+        if len(pair) == 2:
+            params[pair[0]] = pair[1]
+    return params
+
+
+def get_request_owner(input_request):
+    """
+        @param input_request: <object> the request splunkd passes a persistent handler
+        @return: <str> the user who made the request, or a digest of their session key
+            if splunkd didn't name them
+    """
+    session = input_request.get('session') or {}
+    if session.get('user'):
+        return 'user:%s' % session.get('user')
+    return 'session:%s' % get_session_digest(session.get('authtoken'))
+
+
+class PuppetEnterpriseHandler(object):
     """
         This class is the template for Persistent Connection
         Handlers. For examples of use see /bin/puppetenterprise_comment_handler.py
@@ -31,12 +63,22 @@ class puppetenterpriseHandler(object):
         In addition, there are some helpful utilities you can call (see their docs below):
          * handle_puppetenterprise_error
          * build_response
+
+        Handlers given a work_queue also accept requests asynchronously. A request with
+        async=1 in its query string or "async": true in its payload is validated,
+        queued and answered with a 202 and a tracking id. A GET with ?tracking_id=
+        reports the outcome once the queue has processed it, to the user who queued it.
+        Outcomes are kept in the memory of the handler process, so they are lost when
+        splunkd restarts it and a search head cluster member only knows its own.
     """
     def __init__(self, command_line, command_arg, **kwargs):
         """
-            initialize the object. parameters are unused
+            initialize the object. command_line and command_arg are unused
+            @param logger: <Logger> An optional logger object
+            @param work_queue: <WorkQueue> An optional queue that enables async requests
         """
         self.logger = kwargs.get('logger', DEFAULT_LOGGER)
+        self.work_queue = kwargs.get('work_queue')
         self.command_line = command_line
         self.command_arg = command_arg
         self.valid_methods = ['POST']
@@ -135,18 +177,87 @@ class puppetenterpriseHandler(object):
 # pylint: enable = no-self-use
 # pylint: enable = unused-argument
 
+    def is_async(self, input_payload, query):
+        """
+            @param input_payload: <object> The request payload in object form
+            @param query: <dict> The query string params
+            @returns: <bool> True if the request asked to be queued and can be
+        """
+        if self.work_queue is None:
+            return False
+        value = query.get('async', input_payload.get('async'))
+        return str(value).strip().lower() in ASYNC_VALUES
+
+    def queue_request(self, input_payload, rest_path, owner, **kwargs):
+        """
+            Queues process_request and answers with its tracking id
+            @param input_payload: <object> The request payload in object form
+            @param rest_path: <str|None> The path the request was made to
+            @param owner: <str> The user the outcome is kept for, see get_request_owner
+            @param kwargs: the arguments for process_request
+
+            @returns: <object> A 202 response, or a 503 if the queue is full
+        """
+        tracking_id = self.work_queue.submit(owner, self.process_request, input_payload, **kwargs)
+        if tracking_id is None:
+            return self.build_response(503, {'message': 'Too many queued requests, retry later.'})
+        payload = {
+            'message': 'Request accepted',
+            'tracking_id': tracking_id,
+            'note': (
+                'The outcome is kept in the memory of the handler process that accepted '
+                'the request for %d seconds, it is lost if splunkd restarts the handler'
+            ) % self.work_queue.result_ttl,
+        }
+        if rest_path:
+            payload['status_url'] = '%s?tracking_id=%s' % (rest_path, tracking_id)
+        return self.build_response(202, payload)
+
+    def get_queued_status(self, tracking_id, owner):
+        """
+            @param tracking_id: <str|None> The id a queued request was answered with
+            @param owner: <str> The user asking, see get_request_owner
+            @returns: <object> A response with the state of the request, and its response
+                once it has been processed. Another user's request is reported as unknown
+        """
+        if not tracking_id:
+            return self.build_response(400, {'message': 'Missing tracking_id'})
+        result = self.work_queue.get(tracking_id, owner=owner)
+        if result is None:
+            return self.build_response(404, {'message': 'Unknown or expired tracking_id'})
+        result['tracking_id'] = tracking_id
+        return self.build_response(200, result)
+
     def handle(self, in_string):
         """
-            the handler method for incoming http requests
+            the handler method for incoming http requests, timed as a handler metric
+            @param in_string: <str> the http request input string
+
+            @returns: <object> A response object, likely made by self.build_response
+        """
+        with Timer('handler', handler=self.__class__.__name__, bytes=len(in_string or '')) as timer:
+            response = self.handle_request(in_string)
+            timer.add(status=response.get('status'))
+        return response
+
+    def handle_request(self, in_string):
+        """
+            parses, validates and processes an incoming http request
             @param in_string: <str> the http request input string
 
             @returns: <object> A response object, likely made by self.build_response
         """
         try:
-            self.logger.debug('INPUT: %s', json.dumps(in_string))
-            input_request = json.loads(in_string)
+            # the input is only quoted for the log when it will be written
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug('INPUT: %s', json.dumps(in_string))
+            input_request = serialization.loads(in_string)
 
             method = input_request.get('method')
+            query = get_query_params(input_request)
+
+            if method == 'GET' and self.work_queue is not None:
+                return self.get_queued_status(query.get('tracking_id'), get_request_owner(input_request))
 
             if not self.validate_method(method):
                 error_template = 'METHOD= %s SUPPORTED_METHODS= %s'
@@ -155,7 +266,8 @@ class puppetenterpriseHandler(object):
                     error_template % (method, ",".join(self.valid_methods))
                 )
 
-            input_payload = json.loads(input_request.get('payload'))
+            # splunkd passes the body as a json string inside the request json
+            input_payload = serialization.loads(input_request.get('payload') or '{}')
 
             missing_fields = self.check_required_fields(input_payload)
             if missing_fields:
@@ -180,6 +292,16 @@ class puppetenterpriseHandler(object):
             if validation_error:
                 return self.build_response(400, validation_error)
 
+            if self.is_async(input_payload, query):
+                return self.queue_request(
+                    input_payload,
+                    input_request.get('rest_path'),
+                    get_request_owner(input_request),
+                    method=method,
+                    session_key=session_key,
+                    server_rest_uri=server_rest_uri
+                )
+
             return self.process_request(
                 input_payload,
                 method=method,
@@ -0,0 +1,169 @@
+"""
+    An in-process work queue drained by a bounded pool of daemon threads, used by
+    the persistent REST handlers to accept a request, answer straight away with a
+    tracking id and process it in the background. Persistent handlers live across
+    requests, so the pool and the outcomes outlive the request that queued them,
+    but not a restart of the handler process.
+"""
+import binascii
+import os
+import sys
+import threading
+import time
+
+from Queue import Queue, Full
+
+from common_utils.metrics import Timer
+from common_utils.lazy import LazyLogger
+
+DEFAULT_LOGGER = LazyLogger('puppetenterprise.log', 'puppetenterprise.work_queue')
+
+# The number of threads processing queued requests
+DEFAULT_MAX_WORKERS = 4
+# The number of requests that can wait for a worker before new ones are refused
+DEFAULT_MAX_PENDING = 1000
+# Seconds the outcome of a finished request can be looked up for
+DEFAULT_RESULT_TTL = 3600
+# The number of outcomes kept, the oldest finished ones are dropped first
+MAX_RESULTS = 10000
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class WorkQueue(object):
+    """
+        Runs submitted functions on a bounded pool of threads and keeps their outcome
+            under a tracking id
+    """
+
+    def __init__(self, **kwargs):
+        """
+            @param max_workers: <int> An optional number of worker threads
+            @param max_pending: <int> An optional number of requests that can wait
+            @param result_ttl: <int> An optional number of seconds outcomes are kept for
+            @param name: <str> An optional name for the metrics and the threads
+            @param logger: <Logger> An optional logger object
+        """
+        self.max_workers = kwargs.get('max_workers', DEFAULT_MAX_WORKERS)
+        self.result_ttl = kwargs.get('result_ttl', DEFAULT_RESULT_TTL)
+        self.name = kwargs.get('name', 'work_queue')
+        self.logger = kwargs.get('logger', DEFAULT_LOGGER)
+        self.queue = Queue(kwargs.get('max_pending', DEFAULT_MAX_PENDING))
+        self.lock = threading.Lock()
+        self.results = {}
+        self.workers = []
+
+    def start_workers(self):
+        """
+            Starts the pool the first time work is submitted, the lock must be held
+        """
+        while len(self.workers) < self.max_workers:
+            worker = threading.Thread(
+                target=self.run_worker,
+                name='%s-%d' % (self.name, len(self.workers))
+            )
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def prune_results(self, now):
+        """
+            Drops expired outcomes, and the oldest finished ones over MAX_RESULTS. The
+                lock must be held
+        """
+        finished = [
+            (result['finished'], tracking_id) for tracking_id, result in self.results.items()
+            if result['finished'] is not None
+        ]
+        for finished_at, tracking_id in finished:
+            if now - finished_at > self.result_ttl:
+                del self.results[tracking_id]
+        excess = len(self.results) - MAX_RESULTS
+        if excess > 0:
+            for _, tracking_id in sorted(finished)[:excess]:
+                self.results.pop(tracking_id, None)
+
+    def submit(self, owner, function, *args, **kwargs):
+        """
+            Queues function(*args, **kwargs), which must return a response object
+            @param owner: <str> who submitted the work, only they can look up its outcome
+            @return: <str|None> the tracking id, None if the queue is full
+        """
+        tracking_id = binascii.hexlify(os.urandom(16))
+        now = time.time()
+        with self.lock:
+            self.prune_results(now)
+            self.start_workers()
+            self.results[tracking_id] = {
+                'owner': owner,
+                'state': QUEUED,
+                'submitted': now,
+                'started': None,
+                'finished': None,
+                'response': None,
+            }
+        try:
+            self.queue.put_nowait((tracking_id, function, args, kwargs))
+        except Full:
+            with self.lock:
+                del self.results[tracking_id]
+            self.logger.warning('action=WORK_QUEUE_FULL name=%s pending=%d', self.name, self.queue.qsize())
+            return None
+        return tracking_id
+
+    def get(self, tracking_id, **kwargs):
+        """
+            @param tracking_id: <str> an id returned by submit
+            @param owner: <str> An optional owner the work must have been submitted by
+            @return: <dict|None> a copy of the outcome with state, submitted, started,
+                finished and response, None if the id is unknown, expired or another
+                owner's
+        """
+        owner = kwargs.get('owner')
+        with self.lock:
+            result = self.results.get(tracking_id)
+            if result is None or (owner is not None and result['owner'] != owner):
+                return None
+            result = dict(result)
+        del result['owner']
+        return result
+
+    def set_result(self, tracking_id, **fields):
+        with self.lock:
+            result = self.results.get(tracking_id)
+            if result is not None:
+                result.update(fields)
+
+    def run_worker(self):
+        """
+            Processes queued work until the process exits
+        """
+        while True:
+            tracking_id, function, args, kwargs = self.queue.get()
+            started = time.time()
+            self.set_result(tracking_id, state=RUNNING, started=started)
+            result = self.get(tracking_id)
+            submitted = result['submitted'] if result is not None else started
+            with Timer(
+                'queued_request',
+                queue=self.name,
+                queued_ms=(started - submitted) * 1000
+            ) as timer:
+                try:
+                    response = function(*args, **kwargs)
+                    self.set_result(tracking_id, state=DONE, finished=time.time(), response=response)
+                    timer.add(state=DONE, status=response.get('status'))
+# pylint: disable = broad-except
+                except Exception:
+                    exception = sys.exc_info()[1]
+                    self.logger.error('action=QUEUED_REQUEST_FAILED name=%s tracking_id=%s',
+                                      self.name, tracking_id)
+                    self.logger.exception(exception)
+                    self.set_result(tracking_id, state=FAILED, finished=time.time(), response=None)
+                    timer.add(state=FAILED)
+# pylint: enable = broad-except
+                finally:
+                    self.queue.task_done()
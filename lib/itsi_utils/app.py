@@ -1,26 +1,56 @@
 """
     A utility for getting information about the ITSI local app
 """
+from common_utils.cache import TTLCache
 from common_utils.rest import RESTClient
 
-# import ITSI libraries
-from ITOA.setup_logging import setup_logging
+from common_utils.lazy import LazyLogger
 
-DEFAULT_LOGGER = setup_logging('puppetenterprise.log', 'util')
+DEFAULT_LOGGER = LazyLogger('puppetenterprise.log', 'util')
 
 ITSI_APP_NAME = 'SA-ITOA'
 
+# The ITSI version only changes on upgrade, so persistent handlers cache it
+VERSION_CACHE = TTLCache(max_size=16, ttl=3600)
+
 def get_itsi_version(server_uri, session_key, **kwargs):
     """
         Gets the version of the ITSI application
         @param server_uri: <str> the domain of the splunk server
         @param session_key: <str> a valid session key for the splunk server
+        @param use_cache: <bool> An optional value which controls whether a cached
+            version can be returned, defaults to True
         @return: <str|bool> If the app can be found it returns the version string, false otherwise
 
     """
     logger = kwargs.get('logger', DEFAULT_LOGGER)
+    use_cache = kwargs.get('use_cache', True)
     logger.info('action=GET_ITSI_VERSION server_uri=%s app_name=%s', server_uri, ITSI_APP_NAME)
 
+    if use_cache:
+        version = VERSION_CACHE.get(server_uri)
+        stats = VERSION_CACHE.get_stats()
+        logger.info(
+            'action=VERSION_CACHE result=%s hit_rate=%.2f size=%d',
+            'miss' if version is None else 'hit',
+            stats['hit_rate'],
+            stats['size']
+        )
+        if version is not None:
+            return version
+
+    version = fetch_itsi_version(server_uri, session_key, logger)
+    # a failed lookup is not cached so it is retried on the next request
+    if version is not False:
+        VERSION_CACHE.set(server_uri, version)
+    return version
+
+def fetch_itsi_version(server_uri, session_key, logger):
+    """
+        Looks up the version of the ITSI application in splunkd, skipping the cache
+        @return: <str|bool> If the app can be found it returns the version string, false otherwise
+    """
+
     rest = RESTClient(return_json=True, logger=logger)
     url_template = '%s/services/apps/local/%s?output_mode=json'
     url = url_template % (server_uri, ITSI_APP_NAME)
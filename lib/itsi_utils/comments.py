@@ -0,0 +1,62 @@
+"""
+    A utility for adding the same comment to many Notable Events
+"""
+from common_utils.fanout import run_concurrently, DEFAULT_CONCURRENCY
+from common_utils.lazy import LazyLogger
+
+DEFAULT_LOGGER = LazyLogger('puppetenterprise.log', 'util')
+
+def supports_bulk_comments(event):
+    """
+        Checks whether this version of the Notable Events SDK takes a list of ids
+            in create_comment
+        @param event: <Event> an instance of Event from the Notable Events SDK
+        @return: <bool> True if create_comment accepts event_ids
+    """
+    # inspect pulls in tokenize, only pay for it when comments are made
+    import inspect
+    try:
+        return 'event_ids' in inspect.getargspec(event.create_comment).args
+    except TypeError:
+        return False
+
+def add_comments(event, event_ids, comment, **kwargs):
+    """
+        Adds a comment to every event, in one call if the SDK supports it, otherwise
+            with a bounded number of concurrent calls through the same client
+        @param event: <Event> an instance of Event from the Notable Events SDK
+        @param event_ids: <list[str]> the events to comment on
+        @param comment: <str> the comment
+        @param concurrency: <int> An optional maximum number of concurrent calls
+        @return: <list[str]> the ids of the events that could not be commented on
+    """
+    logger = kwargs.get('logger', DEFAULT_LOGGER)
+    concurrency = kwargs.get('concurrency', DEFAULT_CONCURRENCY)
+    if not event_ids:
+        return []
+
+    if supports_bulk_comments(event):
+        try:
+            event.create_comment(event_ids, comment)
+            return []
+# pylint: disable = broad-except
+        except Exception, exception:
+            logger.error('error=BULK_COMMENT_FAILED event_count=%d', len(event_ids))
+            logger.exception(exception)
+            return list(event_ids)
+# pylint: enable = broad-except
+
+    failures = run_concurrently(
+        lambda event_id: event.create_comment(event_id, comment),
+        event_ids,
+        concurrency=concurrency
+    )
+    if failures:
+        logger.error(
+            'error=COMMENT_FANOUT_FAILED failed_count=%d event_count=%d event_ids=%s first_error="%s"',
+            len(failures),
+            len(event_ids),
+            ','.join([event_id for event_id, _ in failures]),
+            failures[0][1]
+        )
+    return [event_id for event_id, _ in failures]
@@ -0,0 +1,87 @@
+"""
+    Utilities for applying Puppet Enterprise responses to ITSI Notable Events
+"""
+from common_utils.lazy import LazyLogger
+
+DEFAULT_LOGGER = LazyLogger('puppetenterprise.log', 'util')
+
+STATUS_NO_CHANGE = 'NO_CHANGE'
+
+RESPONSE_TO_STATUS = {
+    'acknowledge': '2',
+    'resolve': '4',
+    'close': '5',
+    'escalate': STATUS_NO_CHANGE
+}
+
+UPDATE_UNSUPPORTED_VERSIONS = [
+    '2.6.0'
+]
+
+def get_status(response, **kwargs):
+    """
+        Gets the status that the response is mapped to
+        @param response: <str> the response from PuppetEnterprise
+        @return: <str>|<None> if the response is valid it will return a status, otherwise None
+    """
+    logger = kwargs.get('logger', DEFAULT_LOGGER)
+    response_lower = response.lower()
+    status = RESPONSE_TO_STATUS.get(response_lower)
+    if not status:
+        logger.error(
+            'error=INVALID_RESPONSE response=%s valid_responses=%s',
+            response_lower,
+            ",".join(RESPONSE_TO_STATUS.keys())
+        )
+    elif status == STATUS_NO_CHANGE:
+        status = None
+    return status
+
+def update_event(event, event_id, status, owner, **kwargs):
+    """
+        Safely updates the event's status and owner if either is valid
+        @param event: <EventMeta> an instance of EventMeta from the Notable Events SDK
+        @param event_id: <str>|<list> an id or list of Notable Event IDs you wish to update
+        @param status: <str>|<None> the status to transition the event(s) to
+        @param owner: <str>|<None> the owner to assign the event(s) to
+        @return: <bool> True, if the update was successful
+    """
+    logger = kwargs.get('logger', DEFAULT_LOGGER)
+    is_update_successful = False
+    try:
+        update_blob = {
+            'event_ids': event_id
+        }
+        should_send = False
+        if status is not None:
+            update_blob['status'] = status
+            should_send = True
+        if owner is not None:
+            update_blob['owner'] = owner
+            should_send = True
+
+        if should_send:
+            event.update(update_blob)
+            is_update_successful = True
+        else:
+            code = 'NO_EVENT_UPDATE'
+            message = 'no change to status and owner'
+            logger.warn(
+                'warning=%s message="%s"',
+                code,
+                message
+            )
+            is_update_successful = True
+# pylint: disable = broad-except
+    except Exception, exception:
+        code = 'UPDATE_EVENT_ERROR'
+        message = 'Unable to update event due to sdk error'
+        logger.error(
+            'error=%s message="%s"',
+            code,
+            message
+        )
+        logger.exception(exception)
+# pylint: enable = broad-except
+
+    return is_update_successful
@@ -1,9 +1,12 @@
+from common_utils.cache import TTLCache
 from common_utils.rest import RESTClient
 
-# import ITSI libraries
-from ITOA.setup_logging import setup_logging
+from common_utils.lazy import LazyLogger
 
-DEFAULT_LOGGER = setup_logging('puppetenterprise.log', 'util')
+DEFAULT_LOGGER = LazyLogger('puppetenterprise.log', 'util')
+
+# Role lookups are cached for persistent handlers, roles rarely change
+USER_CACHE = TTLCache(max_size=256, ttl=300)
 
 ITSI_ROLES = [
     'itoa_user',
@@ -30,12 +33,42 @@ def is_itsi_user(server_uri, session_key, username, **kwargs):
         @param server_uri: <str> the domain of the splunk server
         @param session_key: <str> a valid session key for the splunk server
         @param username: <str> the username of the user we are validating
+        @param use_cache: <bool> An optional value which controls whether a cached
+            result can be returned, defaults to True
         @return: <bool> True, if the user exists and has one of the ITIS roles, false otherwise
 
     """
     logger = kwargs.get('logger', DEFAULT_LOGGER)
+    use_cache = kwargs.get('use_cache', True)
     logger.info('action=IS_ITSI_USER server_uri=%s username=%s', server_uri, username)
 
+    cache_key = (server_uri, username)
+    if use_cache:
+        is_valid_user = USER_CACHE.get(cache_key)
+        stats = USER_CACHE.get_stats()
+        logger.info(
+            'action=USER_CACHE result=%s username=%s hit_rate=%.2f size=%d',
+            'miss' if is_valid_user is None else 'hit',
+            username,
+            stats['hit_rate'],
+            stats['size']
+        )
+        if is_valid_user is not None:
+            return is_valid_user
+
+    is_valid_user = get_is_itsi_user(server_uri, session_key, username, logger)
+    if is_valid_user is None:
+        # the lookup itself failed, don't cache that
+        return False
+    USER_CACHE.set(cache_key, is_valid_user)
+    return is_valid_user
+
+def get_is_itsi_user(server_uri, session_key, username, logger):
+    """
+        Looks up the user's roles in splunkd, skipping the cache
+        @return: <bool|None> True, if the user exists and has one of the ITIS roles,
+            None if the user could not be looked up, false otherwise
+    """
     rest = RESTClient(return_json=True, logger=logger)
     url_template = '%s/services/authentication/users/%s?output_mode=json'
     url = url_template % (server_uri, username)
@@ -62,4 +95,4 @@ def is_itsi_user(server_uri, session_key, username, **kwargs):
         username,
         'Unable to find user'
     )
-    return False
+    return None
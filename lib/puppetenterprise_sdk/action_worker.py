@@ -0,0 +1,232 @@
+"""
+    A long lived worker that runs alert actions handed to it over a local Unix
+    socket, so the imports, password cache and connection pool stay warm between
+    actions instead of being rebuilt by every --execute process.
+
+    The --execute stub imports this module before anything else, so it only uses
+    the standard library and local_state and takes its logger as an argument.
+
+    Protocol, every message is a 4 byte big-endian length followed by the body:
+        stub   -> worker  the alert action payload
+        worker -> stub    ACCEPTED, once the worker has a thread free for it
+        stub   -> worker  COMMIT, the stub will not run the action itself
+        worker -> stub    the json result, eg. {"exit_code": 0}
+    The worker only runs an action once it has the COMMIT, and the stub only falls
+    back to running in-process before it has sent it, so an action runs exactly once.
+"""
+import errno
+import json
+import os
+import socket
+import struct
+import threading
+import time
+
+from common_utils.local_state import FileLock, get_local_path
+
+ACCEPTED = 'ACCEPTED'
+COMMIT = 'COMMIT'
+
+# Seconds the stub waits for the worker to accept an action before running it in-process
+DEFAULT_ACCEPT_TIMEOUT = 5
+# Seconds the stub waits for the result of an accepted action
+DEFAULT_RESULT_TIMEOUT = 600
+# The number of actions the worker runs at once
+DEFAULT_MAX_ACTIONS = 8
+# Seconds between checks for the end of the worker's runtime
+ACCEPT_POLL_INTERVAL = 1
+LENGTH_FORMAT = '>I'
+LENGTH_SIZE = struct.calcsize(LENGTH_FORMAT)
+
+
+def get_socket_path():
+    """
+        @return: <str> the path of the worker socket under local/worker
+    """
+    return get_local_path('worker', 'action.sock')
+
+
+def send_message(connection, body):
+    """
+        @param connection: <socket> a connected socket
+        @param body: <str> the message body
+    """
+    if isinstance(body, unicode):
+        body = body.encode('utf-8')
+    connection.sendall(struct.pack(LENGTH_FORMAT, len(body)) + body)
+
+
+def receive_exactly(connection, size):
+    """
+        @return: <str> size bytes read from the connection
+        @raise: <socket.error> if the connection closes first
+    """
+    chunks = []
+    remaining = size
+    while remaining:
+        chunk = connection.recv(min(remaining, 65536))
+        if not chunk:
+            raise socket.error(errno.ECONNRESET, 'connection closed')
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return ''.join(chunks)
+
+
+def receive_message(connection):
+    """
+        @param connection: <socket> a connected socket
+        @return: <str> the next message body
+    """
+    size = struct.unpack(LENGTH_FORMAT, receive_exactly(connection, LENGTH_SIZE))[0]
+    return receive_exactly(connection, size)
+
+
+def forward_action(payload, **kwargs):
+    """
+        Hands an alert action payload to the worker
+        @param payload: <str> the payload splunkd passed on stdin
+        @param socket_path: <str> An optional socket path, defaults to get_socket_path()
+        @param accept_timeout: <float> An optional number of seconds to wait for the
+            worker to accept the action
+        @param result_timeout: <float> An optional number of seconds to wait for the result
+
+        @return: <int|None> the exit code of the action, None if the worker did not take
+            it and it should be run in-process
+    """
+    socket_path = kwargs.get('socket_path') or get_socket_path()
+    if not os.path.exists(socket_path):
+        return None
+
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            connection.settimeout(kwargs.get('accept_timeout', DEFAULT_ACCEPT_TIMEOUT))
+            connection.connect(socket_path)
+            send_message(connection, payload)
+            if receive_message(connection) != ACCEPTED:
+                return None
+            send_message(connection, COMMIT)
+        except (socket.error, socket.timeout, struct.error):
+            # the worker is down, busy or stale, nothing has run yet
+            return None
+
+        # from here on the worker owns the action, never run it a second time
+        try:
+            connection.settimeout(kwargs.get('result_timeout', DEFAULT_RESULT_TIMEOUT))
+            result = json.loads(receive_message(connection))
+            return int(result.get('exit_code', 1))
+        except (socket.error, socket.timeout, struct.error, ValueError):
+            return 1
+    finally:
+        connection.close()
+
+
+class ActionWorker(object):
+    """
+        Accepts actions on the worker socket and runs each on its own thread
+    """
+
+    def __init__(self, run_action, logger, **kwargs):
+        """
+            @param run_action: <function> called with a payload, returns an exit code
+            @param logger: <Logger> the logger object
+            @param socket_path: <str> An optional socket path, defaults to get_socket_path()
+            @param max_actions: <int> An optional number of actions run at once
+        """
+        self.run_action = run_action
+        self.logger = logger
+        self.socket_path = kwargs.get('socket_path') or get_socket_path()
+        self.slots = threading.BoundedSemaphore(kwargs.get('max_actions', DEFAULT_MAX_ACTIONS))
+        self.threads = []
+
+    def handle_connection(self, connection):
+        """
+            Runs one forwarded action, the caller has taken a slot for it
+            @param connection: <socket> the stub's connection
+        """
+        start = time.time()
+        try:
+            connection.settimeout(DEFAULT_ACCEPT_TIMEOUT)
+            payload = receive_message(connection)
+            send_message(connection, ACCEPTED)
+            if receive_message(connection) != COMMIT:
+                return
+            connection.settimeout(None)
+
+            exit_code = self.run_action(payload)
+            send_message(connection, json.dumps({'exit_code': exit_code}))
+            self.logger.info(
+                'action=WORKER_ACTION exit_code=%s duration_ms=%.2f',
+                exit_code,
+                (time.time() - start) * 1000
+            )
+        except (socket.error, socket.timeout, struct.error), error:
+            # the stub gave up before committing, it runs the action itself
+            self.logger.warn('warning=WORKER_CONNECTION_LOST error="%s"', error)
+        finally:
+            connection.close()
+            self.slots.release()
+
+    def listen(self):
+        """
+            @return: <socket> the listening worker socket, replacing a stale socket file
+        """
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # the socket is created owner only, chmod after bind would leave a window
+        # where other users could connect
+        umask = os.umask(0177)
+        try:
+            listener.bind(self.socket_path)
+        finally:
+            os.umask(umask)
+        listener.listen(64)
+        listener.settimeout(ACCEPT_POLL_INTERVAL)
+        return listener
+
+    def serve_until(self, deadline):
+        """
+            Accepts actions until the deadline, then waits for the running ones
+            @param deadline: <float> the time to stop accepting at
+        """
+        listener = self.listen()
+        self.logger.info('action=WORKER_START socket=%s', self.socket_path)
+        try:
+            while time.time() < deadline:
+                # wait for a free slot first so waiting stubs time out and run in-process
+                if not self.slots.acquire(False):
+                    time.sleep(0.01)
+                    continue
+                try:
+                    connection, _ = listener.accept()
+                except socket.timeout:
+                    self.slots.release()
+                    continue
+                connection.setblocking(True)
+                thread = threading.Thread(target=self.handle_connection, args=(connection,))
+                thread.start()
+                self.threads = [running for running in self.threads if running.is_alive()]
+                self.threads.append(thread)
+        finally:
+            # stop new stubs connecting before the running actions finish
+            listener.close()
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+            for thread in self.threads:
+                thread.join()
+            self.logger.info('action=WORKER_STOP socket=%s', self.socket_path)
+
+    def run(self, max_runtime):
+        """
+            Serves for max_runtime seconds unless another worker is already running
+            @param max_runtime: <float> the number of seconds to serve for
+        """
+        worker_lock = FileLock(self.socket_path + '.lock', blocking=False)
+        if not worker_lock.acquire():
+            self.logger.info('action=WORKER_START message="another worker is running"')
+            return
+        try:
+            self.serve_until(time.time() + max_runtime)
+        finally:
+            worker_lock.release()
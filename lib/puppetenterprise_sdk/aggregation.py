@@ -0,0 +1,108 @@
+"""
+    Aggregates the events of an episode as they are read so that memory stays
+    bounded no matter how many events are grouped in the episode
+"""
+import heapq
+
+# Severity labels, most important first
+SEVERITY_LABELS = [
+    'critical',
+    'high',
+    'medium',
+    'low',
+    'normal',
+    'info',
+    'other'
+]
+
+SEVERITY_RANK = dict(
+    (label, len(SEVERITY_LABELS) - index) for index, label in enumerate(SEVERITY_LABELS)
+)
+
+
+class EpisodeAggregator(object):
+    """
+        Keeps per severity counters for every event and the details of a sample of
+            events. When max_sample is set only the max_sample most severe events are
+            kept (earliest first on ties), otherwise every event is kept
+    """
+
+    def __init__(self, **kwargs):
+        """
+            @param max_sample: <int|None>, An optional cap on the number of event
+                details kept, defaults to None (keep every event)
+            @param keep_event_ids: <boolean>, An optional value which controls whether
+                the ids of events outside the sample are kept, defaults to False
+        """
+        self.max_sample = kwargs.get('max_sample')
+        self.keep_event_ids = kwargs.get('keep_event_ids', False)
+        self.event_count = 0
+        self.counts_by_severity = dict((label, 0) for label in SEVERITY_LABELS)
+        self.event_ids = []
+        # entries are (severity rank, -arrival order, event_id, event_details) so
+        # the heap root is always the least important sampled event
+        self.sample = []
+
+    def is_bounded(self):
+        """
+            @return: <boolean> True if only a sample of events is kept
+        """
+        return self.max_sample is not None
+
+    def is_sampled(self):
+        """
+            @return: <boolean> True if some events were left out of the sample
+        """
+        return self.event_count > len(self.sample)
+
+    def add(self, event_id, event_details, severity_label):
+        """
+            Counts an event and adds it to the sample if it is severe enough
+            @param event_id: <str> the event id
+            @param event_details: <dict> the event properties to send
+            @param severity_label: <str> one of SEVERITY_LABELS
+        """
+        self.event_count += 1
+        self.counts_by_severity[severity_label] += 1
+        if self.keep_event_ids and self.is_bounded():
+            self.event_ids.append(event_id)
+
+        entry = (SEVERITY_RANK[severity_label], -self.event_count, event_id, event_details)
+        if not self.is_bounded():
+            self.sample.append(entry)
+        elif len(self.sample) < self.max_sample:
+            heapq.heappush(self.sample, entry)
+        elif self.max_sample and entry > self.sample[0]:
+            heapq.heapreplace(self.sample, entry)
+
+    def get_sorted_sample(self):
+        """
+            @return: <list> the sampled entries in arrival order
+        """
+        return sorted(self.sample, key=lambda entry: -entry[1])
+
+    def get_events_by_id(self):
+        """
+            @return: <dict> a dict of sampled event ids to their event details
+        """
+        return dict((entry[2], entry[3]) for entry in self.sample)
+
+    def get_event_ids_by_severity(self):
+        """
+            @return: <dict> a dict of severities to a list of sampled event ids
+                with that severity
+        """
+        event_ids_by_severity = dict((label, []) for label in SEVERITY_LABELS)
+        label_by_rank = dict((rank, label) for label, rank in SEVERITY_RANK.items())
+        for entry in self.get_sorted_sample():
+            event_ids_by_severity[label_by_rank[entry[0]]].append(entry[2])
+        return event_ids_by_severity
+
+    def get_event_ids(self):
+        """
+            @return: <list> the ids of every event, only complete when the aggregator
+                is unbounded or keep_event_ids is set
+        """
+        if self.is_bounded():
+            return self.event_ids
+        return [entry[2] for entry in self.sample]
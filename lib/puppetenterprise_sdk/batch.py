@@ -0,0 +1,252 @@
+"""
+    Coalesces episodes from concurrent alert action processes into a single
+    Orchestrator deploy per environment. The leader reports the outcome of every
+    episode in its batch, and the other processes wait for theirs
+"""
+import json
+import os
+import time
+
+from common_utils.local_state import FileLock, get_local_path
+
+from common_utils.lazy import LazyLogger
+
+DEFAULT_LOGGER = LazyLogger('puppetenterprise.log', 'puppetenterprise_batch')
+
+# The outcomes the leader reports for the episodes of its batch
+BATCH_SENT = 'sent'
+BATCH_QUEUED = 'queued'
+BATCH_FAILED = 'failed'
+# Seconds a follower waits for its outcome once the batch window has passed
+DEFAULT_OUTCOME_TIMEOUT = 300
+# Seconds a reported outcome is kept for a follower that never reads it
+OUTCOME_TTL = 600
+# Seconds between a follower's checks for its outcome
+OUTCOME_POLL_INTERVAL = 0.1
+
+
+def group_by_environment(episodes):
+    """
+        Merges episodes that target the same environment on the same Orchestrator
+        @param episodes: <list[dict]>, episodes with endpoint_url, environment, nodes
+            and event_id keys
+
+        @return: <dict> a map of (endpoint_url, environment) to an object with the
+            deduplicated, sorted list of nodes and the event ids of every contributing episode
+    """
+    batches = {}
+    for episode in episodes:
+        key = (episode.get('endpoint_url'), episode.get('environment'))
+        batch = batches.setdefault(key, {
+            'nodes': set(),
+            'event_ids': []
+        })
+        batch['nodes'].update(episode.get('nodes', []))
+        batch['event_ids'].append(episode.get('event_id'))
+
+    for batch in batches.values():
+        batch['nodes'] = sorted(batch['nodes'])
+    return batches
+
+
+class EpisodeBatcher(object):
+    """
+        Every process appends its episode to a shared pending file. The first process
+            to find no batch in progress becomes the leader, waits out the batch window
+            and then takes every episode that arrived in the meantime. Once it has sent
+            them it reports each episode's outcome to outcomes.json, where the follower
+            that submitted the episode picks it up. A leader can find its own episode
+            already taken by the previous leader, which took it between the append and
+            the leader lock, so it waits for that outcome like a follower
+    """
+
+    def __init__(self, window, **kwargs):
+        """
+            @param window: <float>, The number of seconds to collect episodes for
+            @param logger: <Logger>, An optional logger object
+            @param batch_dir: <str>, An optional directory for the batch files,
+                defaults to local/batch in the app
+        """
+        self.logger = kwargs.get('logger', DEFAULT_LOGGER)
+        self.window = window
+        self.batch_dir = kwargs.get('batch_dir')
+        self.pending_path = self.get_path('pending.jsonl')
+        self.pending_lock_path = self.get_path('pending.lock')
+        self.leader_lock_path = self.get_path('leader.lock')
+        self.outcomes_path = self.get_path('outcomes.json')
+        self.outcomes_lock_path = self.get_path('outcomes.lock')
+
+    def get_path(self, name):
+        """
+            @param name: <str>, A file name
+            @return: <str> the path of the file in the batch directory
+        """
+        if self.batch_dir:
+            return os.path.join(self.batch_dir, name)
+        return get_local_path('batch', name)
+
+    def read_pending(self):
+        """
+            Reads and clears the pending episodes, the pending lock must be held
+            @return: <list[dict]> the pending episodes
+        """
+        episodes = []
+        if not os.path.exists(self.pending_path):
+            return episodes
+        with open(self.pending_path, 'r+') as pending_file:
+            for line in pending_file:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    episodes.append(json.loads(line))
+                except ValueError:
+                    self.logger.warn('warning=INVALID_BATCH_ENTRY entry="%s"', line)
+            pending_file.seek(0)
+            pending_file.truncate()
+        return episodes
+
+    def append(self, episode):
+        """
+            Adds an episode to the pending file
+            @param episode: <dict>, An object with endpoint_url, environment, nodes
+                and event_id keys
+        """
+        with FileLock(self.pending_lock_path):
+            with open(self.pending_path, 'a') as pending_file:
+                pending_file.write(json.dumps(episode) + '\n')
+
+    def submit(self, episode):
+        """
+            Adds an episode to the current batch
+            @param episode: <dict>, An object with endpoint_url, environment, nodes
+                and event_id keys
+
+            @return: <list[dict]|None> If this process became the leader, every
+                episode in the batch, which may not include its own. None if another
+                process will send it
+        """
+        self.append(episode)
+        return self.collect(episode)
+
+    def collect(self, episode):
+        """
+            Leads the batch if no other process does, see submit
+            @param episode: <dict>, The episode this process appended
+            @return: <list[dict]|None> the episodes of the batch, None if not the leader
+        """
+        leader_lock = FileLock(self.leader_lock_path, blocking=False)
+        if not leader_lock.acquire():
+            self.logger.info('action=BATCH_SUBMIT event_id=%s leader=False', episode.get('event_id'))
+            return None
+
+        try:
+            self.logger.info('action=BATCH_SUBMIT event_id=%s leader=True window=%s',
+                             episode.get('event_id'), self.window)
+            time.sleep(self.window)
+            # Give up leadership while still holding the pending lock, anything
+            # appended after this point will find the leader lock free
+            with FileLock(self.pending_lock_path):
+                episodes = self.read_pending()
+                leader_lock.release()
+        finally:
+            leader_lock.release()
+
+        self.logger.info('action=BATCH_COLLECTED episode_count=%d', len(episodes))
+        return episodes
+
+    def send(self, episode, send_batches, **kwargs):
+        """
+            Submits an episode and, if this process leads the batch, sends the batch
+                and reports every episode's outcome
+            @param episode: <dict>, An object with endpoint_url, environment, nodes
+                and event_id keys
+            @param send_batches: <function>, Called by the leader with the episodes of
+                the batch and a map of each event id to its outcome, which starts as
+                BATCH_FAILED and is updated as they are sent
+            @param timeout: <float>, An optional number of seconds to wait for the outcome
+                past the batch window
+
+            @return: <dict|None> the status and job_id of the episode, None if its leader
+                did not report it in time
+        """
+        event_id = episode.get('event_id')
+        episodes = self.submit(episode)
+        if episodes is not None:
+            outcomes = dict(
+                (item.get('event_id'), {'status': BATCH_FAILED, 'job_id': None}) for item in episodes
+            )
+            try:
+                send_batches(episodes, outcomes)
+            finally:
+                # report even if sending raised, so followers don't wait out their timeout
+                if outcomes:
+                    self.report(outcomes)
+            if event_id in outcomes:
+                return outcomes[event_id]
+            # the previous leader took this episode before this process led the batch
+            self.logger.info('action=BATCH_HANDED_OFF event_id=%s', event_id)
+        return self.wait_for_outcome(event_id, **kwargs)
+
+    def read_outcomes(self):
+        """
+            @return: <dict> a map of event id to its reported outcome
+        """
+        try:
+            with open(self.outcomes_path, 'r') as outcomes_file:
+                return json.load(outcomes_file)
+        except (IOError, ValueError):
+            return {}
+
+    def write_outcomes(self, outcomes):
+        """
+            Atomically replaces the outcomes, the outcomes lock must be held
+            @param outcomes: <dict> a map of event id to its reported outcome
+        """
+        temp_path = self.outcomes_path + '.tmp'
+        with open(temp_path, 'w') as outcomes_file:
+            json.dump(outcomes, outcomes_file)
+        os.rename(temp_path, self.outcomes_path)
+
+    def report(self, outcomes):
+        """
+            Publishes the outcome of every episode in the leader's batch
+            @param outcomes: <dict>, a map of event id to an object with the status,
+                one of BATCH_SENT, BATCH_QUEUED or BATCH_FAILED, and the job_id
+        """
+        now = time.time()
+        with FileLock(self.outcomes_lock_path):
+            stored = dict(
+                (event_id, outcome) for event_id, outcome in self.read_outcomes().items()
+                if now - outcome.get('reported', 0) < OUTCOME_TTL
+            )
+            for event_id, outcome in outcomes.items():
+                stored[event_id] = dict(outcome, reported=now)
+            self.write_outcomes(stored)
+        self.logger.info('action=BATCH_REPORTED episode_count=%d', len(outcomes))
+
+    def wait_for_outcome(self, event_id, **kwargs):
+        """
+            Waits for the leader to report the outcome of an episode this process submitted
+            @param event_id: <str>, The event id of the episode
+            @param timeout: <float>, An optional number of seconds to wait past the batch window
+
+            @return: <dict|None> the status and job_id of the episode, None if the leader
+                did not report it in time
+        """
+        deadline = time.time() + self.window + kwargs.get('timeout', DEFAULT_OUTCOME_TIMEOUT)
+        while True:
+            # the outcomes file is replaced atomically, so it is only locked to take one out
+            if event_id in self.read_outcomes():
+                with FileLock(self.outcomes_lock_path):
+                    outcomes = self.read_outcomes()
+                    outcome = outcomes.pop(event_id, None)
+                    self.write_outcomes(outcomes)
+                if outcome is not None:
+                    self.logger.info('action=BATCH_OUTCOME event_id=%s status=%s job_id=%s',
+                                     event_id, outcome.get('status'), outcome.get('job_id'))
+                    return outcome
+            if time.time() >= deadline:
+                self.logger.error('error=BATCH_OUTCOME_TIMEOUT event_id=%s', event_id)
+                return None
+            time.sleep(OUTCOME_POLL_INTERVAL)
@@ -0,0 +1,284 @@
+"""
+    Tracks Orchestrator jobs started by the alert action and reports their
+    per-node outcomes back to the Notable Events once they finish
+"""
+import json
+import os
+import time
+
+from common_utils.local_state import FileLock, get_local_path
+
+from common_utils.lazy import LazyLogger
+
+DEFAULT_LOGGER = LazyLogger('puppetenterprise.log', 'puppetenterprise_job_tracker')
+
+# Orchestrator job states that will not change any more
+FINISHED_STATES = [
+    'finished',
+    'failed',
+    'stopped'
+]
+
+# Poll intervals in seconds, a job is polled every POLL_INTERVAL_FACTOR * its age
+# clamped between the min and max, so long running jobs are polled less often
+MIN_POLL_INTERVAL = 10
+MAX_POLL_INTERVAL = 300
+POLL_INTERVAL_FACTOR = 0.25
+# Jobs older than this are dropped without a result
+MAX_JOB_AGE = 24 * 60 * 60
+
+# The page size used for /jobs/<id>/nodes
+NODES_PAGE_SIZE = 500
+# The maximum number of node names listed per state in a comment
+MAX_NODES_PER_STATE = 100
+
+
+def get_orchestrator_url(endpoint_url):
+    """
+        Gets the Orchestrator API base from a command url
+        @param endpoint_url: <str> eg. https://pe:8143/orchestrator/v1/command/deploy
+        @return: <str> eg. https://pe:8143/orchestrator/v1
+    """
+    index = endpoint_url.find('/command/')
+    if index == -1:
+        return endpoint_url.rstrip('/')
+    return endpoint_url[:index]
+
+
+def is_trackable_command(endpoint_url):
+    """
+        Plan jobs live under /plan_jobs/<id> and report per-node results differently
+            from /jobs/<id>, so they are not tracked
+        @param endpoint_url: <str> the Orchestrator command url the job was started with
+        @return: <bool> True if the poller can report the job's outcome
+    """
+    return not endpoint_url.rstrip('/').endswith('/command/plan_run')
+
+
+def get_poll_interval(age):
+    """
+        @param age: <float> the number of seconds since the job was started
+        @return: <float> the number of seconds until the job should be polled again
+    """
+    return min(MAX_POLL_INTERVAL, max(MIN_POLL_INTERVAL, age * POLL_INTERVAL_FACTOR))
+
+
+def build_outcome_comment(job_id, job_state, nodes):
+    """
+        @param job_id: <str> the Orchestrator job id
+        @param job_state: <str> the final job state
+        @param nodes: <list[dict]> the node items of the job
+        @return: <str> a comment summarising the outcome of every node
+    """
+    nodes_by_state = {}
+    for node in nodes:
+        nodes_by_state.setdefault(node.get('state', 'unknown'), []).append(node.get('name'))
+
+    comment = 'Puppet Enterprise job [%s] %s on %d nodes.' % (job_id, job_state, len(nodes))
+    for state in sorted(nodes_by_state):
+        names = sorted(nodes_by_state[state])
+        listed = ', '.join(names[:MAX_NODES_PER_STATE])
+        if len(names) > MAX_NODES_PER_STATE:
+            listed += ' and %d more' % (len(names) - MAX_NODES_PER_STATE)
+        comment += ' %s (%d): %s.' % (state, len(names), listed)
+    return comment
+
+
+class JobTracker(object):
+    """
+        A registry of in-flight jobs shared by every process through local/jobs
+    """
+
+    def __init__(self, **kwargs):
+        """
+            @param logger: <Logger>, An optional logger object
+            @param jobs_dir: <str>, An optional directory for the registry,
+                defaults to local/jobs in the app
+        """
+        self.logger = kwargs.get('logger', DEFAULT_LOGGER)
+        jobs_dir = kwargs.get('jobs_dir')
+        if jobs_dir:
+            self.path = os.path.join(jobs_dir, 'jobs.json')
+        else:
+            self.path = get_local_path('jobs', 'jobs.json')
+        self.lock_path = self.path + '.lock'
+
+    def read_jobs(self):
+        """
+            @return: <dict> a map of job id to the tracked job
+        """
+        try:
+            with open(self.path, 'r') as jobs_file:
+                return json.load(jobs_file)
+        except (IOError, ValueError):
+            return {}
+
+    def write_jobs(self, jobs):
+        """
+            Atomically replaces the registry, the lock must be held
+            @param jobs: <dict> a map of job id to the tracked job
+        """
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as jobs_file:
+            json.dump(jobs, jobs_file)
+        os.rename(temp_path, self.path)
+
+    def track(self, job_id, orchestrator_url, username, event_ids):
+        """
+            Starts tracking a job
+            @param job_id: <str> the Orchestrator job id
+            @param orchestrator_url: <str> the Orchestrator API base
+            @param username: <str> the puppetenterprise username used to start it
+            @param event_ids: <list[str]> the events to report the outcome to
+        """
+        now = time.time()
+        with FileLock(self.lock_path):
+            jobs = self.read_jobs()
+            jobs[job_id] = {
+                'job_id': job_id,
+                'orchestrator_url': orchestrator_url,
+                'username': username,
+                'event_ids': event_ids,
+                'created': now,
+                'next_poll': now + MIN_POLL_INTERVAL
+            }
+            self.write_jobs(jobs)
+        self.logger.info('action=TRACK_JOB job_id=%s event_count=%d', job_id, len(event_ids))
+
+    def get_due_jobs(self, now):
+        """
+            @param now: <float> the current time
+            @return: <list[dict]> the tracked jobs that should be polled now
+        """
+        return [job for job in self.read_jobs().values() if job['next_poll'] <= now]
+
+    def get_next_poll(self):
+        """
+            @return: <float|None> the earliest time a job should be polled, None if
+                no jobs are being tracked
+        """
+        jobs = self.read_jobs()
+        if not jobs:
+            return None
+        return min(job['next_poll'] for job in jobs.values())
+
+    def reschedule(self, job_id, now):
+        """
+            @param job_id: <str> the Orchestrator job id
+            @param now: <float> the current time
+        """
+        with FileLock(self.lock_path):
+            jobs = self.read_jobs()
+            job = jobs.get(job_id)
+            if job is not None:
+                job['next_poll'] = now + get_poll_interval(now - job['created'])
+                self.write_jobs(jobs)
+
+    def remove(self, job_id):
+        """
+            @param job_id: <str> the Orchestrator job id
+        """
+        with FileLock(self.lock_path):
+            jobs = self.read_jobs()
+            if jobs.pop(job_id, None) is not None:
+                self.write_jobs(jobs)
+
+
+class JobPoller(object):
+    """
+        Polls every due job in the registry through a single loop
+    """
+
+    def __init__(self, get_pe_client, report_outcome, **kwargs):
+        """
+            @param get_pe_client: <function>, Called with a username, returns a
+                PuppetEnterpriseClient
+            @param report_outcome: <function>, Called with the event ids and the
+                outcome comment of a finished job
+            @param logger: <Logger>, An optional logger object
+            @param tracker: <JobTracker>, An optional job registry
+        """
+        self.logger = kwargs.get('logger', DEFAULT_LOGGER)
+        self.tracker = kwargs.get('tracker') or JobTracker(logger=self.logger)
+        self.get_pe_client = get_pe_client
+        self.report_outcome = report_outcome
+
+    def get_all_nodes(self, pe_client, orchestrator_url, job_id):
+        """
+            Pages through the nodes of a job
+            @return: <list[dict]|bool> the node items, False if a page failed
+        """
+        nodes = []
+        offset = 0
+        while True:
+            page = pe_client.get_job_nodes(orchestrator_url, job_id, limit=NODES_PAGE_SIZE, offset=offset)
+            if page is False:
+                return False
+            items = page.get('items', [])
+            nodes.extend(items)
+            offset += len(items)
+            total = page.get('pagination', {}).get('total')
+            if len(items) < NODES_PAGE_SIZE or (total is not None and offset >= total):
+                return nodes
+
+    def poll_job(self, job, now):
+        """
+            Polls a single job, reporting and removing it once it has finished
+            @param job: <dict> the tracked job
+            @param now: <float> the current time
+        """
+        job_id = job['job_id']
+        if now - job['created'] > MAX_JOB_AGE:
+            self.logger.warn('warning=JOB_TRACKING_EXPIRED job_id=%s', job_id)
+            self.tracker.remove(job_id)
+            return
+
+        pe_client = self.get_pe_client(job.get('username'))
+        status = pe_client.get_job(job['orchestrator_url'], job_id)
+        job_state = status.get('state') if status else None
+        if job_state not in FINISHED_STATES:
+            self.tracker.reschedule(job_id, now)
+            return
+
+        nodes = self.get_all_nodes(pe_client, job['orchestrator_url'], job_id)
+        if nodes is False:
+            self.tracker.reschedule(job_id, now)
+            return
+
+        self.logger.info('action=JOB_FINISHED job_id=%s state=%s node_count=%d', job_id, job_state, len(nodes))
+        self.report_outcome(job['event_ids'], build_outcome_comment(job_id, job_state, nodes))
+        self.tracker.remove(job_id)
+
+    def run(self, max_runtime):
+        """
+            Polls jobs as they become due until none are left or max_runtime passes
+            @param max_runtime: <float> the number of seconds to run for
+        """
+        poller_lock = FileLock(self.tracker.path + '.poller', blocking=False)
+        if not poller_lock.acquire():
+            self.logger.info('action=POLL_JOBS message="another poller is running"')
+            return
+        try:
+            self.poll_until(time.time() + max_runtime)
+        finally:
+            poller_lock.release()
+
+    def poll_until(self, deadline):
+        """
+            @param deadline: <float> the time to stop polling at
+        """
+        while True:
+            now = time.time()
+            for job in self.tracker.get_due_jobs(now):
+                try:
+                    self.poll_job(job, now)
+# pylint: disable = broad-except
+                except Exception, exception:
+                    self.logger.error('error=POLL_JOB_FAILED job_id=%s', job['job_id'])
+                    self.logger.exception(exception)
+                    self.tracker.reschedule(job['job_id'], now)
+# pylint: enable = broad-except
+            next_poll = self.tracker.get_next_poll()
+            if next_poll is None or next_poll > deadline:
+                return
+            time.sleep(max(0, next_poll - time.time()))
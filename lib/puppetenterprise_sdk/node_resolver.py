@@ -0,0 +1,701 @@
+"""
+    Resolves the hosts and services of an episode to Puppet node certnames through
+    a sqlite index of the PuppetDB node list kept under local/nodes. The index is
+    shared by every process and refreshed incrementally by the node indexer scripted
+    input, so a lookup is an indexed query per host rather than a PuppetDB round trip,
+    and memory stays bounded by sqlite's page cache however large the estate is. The
+    alert action only reads the index, and registers the PuppetDB it uses and the
+    facts it needs for the indexer to pull.
+
+    The index doubles as an inventory of each node's environment and of a chosen
+    set of facts, eg. os.family and role, indexed by value so the scope of a deploy
+    can be narrowed and its environment picked without querying PuppetDB.
+"""
+import json
+import os
+import sqlite3
+import time
+
+from itertools import islice
+
+from common_utils.local_state import FileLock, get_local_path
+from common_utils.lazy import LazyLogger
+from puppetenterprise_sdk.puppetdb import iter_query
+
+DEFAULT_LOGGER = LazyLogger('puppetenterprise.log', 'puppetenterprise_node_resolver')
+
+# Seconds between incremental refreshes of the index
+DEFAULT_REFRESH_INTERVAL = 300
+# Seconds between full refreshes, which also drop deactivated nodes
+FULL_REFRESH_INTERVAL = 24 * 60 * 60
+# The number of values bound in one IN (...) lookup, below sqlite's variable limit
+LOOKUP_CHUNK_SIZE = 500
+# The number of rows written per executemany
+WRITE_BATCH_SIZE = 1000
+# sqlite page cache per connection, in KiB
+CACHE_SIZE_KB = 8192
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS nodes ('
+    ' certname TEXT PRIMARY KEY, short_name TEXT, environment TEXT,'
+    ' facts_timestamp TEXT, generation INTEGER)',
+    'CREATE INDEX IF NOT EXISTS nodes_short_name ON nodes (short_name)',
+    'CREATE INDEX IF NOT EXISTS nodes_environment ON nodes (environment)',
+    'CREATE TABLE IF NOT EXISTS node_services ('
+    ' service_id TEXT, certname TEXT, PRIMARY KEY (service_id, certname))',
+    'CREATE INDEX IF NOT EXISTS node_services_certname ON node_services (certname)',
+    'CREATE TABLE IF NOT EXISTS node_facts ('
+    ' certname TEXT, name TEXT, value TEXT, generation INTEGER, PRIMARY KEY (certname, name))',
+    'CREATE INDEX IF NOT EXISTS node_facts_value ON node_facts (name, value)',
+    'CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT)',
+]
+
+
+def get_short_name(host):
+    """
+        @param host: <str> a host name or certname
+        @return: <str> the lower case first label, eg. web01 for web01.example.com
+    """
+    return host.strip().lower().split('.', 1)[0]
+
+
+def iter_chunks(values, size):
+    """
+        @return: <iterator[list]> values in lists of at most size
+    """
+    for index in xrange(0, len(values), size):
+        yield values[index:index + size]
+
+
+def get_service_ids(value):
+    """
+        @param value: <str|list|None> a fact value or service_ids field
+        @return: <list[str]> the service ids it holds
+    """
+    if not value:
+        return []
+    if isinstance(value, basestring):
+        value = value.split(',')
+    return [str(service_id).strip() for service_id in value if str(service_id).strip()]
+
+
+def parse_fact_names(value):
+    """
+        @param value: <str|list|None> comma separated fact names, dotted for
+            structured facts, eg. os.family,role
+        @return: <list[str]> the sorted, deduplicated names
+    """
+    if not value:
+        return []
+    if isinstance(value, basestring):
+        value = value.split(',')
+    return sorted(set(name.strip() for name in value if name and name.strip()))
+
+
+def parse_fact_filters(value):
+    """
+        @param value: <str|None> comma separated name=value pairs, eg. os.family=RedHat,role=web
+        @return: <list[tuple(str, str)]> the pairs
+        @raise: ValueError, if a pair has no =
+    """
+    filters = []
+    for pair in (value or '').split(','):
+        if not pair.strip():
+            continue
+        name, separator, fact_value = pair.partition('=')
+        if not separator or not name.strip():
+            raise ValueError('Invalid fact filter "%s", expected name=value' % pair.strip())
+        filters.append((name.strip(), fact_value.strip()))
+    return filters
+
+
+def get_fact_value(value):
+    """
+        @param value: <any> a fact value from PuppetDB
+        @return: <unicode> the value as it is stored and matched, booleans the way
+            Puppet prints them
+    """
+    if isinstance(value, bool):
+        return u'true' if value else u'false'
+    if isinstance(value, (dict, list)):
+        return unicode(json.dumps(value, sort_keys=True))
+    return unicode(value)
+
+
+class NodeIndex(object):
+    """
+        The sqlite index, every method opens its own connection so it can be used
+            from any thread
+    """
+
+    def __init__(self, **kwargs):
+        """
+            @param index_dir: <str> An optional directory for the index files,
+                defaults to local/nodes in the app
+        """
+        index_dir = kwargs.get('index_dir')
+        if index_dir:
+            self.path = os.path.join(index_dir, 'nodes.db')
+        else:
+            self.path = get_local_path('nodes', 'nodes.db')
+        self.lock_path = self.path + '.lock'
+        connection = self.connect()
+        try:
+            with connection:
+                for statement in SCHEMA:
+                    connection.execute(statement)
+        finally:
+            connection.close()
+
+    def connect(self):
+        """
+            @return: <sqlite3.Connection>
+        """
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.execute('PRAGMA cache_size = -%d' % CACHE_SIZE_KB)
+        return connection
+
+    def get_state(self, key):
+        """
+            @return: <str|None> a stored refresh setting, eg. the watermark
+        """
+        connection = self.connect()
+        try:
+            row = connection.execute('SELECT value FROM state WHERE key = ?', (key,)).fetchone()
+            return row[0] if row else None
+        finally:
+            connection.close()
+
+    def set_state(self, connection, key, value):
+        connection.execute('INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)', (key, value))
+
+    def register_source(self, puppetdb_url, username, **kwargs):
+        """
+            Records where the node indexer pulls the index from, the state is only
+                written when it changes
+            @param puppetdb_url: <str> the PuppetDB query API base
+            @param username: <str> the puppetenterprise username whose token is used
+            @param service_fact: <str> An optional fact holding the ITSI service ids of a node
+            @param inventory_facts: <list[str]> An optional list of facts to keep, they
+                are added to the facts other alerts asked for
+            @param refresh_interval: <float> An optional number of seconds between refreshes
+        """
+        connection = self.connect()
+        try:
+            stored = dict(connection.execute('SELECT key, value FROM state').fetchall())
+            source = {
+                'puppetdb_url': puppetdb_url,
+                'username': username or '',
+                'service_fact': kwargs.get('service_fact') or '',
+                'inventory_facts': ','.join(parse_fact_names(
+                    parse_fact_names(stored.get('inventory_facts')) + kwargs.get('inventory_facts', [])
+                )),
+                'refresh_interval': repr(float(kwargs.get('refresh_interval', DEFAULT_REFRESH_INTERVAL)))
+            }
+            changed = dict((key, value) for key, value in source.items() if stored.get(key) != value)
+            if not changed:
+                return
+            with connection:
+                for key, value in changed.items():
+                    self.set_state(connection, key, value)
+        finally:
+            connection.close()
+
+    def get_source(self):
+        """
+            @return: <dict|None> the puppetdb_url, username, service_fact,
+                inventory_facts and refresh_interval registered by the alert action,
+                None if no action has registered one yet
+        """
+        connection = self.connect()
+        try:
+            stored = dict(connection.execute('SELECT key, value FROM state').fetchall())
+        finally:
+            connection.close()
+        if not stored.get('puppetdb_url'):
+            return None
+        return {
+            'puppetdb_url': stored['puppetdb_url'],
+            'username': stored.get('username') or None,
+            'service_fact': stored.get('service_fact') or None,
+            'inventory_facts': parse_fact_names(stored.get('inventory_facts')),
+            'refresh_interval': float(stored.get('refresh_interval') or DEFAULT_REFRESH_INTERVAL)
+        }
+
+    def write_nodes(self, nodes, generation):
+        """
+            Upserts PuppetDB node records
+            @param nodes: <iterator[dict]> records from the nodes endpoint
+            @param generation: <int> the refresh the records belong to
+            @return: <tuple(int, str|None)> the number of nodes and the latest facts_timestamp
+        """
+        count = 0
+        watermark = None
+        connection = self.connect()
+        try:
+            rows = []
+            for node in nodes:
+                certname = node['certname']
+                facts_timestamp = node.get('facts_timestamp')
+                if facts_timestamp and facts_timestamp > watermark:
+                    watermark = facts_timestamp
+                rows.append((
+                    certname,
+                    get_short_name(certname),
+                    node.get('facts_environment') or node.get('catalog_environment'),
+                    facts_timestamp,
+                    generation
+                ))
+                if len(rows) >= WRITE_BATCH_SIZE:
+                    count += self.write_rows(connection, rows)
+                    rows = []
+            count += self.write_rows(connection, rows)
+        finally:
+            connection.close()
+        return count, watermark
+
+    def write_rows(self, connection, rows):
+        with connection:
+            connection.executemany(
+                'INSERT OR REPLACE INTO nodes'
+                ' (certname, short_name, environment, facts_timestamp, generation)'
+                ' VALUES (?, ?, ?, ?, ?)',
+                rows
+            )
+        return len(rows)
+
+    def write_services(self, facts):
+        """
+            Replaces the services of every node in facts
+            @param facts: <iterator[dict]> records from the facts endpoint
+        """
+        facts = iter(facts)
+        connection = self.connect()
+        try:
+            while True:
+                chunk = list(islice(facts, WRITE_BATCH_SIZE))
+                if not chunk:
+                    return
+                with connection:
+                    connection.executemany(
+                        'DELETE FROM node_services WHERE certname = ?',
+                        [(fact['certname'],) for fact in chunk]
+                    )
+                    connection.executemany(
+                        'INSERT OR REPLACE INTO node_services (service_id, certname) VALUES (?, ?)',
+                        [
+                            (service_id, fact['certname'])
+                            for fact in chunk
+                            for service_id in get_service_ids(fact.get('value'))
+                        ]
+                    )
+        finally:
+            connection.close()
+
+    def write_facts(self, fact_contents, generation):
+        """
+            Upserts inventory facts
+            @param fact_contents: <iterator[dict]> records from the fact-contents endpoint
+            @param generation: <int> the refresh the records belong to
+            @return: <int> the number of facts written
+        """
+        count = 0
+        fact_contents = iter(fact_contents)
+        connection = self.connect()
+        try:
+            while True:
+                chunk = list(islice(fact_contents, WRITE_BATCH_SIZE))
+                if not chunk:
+                    return count
+                with connection:
+                    connection.executemany(
+                        'INSERT OR REPLACE INTO node_facts (certname, name, value, generation)'
+                        ' VALUES (?, ?, ?, ?)',
+                        [
+                            (
+                                fact['certname'],
+                                '.'.join(fact['path']),
+                                get_fact_value(fact.get('value')),
+                                generation
+                            )
+                            for fact in chunk
+                        ]
+                    )
+                count += len(chunk)
+        finally:
+            connection.close()
+
+    def finish_refresh(self, watermark, is_full, generation, now, **kwargs):
+        """
+            Records a successful refresh, a full refresh also drops every node it didn't see.
+                Facts of a node the refresh pulled that it didn't see again are dropped,
+                the node no longer has them
+            @param fact_names: <list[str]> An optional list of the inventory facts the
+                refresh pulled
+        """
+        fact_names = kwargs.get('fact_names')
+        connection = self.connect()
+        try:
+            with connection:
+                if is_full:
+                    connection.execute('DELETE FROM nodes WHERE generation != ?', (generation,))
+                    connection.execute(
+                        'DELETE FROM node_services WHERE certname NOT IN (SELECT certname FROM nodes)'
+                    )
+                    connection.execute('DELETE FROM node_facts WHERE generation != ?', (generation,))
+                else:
+                    connection.execute(
+                        'DELETE FROM node_facts WHERE generation != ?'
+                        ' AND certname IN (SELECT certname FROM nodes WHERE generation = ?)',
+                        (generation, generation)
+                    )
+                if fact_names is not None:
+                    self.set_state(connection, 'fact_names', ','.join(fact_names))
+                    self.set_state(connection, 'last_full_refresh', repr(now))
+                if watermark:
+                    self.set_state(connection, 'watermark', watermark)
+                self.set_state(connection, 'last_refresh', repr(now))
+        finally:
+            connection.close()
+
+    def lookup(self, hosts, service_ids):
+        """
+            @param hosts: <list[str]> host names, certnames or short names
+            @param service_ids: <list[str]> ITSI service ids
+            @return: <tuple(set, list)> the certnames found and the hosts that did not
+                resolve to exactly one node
+        """
+        certnames = set()
+        unresolved = []
+        connection = self.connect()
+        try:
+            by_name = dict((host.strip().lower(), host) for host in hosts if host and host.strip())
+            names = list(by_name)
+            for chunk in iter_chunks(names, LOOKUP_CHUNK_SIZE):
+                rows = connection.execute(
+                    'SELECT certname FROM nodes WHERE certname IN (%s)' % ','.join('?' * len(chunk)),
+                    chunk
+                ).fetchall()
+                for row in rows:
+                    certnames.add(row[0])
+                    by_name.pop(row[0], None)
+
+            # hosts that aren't certnames are matched on their short name when that is unique
+            by_short_name = {}
+            for name, host in by_name.items():
+                by_short_name.setdefault(get_short_name(name), []).append(host)
+            matches = {}
+            for chunk in iter_chunks(list(by_short_name), LOOKUP_CHUNK_SIZE):
+                rows = connection.execute(
+                    'SELECT short_name, certname FROM nodes WHERE short_name IN (%s)'
+                    % ','.join('?' * len(chunk)),
+                    chunk
+                ).fetchall()
+                for short_name, certname in rows:
+                    matches.setdefault(short_name, []).append(certname)
+            for short_name, short_name_hosts in by_short_name.items():
+                if len(matches.get(short_name, [])) == 1:
+                    certnames.add(matches[short_name][0])
+                else:
+                    unresolved.extend(short_name_hosts)
+
+            service_ids = sorted(set(service_ids))
+            for chunk in iter_chunks(service_ids, LOOKUP_CHUNK_SIZE):
+                rows = connection.execute(
+                    'SELECT certname FROM node_services WHERE service_id IN (%s)'
+                    % ','.join('?' * len(chunk)),
+                    chunk
+                ).fetchall()
+                certnames.update(row[0] for row in rows)
+        finally:
+            connection.close()
+        return certnames, sorted(unresolved)
+
+    def get_environments(self, certnames):
+        """
+            @param certnames: <list[str]> node certnames
+            @return: <dict> a map of environment to the sorted certnames in it, None
+                holds the certnames that aren't in the index
+        """
+        environments = {}
+        found = set()
+        connection = self.connect()
+        try:
+            for chunk in iter_chunks(sorted(set(certnames)), LOOKUP_CHUNK_SIZE):
+                rows = connection.execute(
+                    'SELECT environment, certname FROM nodes WHERE certname IN (%s)'
+                    % ','.join('?' * len(chunk)),
+                    chunk
+                ).fetchall()
+                for environment, certname in rows:
+                    environments.setdefault(environment, []).append(certname)
+                    found.add(certname)
+        finally:
+            connection.close()
+        missing = [certname for certname in certnames if certname not in found]
+        if missing:
+            environments.setdefault(None, []).extend(missing)
+        for environment_certnames in environments.values():
+            environment_certnames.sort()
+        return environments
+
+    def select_nodes(self, fact_filters, **kwargs):
+        """
+            @param fact_filters: <list[tuple(str, str)]> fact names and the values a node
+                must have for all of them
+            @param certnames: <list[str]> An optional list of certnames to select from,
+                every node in the index otherwise
+            @param environment: <str> An optional environment the nodes must be in
+            @return: <list[str]> the sorted certnames that match
+        """
+        certnames = kwargs.get('certnames')
+        environment = kwargs.get('environment')
+        # the first filter is looked up through the (name, value) index, the others
+        # through the (certname, name) primary key of the nodes it found
+        joins = []
+        params = []
+        for index, (name, value) in enumerate(fact_filters):
+            joins.append(
+                'JOIN node_facts f%d ON f%d.certname = n.certname'
+                ' AND f%d.name = ? AND f%d.value = ?' % (index, index, index, index)
+            )
+            params.extend([name, get_fact_value(value)])
+        sql = 'SELECT n.certname FROM nodes n %s WHERE 1 = 1' % ' '.join(joins)
+        if environment is not None:
+            sql += ' AND n.environment = ?'
+            params.append(environment)
+
+        selected = set()
+        connection = self.connect()
+        try:
+            if certnames is None:
+                selected.update(row[0] for row in connection.execute(sql, params))
+            else:
+                for chunk in iter_chunks(sorted(set(certnames)), LOOKUP_CHUNK_SIZE):
+                    rows = connection.execute(
+                        sql + ' AND n.certname IN (%s)' % ','.join('?' * len(chunk)),
+                        params + chunk
+                    )
+                    selected.update(row[0] for row in rows)
+        finally:
+            connection.close()
+        return sorted(selected)
+
+    def get_facts(self, certnames):
+        """
+            @param certnames: <list[str]> node certnames
+            @return: <dict> a map of certname to its inventory facts, by name
+        """
+        facts = {}
+        connection = self.connect()
+        try:
+            for chunk in iter_chunks(sorted(set(certnames)), LOOKUP_CHUNK_SIZE):
+                rows = connection.execute(
+                    'SELECT certname, name, value FROM node_facts WHERE certname IN (%s)'
+                    % ','.join('?' * len(chunk)),
+                    chunk
+                )
+                for certname, name, value in rows:
+                    facts.setdefault(certname, {})[name] = value
+        finally:
+            connection.close()
+        return facts
+
+
+class NodeResolver(object):
+    """
+        Resolves episodes against the index, and refreshes it from the node indexer
+    """
+
+    def __init__(self, pe_client, puppetdb_url, **kwargs):
+        """
+            @param pe_client: <PuppetEnterpriseClient> a client with the PE token
+            @param puppetdb_url: <str> the PuppetDB query API base
+            @param logger: <Logger> An optional logger object
+            @param index: <NodeIndex> An optional index
+            @param refresh_interval: <float> An optional number of seconds between refreshes
+            @param service_fact: <str> An optional fact holding the ITSI service ids of
+                a node, service ids are not resolved without it
+            @param inventory_facts: <list[str]> An optional list of facts to keep in the
+                inventory, dotted for structured facts, eg. os.family
+            @param strict: <bool> An optional value, True only deploys to nodes in the
+                index. Hosts that don't resolve are sent as they are by default
+        """
+        self.logger = kwargs.get('logger', DEFAULT_LOGGER)
+        self.index = kwargs.get('index') or NodeIndex()
+        self.pe_client = pe_client
+        self.puppetdb_url = puppetdb_url
+        self.refresh_interval = kwargs.get('refresh_interval', DEFAULT_REFRESH_INTERVAL)
+        self.service_fact = kwargs.get('service_fact')
+        self.inventory_facts = parse_fact_names(kwargs.get('inventory_facts'))
+        self.strict = kwargs.get('strict', False)
+
+    def is_stale(self, now):
+        last_refresh = self.index.get_state('last_refresh')
+        return last_refresh is None or now - float(last_refresh) >= self.refresh_interval
+
+    def refresh(self):
+        """
+            Pulls the nodes that changed since the watermark, or every node when a full
+                refresh is due. Only one process refreshes at a time, the others keep
+                using the index as it is
+            @return: <bool> True if this process refreshed the index
+        """
+        refresh_lock = FileLock(self.index.lock_path, blocking=False)
+        if not refresh_lock.acquire():
+            return False
+        try:
+            now = time.time()
+            # another process may have refreshed while we waited for the lock
+            if not self.is_stale(now):
+                return False
+            watermark = self.index.get_state('watermark')
+            last_full_refresh = self.index.get_state('last_full_refresh')
+            # facts another alert asked for stay in the inventory, a fact that isn't
+            # in it yet needs a full refresh to be filled in for every node
+            indexed_facts = parse_fact_names(self.index.get_state('fact_names'))
+            fact_names = parse_fact_names(indexed_facts + self.inventory_facts)
+            is_full = (
+                watermark is None or last_full_refresh is None or
+                now - float(last_full_refresh) >= FULL_REFRESH_INTERVAL or
+                fact_names != indexed_facts
+            )
+
+            query = None if is_full else ['>=', 'facts_timestamp', watermark]
+            count, latest = self.index.write_nodes(
+                iter_query(self.pe_client, self.puppetdb_url, 'nodes', query=query),
+                int(now)
+            )
+            if self.service_fact:
+                fact_query = ['=', 'name', self.service_fact]
+                if not is_full:
+                    fact_query = ['and', fact_query, [
+                        'in', 'certname',
+                        ['extract', 'certname', ['select_nodes', query]]
+                    ]]
+                self.index.write_services(
+                    iter_query(self.pe_client, self.puppetdb_url, 'facts', query=fact_query)
+                )
+            fact_count = 0
+            if fact_names:
+                fact_query = ['or'] + [['=', 'path', name.split('.')] for name in fact_names]
+                if not is_full:
+                    fact_query = ['and', fact_query, [
+                        'in', 'certname',
+                        ['extract', 'certname', ['select_nodes', query]]
+                    ]]
+                fact_count = self.index.write_facts(
+                    iter_query(self.pe_client, self.puppetdb_url, 'fact-contents', query=fact_query),
+                    int(now)
+                )
+            self.index.finish_refresh(
+                max(latest, watermark),
+                is_full,
+                int(now),
+                now,
+                fact_names=fact_names
+            )
+            self.logger.info(
+                'action=REFRESH_NODE_INDEX full=%s node_count=%d fact_count=%d watermark=%s '
+                'duration_ms=%.2f',
+                is_full,
+                count,
+                fact_count,
+                max(latest, watermark),
+                (time.time() - now) * 1000
+            )
+            return True
+        finally:
+            refresh_lock.release()
+
+    def register(self, username):
+        """
+            Registers this resolver's PuppetDB and facts with the index, for the node
+                indexer to refresh it from
+            @param username: <str> the puppetenterprise username whose token is used
+        """
+        self.index.register_source(
+            self.puppetdb_url,
+            username,
+            service_fact=self.service_fact,
+            inventory_facts=self.inventory_facts,
+            refresh_interval=self.refresh_interval
+        )
+
+    def resolve(self, hosts, service_ids):
+        """
+            Only reads the index, it is refreshed by the node indexer scripted input
+            @param hosts: <iterable[str]> the hosts of the episode
+            @param service_ids: <iterable[str]> the ITSI services of the episode
+            @return: <list[str]> the sorted certnames to deploy to. Hosts that don't
+                resolve are passed through unchanged, unless the resolver is strict and
+                the index has been built once
+        """
+        hosts = list(hosts)
+        certnames, unresolved = self.index.lookup(hosts, list(service_ids))
+        if unresolved:
+            is_dropped = self.strict and self.index.get_state('last_refresh') is not None
+            if not is_dropped:
+                certnames.update(unresolved)
+            self.logger.warn(
+                'warning=UNRESOLVED_HOSTS count=%d dropped=%s hosts="%s"',
+                len(unresolved),
+                is_dropped,
+                ','.join(unresolved[:20])
+            )
+        self.logger.info(
+            'action=RESOLVE_NODES host_count=%d certname_count=%d unresolved_count=%d',
+            len(hosts),
+            len(certnames),
+            len(unresolved)
+        )
+        return sorted(certnames)
+
+    def get_scope(self, certnames, **kwargs):
+        """
+            Narrows resolved certnames to what one deploy can target
+            @param certnames: <list[str]> the certnames from resolve
+            @param environment: <str> An optional environment to deploy, the one most
+                of the nodes are in is picked otherwise
+            @param fact_filters: <list[tuple(str, str)]> An optional list of fact names
+                and values the nodes must have
+            @param pick_environment: <bool> An optional value, False keeps the nodes of
+                every environment when none is given, defaults to True
+            @return: <tuple(str|None, list[str])> the environment and the sorted
+                certnames in it that match the filters
+        """
+        environment = kwargs.get('environment')
+        fact_filters = kwargs.get('fact_filters')
+        if fact_filters:
+            selected = self.index.select_nodes(fact_filters, certnames=certnames)
+            if len(selected) < len(certnames):
+                self.logger.info(
+                    'action=FILTER_NODES filters="%s" certname_count=%d selected_count=%d',
+                    ','.join('%s=%s' % fact_filter for fact_filter in fact_filters),
+                    len(certnames),
+                    len(selected)
+                )
+            certnames = selected
+        if environment or not certnames or not kwargs.get('pick_environment', True):
+            return environment, certnames
+
+        environments = self.index.get_environments(certnames)
+        # nodes that aren't indexed yet can't pick the environment
+        known = dict(
+            (name, names) for name, names in environments.items() if name is not None
+        ) or environments
+        environment = sorted(known, key=lambda name: (-len(known[name]), name))[0]
+        scope = known[environment]
+        if not self.strict and environment is not None and None in environments:
+            # hosts passed through unresolved go with the picked environment
+            scope = sorted(scope + environments.pop(None))
+        if len(scope) < len(certnames):
+            self.logger.warn(
+                'warning=NODES_IN_OTHER_ENVIRONMENTS environment=%s certname_count=%d '
+                'skipped_count=%d environments="%s"',
+                environment,
+                len(scope),
+                len(certnames) - len(scope),
+                ','.join(sorted(str(name) for name in environments if name != environment))
+            )
+        return environment, scope
@@ -0,0 +1,103 @@
+"""
+    Precompiled projections of event fields into Puppet Enterprise event properties.
+    A projector resolves its key list and coercion table once, so projecting an
+    event is a single pass with one dict lookup per key
+"""
+
+def coerce_list(value):
+    """
+        @return: <str> the list items joined with commas
+    """
+    return ','.join(value)
+
+def coerce_string(value):
+    """
+        @return: <str|unicode> the value unchanged
+    """
+    return value
+
+def coerce_none(value):
+    """
+        @return: <str> an empty string for missing values
+    """
+    return ''
+
+# The supported value types and how they are converted to property values
+COERCERS = {
+    list: coerce_list,
+    str: coerce_string,
+    unicode: coerce_string,
+    type(None): coerce_none
+}
+
+# Projectors are cached by key list so they are only built once per process
+PROJECTORS = {}
+
+
+def parse_keys(value, default_keys):
+    """
+        Parses a comma separated key list from an alert action parameter
+        @param value: <str|None> the parameter value
+        @param default_keys: <list[str]> the keys to use if the value is empty
+        @return: <list[str]>
+    """
+    if not value:
+        return default_keys
+    keys = [key.strip() for key in value.split(',')]
+    return [key for key in keys if key] or default_keys
+
+
+def get_projector(keys, **kwargs):
+    """
+        @param keys: <list[str]> the keys to extract
+        @param logger: <Logger> An optional logger used to report unsupported values
+        @return: <FieldProjector> a cached projector for the keys
+    """
+    cache_key = tuple(keys)
+    projector = PROJECTORS.get(cache_key)
+    if projector is None:
+        projector = FieldProjector(keys, **kwargs)
+        PROJECTORS[cache_key] = projector
+    return projector
+
+
+class FieldProjector(object):
+    """
+        Extracts and coerces a fixed set of keys from event dicts
+    """
+
+    def __init__(self, keys, **kwargs):
+        """
+            @param keys: <list[str]> the keys to extract, duplicates are ignored
+            @param logger: <Logger> An optional logger used to report unsupported values
+        """
+        self.logger = kwargs.get('logger')
+        unique_keys = []
+        for key in keys:
+            if key not in unique_keys:
+                unique_keys.append(key)
+        self.keys = tuple(unique_keys)
+
+    def project(self, source_object):
+        """
+            @param source_object: <dict>, a standard python map object
+            @return: <dict> with only the selected keys, values of unsupported
+                types are left out
+        """
+        result = {}
+        get_value = source_object.get
+        get_coercer = COERCERS.get
+        for key in self.keys:
+            value = get_value(key)
+            value_type = type(value)
+            # most values are plain strings, skip the table lookup for them
+            if value_type is str or value_type is unicode:
+                result[key] = value
+                continue
+            coerce = get_coercer(value_type)
+            if coerce is None:
+                if self.logger is not None:
+                    self.logger.warn('warning=INVALID_PROP_TYPE key=%s value_type=%s', key, value_type)
+                continue
+            result[key] = coerce(value)
+        return result
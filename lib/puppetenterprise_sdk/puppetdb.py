@@ -0,0 +1,60 @@
+"""
+    Helpers for paging through the PuppetDB v4 query API with a PuppetEnterpriseClient
+"""
+import json
+
+from urlparse import urlparse
+
+# PuppetDB listens next to the Orchestrator on a PE primary server
+PUPPETDB_PORT = 8081
+QUERY_PATH = '/pdb/query/v4'
+DEFAULT_PAGE_SIZE = 1000
+
+
+class PuppetDBException(Exception):
+    """
+        Exception Class used when a PuppetDB query fails
+    """
+    pass
+
+
+def get_puppetdb_url(endpoint_url):
+    """
+        Gets the PuppetDB query API of the server an Orchestrator url points at
+        @param endpoint_url: <str> eg. https://pe:8143/orchestrator/v1/command/deploy
+        @return: <str> eg. https://pe:8081/pdb/query/v4
+    """
+    return 'https://%s:%d%s' % (urlparse(endpoint_url).hostname, PUPPETDB_PORT, QUERY_PATH)
+
+
+def iter_query(pe_client, puppetdb_url, entity, **kwargs):
+    """
+        Yields every result of a query, a page at a time
+        @param pe_client: <PuppetEnterpriseClient> a client with the PE token
+        @param puppetdb_url: <str> the query API base, eg. https://pe:8081/pdb/query/v4
+        @param entity: <str> the entity to query, eg. nodes
+        @param query: <list> An optional AST query
+        @param order_by: <str> An optional field to page in the order of, defaults to certname
+        @param page_size: <int> An optional number of results per request
+
+        @return: <iterator[dict]>
+        @raise: PuppetDBException, if a page can't be fetched
+    """
+    query = kwargs.get('query')
+    order_by = json.dumps([{'field': kwargs.get('order_by', 'certname')}])
+    page_size = kwargs.get('page_size', DEFAULT_PAGE_SIZE)
+    url = '%s/%s' % (puppetdb_url.rstrip('/'), entity)
+
+    offset = 0
+    while True:
+        params = {'limit': page_size, 'offset': offset, 'order_by': order_by}
+        if query is not None:
+            params['query'] = json.dumps(query)
+        page = pe_client.get_resource(url, query=params)
+        if page is False:
+            raise PuppetDBException('PuppetDB query failed: %s offset=%d' % (url, offset))
+        for item in page:
+            yield item
+        if len(page) < page_size:
+            return
+        offset += len(page)
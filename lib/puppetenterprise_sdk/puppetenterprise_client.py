@@ -3,14 +3,74 @@
     Currently only supports sending events.
 """
 import base64
+import binascii
+import os
+import threading
+import urllib
 
+from common_utils import serialization
 from common_utils.rest import RESTClient
+from common_utils.governor import RequestGovernor, get_endpoint_key
+from common_utils.circuit_breaker import CircuitBreaker
+from common_utils.local_state import is_locking_supported
 
-# import ITSI libraries
-from ITOA.setup_logging import setup_logging
+from common_utils.lazy import LazyLogger
 # pylint: enable = import-error
 
-DEFAULT_LOGGER = setup_logging('puppetenterprise.log', 'puppetenterprise_client')
+DEFAULT_LOGGER = LazyLogger('puppetenterprise.log', 'puppetenterprise_client')
+
+def get_job_id(response_body):
+    """
+        Gets the id of the job created by an Orchestrator command
+        @param response_body: <dict> The parsed response from Puppet Enterprise
+        @return <str> The job name from the Orchestrator, the plan job name for
+            plan_run, or the requestId for older endpoints
+    """
+    job = response_body.get('job')
+    if job:
+        return job['name']
+    # command/plan_run answers {"name": "<plan job id>"}
+    if 'name' in response_body:
+        return response_body['name']
+    return response_body['requestId']
+
+def new_idempotency_key():
+    """
+        @return <str> A random key for an Orchestrator command, reused by every retry
+            and redelivery of that command. Orchestrator does not document de-duplicating
+            on it, so the key only marks requests that RESTClient may retry when they
+            were provably not processed
+    """
+    return binascii.hexlify(os.urandom(16))
+
+def is_endpoint_healthy(status):
+    """
+        @param status: <int|None> the status of a response, None if there was none
+        @return <bool> False if the endpoint could not be reached or failed the request
+    """
+    return status is not None and status < 500 and status != 429
+
+def is_credentials_rejected(status):
+    """
+        @param status: <int|None> the status of a response, None if there was none
+        @return <bool> True if Puppet Enterprise rejected the token
+    """
+    return status in (401, 403)
+
+def get_deploy_payload(environment, nodes):
+    """
+        Builds the body of an Orchestrator deploy command
+        @param environment: <str> The environment to deploy
+        @param nodes: <list[str]> The nodes to scope the deploy to
+        @return <str> The json payload
+    """
+    return serialization.dumps({
+        'environment': environment,
+        'noop': False,
+        'scope': {
+            'nodes': nodes
+        }
+    })
 
 class PuppetEnterpriseClient(object):
     """
@@ -19,17 +79,35 @@ class PuppetEnterpriseClient(object):
 
     def __init__(self, **kwargs):
         """
-            Constructor, takes no params
+            @param logger: <Logger> An optional logger object
+            @param governor_settings: <dict> An optional rate, burst, max_in_flight and
+                max_wait for the RequestGovernor of each endpoint, None turns governing off
+            @param request_settings: <dict> An optional connect_timeout, read_timeout,
+                max_retries and deadline for every RESTClient
+            @param circuit_settings: <dict> An optional failure_rate, min_requests, window
+                and open_seconds for the CircuitBreaker of each endpoint, None turns it off
         """
         self.logger = kwargs.get('logger', DEFAULT_LOGGER)
         self.headers = {}
         self.add_header('Content-Type', 'application/json')
+        self.governor_settings = kwargs.get('governor_settings', {})
+        self.request_settings = kwargs.get('request_settings', {})
+        self.circuit_settings = kwargs.get('circuit_settings', {})
+        self.governors = {}
+        self.circuit_breakers = {}
+        self.on_credentials_rejected = None
+        # the status of the last request of each thread, None if it got no response
+        self.last_request = threading.local()
 
-    def add_credentials(self, password, data):
+    def add_credentials(self, username, password, **kwargs):
         """
+            @param username: <str> The puppetenterprise username the token belongs to
             @param password: <str> The Token in puppetenterprise
+            @param on_rejected: <callable> An optional function called with no arguments
+                when Puppet Enterprise answers 401 or 403, eg. to drop a cached token
         """
-        self.logger.info('action=ADD_CREDENTIALS password=%s', password)
+        self.logger.info('action=ADD_CREDENTIALS username=%s', username)
+        self.on_credentials_rejected = kwargs.get('on_rejected')
 
         # Build the auth string
         self.add_header('X-Authentication', password)
@@ -43,11 +121,102 @@ class PuppetEnterpriseClient(object):
         """
         self.headers[key] = value
 
-    def send_event(self, url, puppetenterprise_event):
+    def get_governor(self, url):
+        """
+            @param url: <str> a request url
+            @return: <RequestGovernor|None> the governor shared by every request to the
+                url's endpoint, None if governing is off
+        """
+        if self.governor_settings is None or not is_locking_supported():
+            return None
+        endpoint = get_endpoint_key(url)
+        if endpoint not in self.governors:
+            self.governors[endpoint] = RequestGovernor(
+                endpoint,
+                logger=self.logger,
+                **self.governor_settings
+            )
+        return self.governors[endpoint]
+
+    def get_circuit_breaker(self, url):
+        """
+            @param url: <str> a request url
+            @return: <CircuitBreaker|None> the circuit breaker shared by every request to
+                the url's endpoint, None if it is off
+        """
+        if self.circuit_settings is None or not is_locking_supported():
+            return None
+        endpoint = get_endpoint_key(url)
+        if endpoint not in self.circuit_breakers:
+            self.circuit_breakers[endpoint] = CircuitBreaker(
+                endpoint,
+                logger=self.logger,
+                **self.circuit_settings
+            )
+        return self.circuit_breakers[endpoint]
+
+    def get_rest_client(self, url):
+        """
+            @param url: <str> a request url
+            @return: <RESTClient> a client with the governor and request settings for the url
+        """
+        return RESTClient(
+            return_json=True,
+            logger=self.logger,
+            governor=self.get_governor(url),
+            **self.request_settings
+        )
+
+    def send_request(self, url, send):
+        """
+            Sends a request through the circuit breaker of the url's endpoint, while the
+                circuit is open it fails without touching the network
+            @param url: <str> The request url
+            @param send: <callable> Takes a RESTClient and sends the request with it
+            @return <dict> | False The parsed response, False if the request failed or
+                was refused by the circuit breaker
+        """
+        rest = self.get_rest_client(url)
+        breaker = self.get_circuit_breaker(url)
+        self.last_request.status = None
+        if breaker is None:
+            response_body = send(rest)
+        else:
+            admitted_as = breaker.allow_request()
+            if admitted_as is None:
+                self.logger.warning('action=CIRCUIT_REJECTED endpoint=%s url=%s', breaker.endpoint, url)
+                return False
+            try:
+                response_body = send(rest)
+            finally:
+                # a request the governor never admitted says nothing about the endpoint
+                if rest.not_admitted:
+                    breaker.release(admitted_as)
+                else:
+                    breaker.record(admitted_as, is_endpoint_healthy(rest.status))
+        self.last_request.status = rest.status
+        if is_credentials_rejected(rest.status):
+            self.logger.warning('action=CREDENTIALS_REJECTED status=%s url=%s', rest.status, url)
+            if self.on_credentials_rejected is not None:
+                self.on_credentials_rejected()
+        return response_body
+
+    def is_last_failure_retryable(self):
+        """
+            @return <bool> True if the calling thread's last request failed in a way that
+                may succeed later: it got no response, a 5xx or a 429. False if Puppet
+                Enterprise rejected it with any other status
+        """
+        return not is_endpoint_healthy(getattr(self.last_request, 'status', None))
+
+    def send_event(self, url, puppetenterprise_event, **kwargs):
         """
             Sends an puppetenterprise_event to the specified url with the client's configuration
             @param url: <str> The inbound integration url
             @param puppetenterprise_event <PuppetEnterprise> The event to send to puppetenterprise
+            @param stream: <boolean> An optional value which controls whether the payload is
+                streamed to the socket as it is encoded, defaults to False
+            @param idempotency_key: <str> An optional key for the command, see post_command
             @return <str> | False If successful, it will return the requestId from the response
         """
 
@@ -59,15 +228,81 @@ class PuppetEnterpriseClient(object):
         """
 
         self.logger.info('action=SEND_EVENT url=%s puppetenterprise_event_type=%s', url, type(puppetenterprise_event))
-        rest = RESTClient(return_json=True, logger=self.logger)
 
-        response_body = rest.post(
+        if kwargs.get('stream', False):
+            body = puppetenterprise_event.iter_json_payload
+        else:
+            body = puppetenterprise_event.get_json_payload()
+        return self.post_command(url, body, idempotency_key=kwargs.get('idempotency_key'))
+
+    def deploy(self, url, environment, nodes, **kwargs):
+        """
+            Sends a deploy command for a set of nodes to the Orchestrator
+            @param url: <str> The command/deploy url
+            @param environment: <str> The environment to deploy
+            @param nodes: <list[str]> The nodes to scope the deploy to
+            @param idempotency_key: <str> An optional key for the command, see post_command
+            @return <str> | False If successful, it will return the job id from the response
+        """
+        self.logger.info('action=DEPLOY url=%s environment=%s node_count=%d', url, environment, len(nodes))
+        return self.post_command(
             url,
-            headers=self.headers,
-            data='{"environment" : 'module', "noop" : false, "scope: : { "nodes" : ['hostname'] } }',
-            body=puppetenterprise_event.get_json_payload(),
-            force_https=True
+            get_deploy_payload(environment, nodes),
+            idempotency_key=kwargs.get('idempotency_key')
         )
+
+    def post_command(self, url, body, **kwargs):
+        """
+            Posts a prepared payload to an Orchestrator command endpoint
+            @param url: <str> The command url
+            @param body: <str|callable> The json payload, or a callable streaming it
+            @param idempotency_key: <str> An optional key sent as the Idempotency-Key
+                header, a new one is made if it is not given. Pass the same key to
+                resend a command
+            @return <str> | False If successful, it will return the job id from the response
+        """
+        idempotency_key = kwargs.get('idempotency_key') or new_idempotency_key()
+        response_body = self.send_request(url, lambda rest: rest.post(
+            url,
+            headers=self.headers,
+            body=body,
+            force_https=True,
+            idempotency_key=idempotency_key
+        ))
         if response_body:
-            return response_body['requestId']
+            return get_job_id(response_body)
         return False
+
+    def get_resource(self, url, **kwargs):
+        """
+            Gets a resource from the Puppet Enterprise API
+            @param url: <str> The resource url
+            @param query: <dict> An optional map of query param key, value pairs
+            @return <dict> | False The parsed response, False if the request failed
+        """
+        query = kwargs.get('query')
+        if query:
+            url += '?' + urllib.urlencode(query)
+        return self.send_request(url, lambda rest: rest.get(url, headers=self.headers, force_https=True))
+
+    def get_job(self, orchestrator_url, job_id):
+        """
+            @param orchestrator_url: <str> The Orchestrator API base, eg. https://pe:8143/orchestrator/v1
+            @param job_id: <str> The job id
+            @return <dict> | False The job, False if the request failed
+        """
+        return self.get_resource('%s/jobs/%s' % (orchestrator_url, job_id))
+
+    def get_job_nodes(self, orchestrator_url, job_id, **kwargs):
+        """
+            @param orchestrator_url: <str> The Orchestrator API base
+            @param job_id: <str> The job id
+            @param limit: <int> An optional page size
+            @param offset: <int> An optional index of the first node to return
+            @return <dict> | False A page of the job's nodes, False if the request failed
+        """
+        query = {
+            'limit': kwargs.get('limit', 500),
+            'offset': kwargs.get('offset', 0)
+        }
+        return self.get_resource('%s/jobs/%s/nodes' % (orchestrator_url, job_id), query=query)
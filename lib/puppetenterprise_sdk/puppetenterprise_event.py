@@ -5,11 +5,17 @@
 import json
 
 # pylint: disable = import-error
-# import ITSI libraries
-from ITOA.setup_logging import setup_logging
+from common_utils import serialization
+from common_utils.lazy import LazyLogger
 # pylint: enable = import-error
 
-DEFAULT_LOGGER = setup_logging('puppetenterprise.log', 'puppetenterprise_event')
+DEFAULT_LOGGER = LazyLogger('puppetenterprise.log', 'puppetenterprise_event')
+
+# The Orchestrator commands an event can be sent as
+DEPLOY = 'deploy'
+TASK = 'task'
+PLAN_RUN = 'plan_run'
+COMMANDS = [DEPLOY, TASK, PLAN_RUN]
 
 class PuppetEnterpriseEvent(object):
     """
@@ -26,6 +32,11 @@ class PuppetEnterpriseEvent(object):
         self.properties = {}
         self.recipients = []
         self.priority = None
+        self.environment = None
+        self.nodes = []
+        self.command = DEPLOY
+        self.command_name = None
+        self.params = {}
 
         self.valid_priorities = [
             'HIGH',
@@ -50,6 +61,34 @@ class PuppetEnterpriseEvent(object):
         """
         self.properties[key] = value
 
+    def set_scope(self, environment, nodes):
+        """
+            Sets what the Orchestrator deploys
+            @param environment: <str>, The environment to deploy
+            @param nodes: <list[str]>, The certnames to scope the deploy to
+        """
+        self.environment = environment
+        self.nodes = nodes
+
+    def set_command(self, command, name, params):
+        """
+            Sends the event as a task or plan instead of a deploy
+            @param command: <str>, One of COMMANDS
+            @param name: <str|None>, The task or plan name, eg. package
+            @param params: <dict>, The task or plan parameters
+            @raise: ValueError, if the command is not supported
+        """
+        if command not in COMMANDS:
+            raise ValueError(
+                'error=PUPPETENTERPRISE_INVALID_COMMAND value=%s valid_commands=%s' % (
+                    command,
+                    ';'.join(COMMANDS)
+                )
+            )
+        self.command = command
+        self.command_name = name
+        self.params = params
+
     def add_recipient(self, target_name):
         """
             Adds a recipient to the recipients list in the Puppet Enterprise Event
@@ -77,19 +116,59 @@ class PuppetEnterpriseEvent(object):
             )
 
 
-    def get_json_payload(self):
+    def get_payload(self):
         """
-            Gets the json payload as a string to send to Puppet Enterprise
-            @return <str>
+            Gets the payload to send to Puppet Enterprise, an Orchestrator deploy or
+                task command carrying the event in its userdata, or a plan_run
+                command, which only takes the plan parameters
+            @return <dict>
         """
-        body = {
+        if self.command == PLAN_RUN:
+            return {
+                'plan_name': self.command_name,
+                'environment': self.environment,
+                'params': self.params
+            }
+
+        userdata = {
             'properties': self.properties
         }
 
         # empty arrays are considered falsey in python
         if self.recipients:
-            body['recipients'] = self.recipients
+            userdata['recipients'] = self.recipients
         if self.priority is not None:
-            body['priority'] = self.priority
+            userdata['priority'] = self.priority
+        if self.command == TASK:
+            return {
+                'environment': self.environment,
+                'task': self.command_name,
+                'params': self.params,
+                'scope': {
+                    'nodes': self.nodes
+                },
+                'userdata': userdata
+            }
+        return {
+            'environment': self.environment,
+            'noop': False,
+            'scope': {
+                'nodes': self.nodes
+            },
+            'userdata': userdata
+        }
 
-        return json.dumps(body)
+    def get_json_payload(self):
+        """
+            Gets the json payload as a string to send to Puppet Enterprise
+            @return <str>
+        """
+        return serialization.dumps(self.get_payload())
+
+    def iter_json_payload(self):
+        """
+            Encodes the json payload piece by piece so it can be streamed without
+                building the whole string in memory
+            @return <iterator[str]>
+        """
+        return json.JSONEncoder().iterencode(self.get_payload())
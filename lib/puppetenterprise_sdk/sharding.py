@@ -0,0 +1,58 @@
+"""
+    Splits the scope of a large episode into shards, each sent as its own Orchestrator
+    job. Every job runs at PE's per-job concurrency and a slow or failing node only
+    holds up the shard it is in
+"""
+
+# The number of shards submitted at the same time
+DEFAULT_SHARD_CONCURRENCY = 4
+# The shard_by value that splits nodes by their environment rather than by a fact
+SHARD_BY_ENVIRONMENT = 'environment'
+
+
+def split_scope(groups, shard_size):
+    """
+        Splits every group of nodes into shards of at most shard_size nodes, a group
+            that needs several shards is spread evenly over them
+        @param groups: <dict> a map of a group value, eg. an environment or a fact
+            value, to the certnames in it
+        @param shard_size: <int> the most nodes in a shard, 0 keeps each group whole
+        @return: <list[dict]> the shards, with the group value and the sorted nodes,
+            ordered by group value
+    """
+    shards = []
+    for group in sorted(groups):
+        nodes = sorted(groups[group])
+        if not nodes:
+            continue
+        shard_count = 1
+        if shard_size > 0:
+            shard_count = (len(nodes) + shard_size - 1) // shard_size
+        # the first len(nodes) % shard_count shards take one extra node
+        base_size, extra = divmod(len(nodes), shard_count)
+        start = 0
+        for index in xrange(shard_count):
+            end = start + base_size + (1 if index < extra else 0)
+            shards.append({'group': group, 'nodes': nodes[start:end]})
+            start = end
+    return shards
+
+
+def format_summary(shards, node_count):
+    """
+        @param shards: <list[dict]> the shards, with the group they were split by, their
+            nodes and the outcome of their request in result, a job id or a status
+        @param node_count: <int> the number of nodes in the episode
+        @return: <str> a comment listing the job of every shard
+    """
+    lines = ['Sent %d jobs to Puppet Enterprise for %d nodes:' % (len(shards), node_count)]
+    for index, shard in enumerate(shards):
+        group = ' %s' % shard['group'] if shard['group'] is not None else ''
+        lines.append('shard %d/%d%s (%d nodes): %s' % (
+            index + 1,
+            len(shards),
+            group,
+            len(shard['nodes']),
+            shard['result']
+        ))
+    return '\n'.join(lines)
@@ -0,0 +1,314 @@
+"""
+    A durable, append-only spool of Orchestrator requests that could not be
+    delivered, and the sender loop that drains it. Records that are rejected, or
+    that still fail after DEFAULT_MAX_ATTEMPTS or DEFAULT_MAX_AGE, are moved to a
+    dead-letter file
+"""
+import json
+import os
+import random
+import time
+
+from common_utils.local_state import FileLock, get_local_path
+
+from common_utils.lazy import LazyLogger
+
+DEFAULT_LOGGER = LazyLogger('puppetenterprise.log', 'puppetenterprise_spool')
+
+# Returned in place of a job id when a request was spooled for later delivery
+REQUEST_QUEUED = object()
+
+# The outcomes send_record reports to drain
+SEND_DELIVERED = 'delivered'
+# the request may succeed later, eg. PE could not be reached or answered 5xx or 429
+SEND_FAILED = 'failed'
+# PE refused the request, eg. with a 4xx, sending it again won't help
+SEND_REJECTED = 'rejected'
+
+# The number of appended records buffered before they are written and fsynced
+DEFAULT_FSYNC_BATCH_SIZE = 50
+# Backoff settings for the sender, in seconds
+DEFAULT_BACKOFF_BASE = 1
+DEFAULT_BACKOFF_CAP = 60
+# The maximum number of seconds a single drain may run for
+DEFAULT_MAX_RUNTIME = 50
+# The number of records read from the spool at a time
+DEFAULT_READ_BATCH_SIZE = 100
+# The number of failed attempts, across drains, after which a record is dead-lettered
+DEFAULT_MAX_ATTEMPTS = 20
+# The number of seconds after it was spooled that a record is dead-lettered
+DEFAULT_MAX_AGE = 24 * 60 * 60
+
+
+def get_backoff_delay(attempt, **kwargs):
+    """
+        Exponential backoff with full jitter
+        @param attempt: <int>, The number of consecutive failures so far
+        @param base: <float>, An optional base delay in seconds
+        @param cap: <float>, An optional maximum delay in seconds
+
+        @return: <float>, The number of seconds to wait before the next attempt
+    """
+    base = kwargs.get('base', DEFAULT_BACKOFF_BASE)
+    cap = kwargs.get('cap', DEFAULT_BACKOFF_CAP)
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+class OutboundSpool(object):
+    """
+        Records are appended as json lines to outbound.log. The sender keeps the byte
+            offset of the last delivered record in outbound.offset and truncates the log
+            once everything in it has been delivered. The failed attempts of the first
+            undelivered record are kept in outbound.attempts, and records given up on are
+            appended to outbound.dead
+    """
+
+    def __init__(self, **kwargs):
+        """
+            @param logger: <Logger>, An optional logger object
+            @param spool_dir: <str>, An optional directory for the spool files,
+                defaults to local/spool in the app
+            @param fsync_batch_size: <int>, An optional number of appended records to
+                buffer before writing them with a single fsync
+        """
+        self.logger = kwargs.get('logger', DEFAULT_LOGGER)
+        self.spool_dir = kwargs.get('spool_dir')
+        self.fsync_batch_size = kwargs.get('fsync_batch_size', DEFAULT_FSYNC_BATCH_SIZE)
+        self.log_path = self.get_path('outbound.log')
+        self.offset_path = self.get_path('outbound.offset')
+        self.attempts_path = self.get_path('outbound.attempts')
+        self.dead_letter_path = self.get_path('outbound.dead')
+        self.lock_path = self.get_path('outbound.lock')
+        self.sender_lock_path = self.get_path('sender.lock')
+        self.buffer = []
+
+    def get_path(self, name):
+        """
+            @param name: <str>, A file name
+            @return: <str> the path of the file in the spool directory
+        """
+        if self.spool_dir:
+            return os.path.join(self.spool_dir, name)
+        return get_local_path('spool', name)
+
+    def append(self, record):
+        """
+            Buffers a record, call flush to make sure it is on disk
+            @param record: <dict>, A json serializable request record
+        """
+        self.buffer.append(json.dumps(record))
+        if len(self.buffer) >= self.fsync_batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+            Writes the buffered records and fsyncs the spool
+        """
+        if not self.buffer:
+            return
+        with FileLock(self.lock_path):
+            with open(self.log_path, 'a') as log_file:
+                log_file.write('\n'.join(self.buffer) + '\n')
+                log_file.flush()
+                os.fsync(log_file.fileno())
+        self.logger.info('action=SPOOL_FLUSH record_count=%d', len(self.buffer))
+        self.buffer = []
+
+    def get_offset(self):
+        """
+            @return: <int> the byte offset of the first undelivered record
+        """
+        try:
+            with open(self.offset_path, 'r') as offset_file:
+                return int(offset_file.read().strip() or 0)
+        except (IOError, ValueError):
+            return 0
+
+    def set_offset(self, offset):
+        """
+            Atomically replaces the offset file, the spool lock must be held
+            @param offset: <int> the byte offset of the first undelivered record
+        """
+        temp_path = self.offset_path + '.tmp'
+        with open(temp_path, 'w') as offset_file:
+            offset_file.write(str(offset))
+            offset_file.flush()
+            os.fsync(offset_file.fileno())
+        os.rename(temp_path, self.offset_path)
+
+    def get_attempts(self, offset):
+        """
+            @param offset: <int> the offset just past the first undelivered record
+            @return: <int> the failed attempts at delivering that record in earlier drains
+        """
+        try:
+            with open(self.attempts_path, 'r') as attempts_file:
+                attempts_offset, attempts = attempts_file.read().split()
+            return int(attempts) if int(attempts_offset) == offset else 0
+        except (IOError, ValueError):
+            return 0
+
+    def set_attempts(self, offset, attempts):
+        """
+            @param offset: <int> the offset just past the first undelivered record
+            @param attempts: <int> the failed attempts at delivering it
+        """
+        temp_path = self.attempts_path + '.tmp'
+        with open(temp_path, 'w') as attempts_file:
+            attempts_file.write('%d %d' % (offset, attempts))
+        os.rename(temp_path, self.attempts_path)
+
+    def dead_letter(self, record, reason):
+        """
+            Appends a record that won't be delivered to the dead-letter file
+            @param record: <dict> the request record
+            @param reason: <str> why it was given up on
+        """
+        with FileLock(self.lock_path):
+            with open(self.dead_letter_path, 'a') as dead_file:
+                dead_file.write(json.dumps({'reason': reason, 'failed': time.time(), 'record': record}) + '\n')
+                dead_file.flush()
+                os.fsync(dead_file.fileno())
+        self.logger.error(
+            'error=SPOOL_DEAD_LETTER reason=%s url=%s event_ids=%s',
+            reason,
+            record.get('url'),
+            ','.join(record.get('event_ids', []))
+        )
+
+    def read_pending(self, limit):
+        """
+            Reads undelivered records without removing them
+            @param limit: <int> the maximum number of records to read
+
+            @return: <list[tuple(int, dict|None)]> the offset just past each record and
+                the record, None if the line could not be parsed
+        """
+        entries = []
+        if not os.path.exists(self.log_path):
+            return entries
+        with open(self.log_path, 'r') as log_file:
+            log_file.seek(self.get_offset())
+            while len(entries) < limit:
+                line = log_file.readline()
+                if not line.endswith('\n'):
+                    # end of file, or a record that is still being written
+                    break
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    self.logger.error('error=INVALID_SPOOL_RECORD record="%s"', line.strip())
+                    record = None
+                entries.append((log_file.tell(), record))
+        return entries
+
+    def commit(self, offset):
+        """
+            Marks every record before offset as delivered, truncating the log when it
+                has been fully delivered
+            @param offset: <int> the offset just past the last delivered record
+        """
+        with FileLock(self.lock_path):
+            # the attempts belong to the record just delivered or given up on
+            try:
+                os.remove(self.attempts_path)
+            except OSError:
+                pass
+            if offset >= os.path.getsize(self.log_path):
+                # reset the offset before truncating, a crash in between then
+                # redelivers records instead of skipping new ones
+                self.set_offset(0)
+                with open(self.log_path, 'w'):
+                    pass
+            else:
+                self.set_offset(offset)
+
+    def drain(self, send_record, **kwargs):
+        """
+            Delivers spooled records in order, backing off while delivery fails. Only one
+                process drains the spool at a time. A record is dead-lettered when it is
+                rejected, when it has failed max_attempts times or when it is older
+                than max_age
+            @param send_record: <function>, Called with each record, returns SEND_DELIVERED,
+                SEND_FAILED or SEND_REJECTED
+            @param on_dead_letter: <function>, An optional function called with each record
+                and the reason it was dead-lettered, eg. to comment on its events
+            @param max_runtime: <float>, An optional number of seconds to give up after
+            @param max_attempts: <int>, An optional number of failed attempts per record
+            @param max_age: <float>, An optional number of seconds a record is retried for
+            @param backoff_base: <float>, An optional base backoff delay in seconds
+            @param backoff_cap: <float>, An optional maximum backoff delay in seconds
+
+            @return: <int> the number of records delivered
+        """
+        on_dead_letter = kwargs.get('on_dead_letter')
+        max_runtime = kwargs.get('max_runtime', DEFAULT_MAX_RUNTIME)
+
+        sender_lock = FileLock(self.sender_lock_path, blocking=False)
+        if not sender_lock.acquire():
+            self.logger.info('action=SPOOL_DRAIN message="another sender is running"')
+            return 0
+
+        deadline = time.time() + max_runtime
+        delivered_count = 0
+        try:
+            while time.time() < deadline:
+                entries = self.read_pending(DEFAULT_READ_BATCH_SIZE)
+                if not entries:
+                    break
+                for offset, record in entries:
+                    if record is not None:
+                        reason = self.send_with_backoff(record, offset, send_record, deadline, **kwargs)
+                        if reason is None:
+                            self.logger.warn('warning=SPOOL_DRAIN_INCOMPLETE delivered_count=%d', delivered_count)
+                            return delivered_count
+                        if reason == SEND_DELIVERED:
+                            delivered_count += 1
+                        else:
+                            self.dead_letter(record, reason)
+                            if on_dead_letter is not None:
+                                on_dead_letter(record, reason)
+                    self.commit(offset)
+        finally:
+            sender_lock.release()
+
+        self.logger.info('action=SPOOL_DRAIN delivered_count=%d', delivered_count)
+        return delivered_count
+
+    def send_with_backoff(self, record, offset, send_record, deadline, **kwargs):
+        """
+            Sends the first undelivered record until it is delivered or given up on,
+                the failed attempts are kept so they add up over drains
+            @param record: <dict> the request record
+            @param offset: <int> the offset just past the record
+            @param send_record: <function>, see drain
+            @param deadline: <float> the time the drain has to finish by
+            @param max_attempts: <int>, An optional number of failed attempts per record
+            @param max_age: <float>, An optional number of seconds a record is retried for
+            @param backoff_base: <float>, An optional base backoff delay in seconds
+            @param backoff_cap: <float>, An optional maximum backoff delay in seconds
+
+            @return: <str|None> SEND_DELIVERED, the reason the record is given up on,
+                or None if the deadline was reached first
+        """
+        max_attempts = kwargs.get('max_attempts', DEFAULT_MAX_ATTEMPTS)
+        max_age = kwargs.get('max_age', DEFAULT_MAX_AGE)
+        backoff_base = kwargs.get('backoff_base', DEFAULT_BACKOFF_BASE)
+        backoff_cap = kwargs.get('backoff_cap', DEFAULT_BACKOFF_CAP)
+
+        attempt = self.get_attempts(offset)
+        while True:
+            if time.time() - record.get('created', time.time()) > max_age:
+                return 'expired'
+            outcome = send_record(record)
+            if outcome in (SEND_DELIVERED, SEND_REJECTED):
+                return outcome
+            attempt += 1
+            if attempt >= max_attempts:
+                return 'max_attempts'
+            self.set_attempts(offset, attempt)
+            delay = get_backoff_delay(attempt, base=backoff_base, cap=backoff_cap)
+            if time.time() + delay > deadline:
+                return None
+            self.logger.info('action=SPOOL_BACKOFF attempt=%d delay=%.2f', attempt, delay)
+            time.sleep(delay)
@@ -0,0 +1,147 @@
+"""
+    Suppresses repeated remediation of the same nodes. ITSI runs the alert action
+    again on every episode update, so the first send of a (environment, nodes,
+    command) target claims it for a suppression window and every later send of the
+    same target inside the window is skipped. Claims live in a sqlite database under
+    local/suppression so concurrent action processes agree on them.
+"""
+import hashlib
+import os
+import sqlite3
+import time
+
+from common_utils.local_state import get_local_path
+from common_utils.lazy import LazyLogger
+
+DEFAULT_LOGGER = LazyLogger('puppetenterprise.log', 'puppetenterprise_suppression')
+
+# Seconds a deploy of a target suppresses repeats of it, 0 turns suppression off
+DEFAULT_SUPPRESSION_TTL = 900
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS claims ('
+    ' target TEXT PRIMARY KEY, environment TEXT, command TEXT, node_count INTEGER,'
+    ' job_id TEXT, created REAL, expires REAL, suppressed_count INTEGER DEFAULT 0)',
+    'CREATE INDEX IF NOT EXISTS claims_expires ON claims (expires)',
+]
+
+
+def get_target_key(environment, nodes, command):
+    """
+        @param environment: <str> the code environment
+        @param nodes: <list[str]> the certnames, in any order
+        @param command: <str> the Orchestrator command, eg. deploy
+        @return: <str> a digest identifying the target
+    """
+    node_hash = hashlib.sha1('\n'.join(sorted(set(nodes)))).hexdigest()
+    return hashlib.sha1('%s\0%s\0%s' % (environment or '', node_hash, command)).hexdigest()
+
+
+class SuppressionWindow(object):
+    """
+        The shared claims, every method opens its own connection so it can be used
+            from any thread
+    """
+
+    def __init__(self, ttl, **kwargs):
+        """
+            @param ttl: <float> the seconds a claim suppresses repeats of its target
+            @param logger: <Logger> An optional logger object
+            @param store_dir: <str> An optional directory for the database,
+                defaults to local/suppression in the app
+        """
+        self.ttl = ttl
+        self.logger = kwargs.get('logger', DEFAULT_LOGGER)
+        store_dir = kwargs.get('store_dir')
+        if store_dir:
+            self.path = os.path.join(store_dir, 'claims.db')
+        else:
+            self.path = get_local_path('suppression', 'claims.db')
+        connection = self.connect()
+        try:
+            with connection:
+                for statement in SCHEMA:
+                    connection.execute(statement)
+        finally:
+            connection.close()
+
+    def connect(self):
+        """
+            @return: <sqlite3.Connection> a connection whose transactions take the
+                write lock on their first write, so a claim's read and write are atomic
+        """
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.isolation_level = 'IMMEDIATE'
+        return connection
+
+    def claim(self, target, **kwargs):
+        """
+            Claims a target unless it is already claimed, in which case the repeat is
+                counted against the existing claim
+            @param target: <str> the key from get_target_key
+            @param environment: <str> An optional environment, recorded for the logs
+            @param command: <str> An optional command, recorded for the logs
+            @param node_count: <int> An optional node count, recorded for the logs
+            @param now: <float> An optional current time
+
+            @return: <dict|None> None if this caller now holds the claim, otherwise the
+                existing claim with job_id, created, expires and suppressed_count
+        """
+        now = kwargs.get('now') or time.time()
+        connection = self.connect()
+        try:
+            with connection:
+                connection.execute('DELETE FROM claims WHERE expires <= ?', (now,))
+                row = connection.execute(
+                    'SELECT job_id, created, expires, suppressed_count FROM claims WHERE target = ?',
+                    (target,)
+                ).fetchone()
+                if row is None:
+                    connection.execute(
+                        'INSERT INTO claims (target, environment, command, node_count, created, expires)'
+                        ' VALUES (?, ?, ?, ?, ?, ?)',
+                        (
+                            target,
+                            kwargs.get('environment'),
+                            kwargs.get('command'),
+                            kwargs.get('node_count'),
+                            now,
+                            now + self.ttl
+                        )
+                    )
+                    return None
+                connection.execute(
+                    'UPDATE claims SET suppressed_count = suppressed_count + 1 WHERE target = ?',
+                    (target,)
+                )
+        finally:
+            connection.close()
+        job_id, created, expires, suppressed_count = row
+        return {
+            'job_id': job_id,
+            'created': created,
+            'expires': expires,
+            'suppressed_count': suppressed_count + 1,
+        }
+
+    def set_job_id(self, target, job_id):
+        """
+            Records the job started for a claim, so suppressed repeats can point at it
+        """
+        connection = self.connect()
+        try:
+            with connection:
+                connection.execute('UPDATE claims SET job_id = ? WHERE target = ?', (job_id, target))
+        finally:
+            connection.close()
+
+    def release(self, target):
+        """
+            Drops a claim whose send failed, so the next attempt is not suppressed
+        """
+        connection = self.connect()
+        try:
+            with connection:
+                connection.execute('DELETE FROM claims WHERE target = ?', (target,))
+        finally:
+            connection.close()
@@ -0,0 +1,146 @@
+"""
+    Parameter templates for Orchestrator task and plan commands, rendered from the
+    fields of an episode. A template is a json object whose string values may hold
+    {field} placeholders, eg.
+
+        {"name": "{pkgname}", "version": "{pkgver}", "targets": "{nodes}"}
+
+    A value that is a single placeholder takes the field's value as it is, so lists
+    stay lists, other strings have the values formatted into them and {{ and }} are
+    literal braces. Templates are parsed and compiled once per process and cached by
+    (template, version), so rendering is a walk over the compiled parts with one
+    dict lookup per placeholder
+"""
+import json
+
+from string import Formatter
+
+# Compiled templates are cached by (template, version) so they are only parsed once per process
+TEMPLATES = {}
+# The number of cached templates after which the cache is cleared
+MAX_TEMPLATES = 256
+
+
+class TemplateException(Exception):
+    """
+        Exception Class used when a template can't be parsed or rendered
+    """
+    pass
+
+
+def format_field(value):
+    """
+        @return: <unicode> the value as it appears inside a string, lists joined
+            with commas the way event properties are
+    """
+    if value is None:
+        return u''
+    if isinstance(value, (list, tuple)):
+        return u','.join(unicode(item) for item in value)
+    return unicode(value)
+
+
+def get_field(fields, name):
+    """
+        @return: <any> the value of the field
+        @raise: TemplateException, if the fields don't have it
+    """
+    try:
+        return fields[name]
+    except KeyError:
+        raise TemplateException('Missing template field "%s"' % name)
+
+
+def compile_string(value):
+    """
+        @param value: <str> a template string
+        @return: <function> renders the string from a dict of fields
+        @raise: TemplateException, if the string isn't a valid template
+    """
+    try:
+        parts = list(Formatter().parse(value))
+    except ValueError, error:
+        raise TemplateException('Invalid template "%s": %s' % (value, error))
+    for _, name, format_spec, conversion in parts:
+        if name == '' or format_spec or conversion:
+            raise TemplateException('Invalid template "%s": only {field} placeholders are supported' % value)
+
+    names = [name for _, name, _, _ in parts if name is not None]
+    if not names:
+        literal = u''.join(literal for literal, _, _, _ in parts)
+        return lambda fields: literal
+    if len(parts) == 1 and not parts[0][0]:
+        name = parts[0][1]
+        return lambda fields: get_field(fields, name)
+
+    pieces = [(literal, name) for literal, name, _, _ in parts]
+
+    def render(fields):
+        rendered = []
+        for literal, name in pieces:
+            rendered.append(literal)
+            if name is not None:
+                rendered.append(format_field(get_field(fields, name)))
+        return u''.join(rendered)
+    return render
+
+
+def compile_value(value):
+    """
+        @param value: <any> a parsed json template value
+        @return: <function> renders the value from a dict of fields
+    """
+    if isinstance(value, dict):
+        items = [(key, compile_value(item)) for key, item in value.items()]
+        return lambda fields: dict((key, render(fields)) for key, render in items)
+    if isinstance(value, list):
+        renders = [compile_value(item) for item in value]
+        return lambda fields: [render(fields) for render in renders]
+    if isinstance(value, basestring):
+        return compile_string(value)
+    return lambda fields: value
+
+
+def get_template(source, **kwargs):
+    """
+        @param source: <str> the json template
+        @param version: <str> An optional version of the template, a new version is
+            compiled even if the source is unchanged
+        @return: <ParameterTemplate> a cached compiled template
+        @raise: TemplateException, if the template isn't valid
+    """
+    cache_key = (source, kwargs.get('version'))
+    template = TEMPLATES.get(cache_key)
+    if template is None:
+        template = ParameterTemplate(source)
+        if len(TEMPLATES) >= MAX_TEMPLATES:
+            TEMPLATES.clear()
+        TEMPLATES[cache_key] = template
+    return template
+
+
+class ParameterTemplate(object):
+    """
+        A compiled parameter template
+    """
+
+    def __init__(self, source):
+        """
+            @param source: <str> the json template, an object of parameters
+            @raise: TemplateException, if the template isn't valid
+        """
+        try:
+            parsed = json.loads(source) if source else {}
+        except ValueError, error:
+            raise TemplateException('Invalid parameter template: %s' % error)
+        if not isinstance(parsed, dict):
+            raise TemplateException('The parameter template must be a json object')
+        self.render_params = compile_value(parsed)
+
+    def render(self, fields):
+        """
+            @param fields: <dict> the values of the placeholders
+            @return: <dict> the parameters
+            @raise: TemplateException, if a placeholder has no value
+        """
+        return self.render_params(fields)
@@ -0,0 +1,99 @@
+"""
+    Tests for the cross-process batch protocol in puppetenterprise_sdk.batch. Each
+    EpisodeBatcher stands in for an alert action process, the locks are flocks on
+    their own file handles so they exclude each other the same way
+
+    Usage: python -m unittest discover -s tests
+"""
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path[:0] = [os.path.join(ROOT, 'lib'), os.path.join(ROOT, 'benchmarks', 'stubs')]
+# the splunk stubs and the logs resolve paths under SPLUNK_HOME
+os.environ.setdefault('SPLUNK_HOME', tempfile.mkdtemp())
+
+from common_utils.local_state import FileLock
+from puppetenterprise_sdk.batch import EpisodeBatcher, BATCH_SENT
+
+
+def get_episode(event_id):
+    return {
+        'event_id': event_id,
+        'endpoint_url': 'https://pe.example.com:8143',
+        'environment': 'production',
+        'nodes': ['%s.example.com' % event_id]
+    }
+
+
+class RecordingSender(object):
+    """
+        A send_batches that marks every episode sent in one job per call
+    """
+
+    def __init__(self):
+        self.batches = []
+
+    def __call__(self, episodes, outcomes):
+        self.batches.append(sorted(episode['event_id'] for episode in episodes))
+        for episode in episodes:
+            outcomes[episode['event_id']] = {'status': BATCH_SENT, 'job_id': 'job-%d' % len(self.batches)}
+
+
+class EpisodeBatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.batch_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.batch_dir)
+
+    def get_batcher(self, window):
+        return EpisodeBatcher(window, batch_dir=self.batch_dir)
+
+    def test_follower_gets_leader_outcome(self):
+        sender = RecordingSender()
+        leader = self.get_batcher(0.5)
+        outcomes = {}
+        thread = threading.Thread(
+            target=lambda: outcomes.update(a=leader.send(get_episode('a'), sender, timeout=5))
+        )
+        thread.start()
+        # wait for the leader to hold the lock before following it
+        probe = FileLock(leader.leader_lock_path, blocking=False)
+        while thread.is_alive() and probe.acquire():
+            probe.release()
+            time.sleep(0.01)
+        outcomes['b'] = self.get_batcher(0.5).send(get_episode('b'), sender, timeout=5)
+        thread.join()
+
+        self.assertEqual(sender.batches, [['a', 'b']])
+        self.assertEqual(outcomes['a']['status'], BATCH_SENT)
+        self.assertEqual(outcomes['b']['job_id'], 'job-1')
+
+    def test_episode_taken_before_leading(self):
+        # the previous leader collects the episode between its append and the leader
+        # lock, so the process leads an empty batch and must wait for that outcome
+        sender = RecordingSender()
+        previous_leader = self.get_batcher(0)
+        batcher = self.get_batcher(0)
+
+        def append_then_hand_off(episode):
+            EpisodeBatcher.append(batcher, episode)
+            previous_leader.send(get_episode('a'), sender, timeout=1)
+        batcher.append = append_then_hand_off
+
+        outcome = batcher.send(get_episode('b'), sender, timeout=1)
+
+        self.assertEqual(sender.batches, [['a', 'b'], []])
+        self.assertEqual(outcome['status'], BATCH_SENT)
+        self.assertEqual(outcome['job_id'], 'job-1')
+
+
+if __name__ == '__main__':
+    unittest.main()